@@ -0,0 +1 @@
+"""Synthetic-phantom and start-up benchmarks for the pipeline (``python -m benchmark``)."""
@@ -0,0 +1,64 @@
+"""
+Synthetic-phantom benchmarks for the DIPY pipeline stages.
+
+Usage
+-----
+>>> python -m benchmark --shape 32 32 16 --n_vols 33 --shells 1000 \
+...                     --out bench/current.json --baseline bench/baseline.json
+>>> python -m benchmark --startup      # import-time budgets only
+"""
+
+import argparse
+import sys
+
+from .suite import CASES, run_suite, save_results, load_results, compare, format_comparison
+from .startup import check_startup, format_startup
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the DIPY pipeline on a synthetic phantom")
+    parser.add_argument("--cases", nargs="*", default=None, choices=sorted(CASES), help="Cases to run; defaults to all")
+    parser.add_argument("--shape", nargs=3, type=int, default=[32, 32, 16], help="Phantom matrix size")
+    parser.add_argument("--n_vols", type=int, default=33, help="Total number of volumes")
+    parser.add_argument("--shells", nargs="+", type=float, default=[1000.0], help="Diffusion-weighted b-values")
+    parser.add_argument("--n_b0", type=int, default=1, help="Number of b0 volumes")
+    parser.add_argument("--configuration", choices=["single", "parallel", "crossing"], default="crossing")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case")
+    parser.add_argument("--work_dir", default=None, help="Keep intermediate files here instead of a temp dir")
+    parser.add_argument("--out", default=None, help="Write results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Compare against this results JSON")
+    parser.add_argument("--time_threshold", type=float, default=0.2, help="Allowed relative slow-down")
+    parser.add_argument("--mem_threshold", type=float, default=0.2, help="Allowed relative memory growth")
+    parser.add_argument("--startup", action="store_true",
+                        help="Check package import times against their budgets instead of running the cases")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        rows, over_budget = check_startup(repeat=args.repeat)
+        print(format_startup(rows))
+        if over_budget:
+            print(f"Over budget: {', '.join(over_budget)}")
+            return 1
+        return 0
+
+    report = run_suite(
+        cases=args.cases, repeat=args.repeat, work_dir=args.work_dir,
+        shape=tuple(args.shape), n_vols=args.n_vols, shells=tuple(args.shells),
+        n_b0=args.n_b0, configuration=args.configuration,
+    )
+    if args.out:
+        save_results(report, args.out)
+
+    if args.baseline:
+        rows, regressions = compare(report, load_results(args.baseline),
+                                    time_threshold=args.time_threshold,
+                                    mem_threshold=args.mem_threshold)
+        print(format_comparison(rows))
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
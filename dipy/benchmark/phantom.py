@@ -0,0 +1,203 @@
+import os
+import numpy as np
+from dipy.io.image import save_nifti
+
+
+# Diffusivities (mm^2/s) of the three synthetic tissue classes
+WM_EVALS = (1.7e-3, 0.3e-3, 0.3e-3)
+GM_DIFFUSIVITY = 0.8e-3
+CSF_DIFFUSIVITY = 3.0e-3
+
+
+def sphere_directions(n):
+    """Return ``n`` roughly uniform unit vectors on a Fibonacci sphere."""
+    idx = np.arange(n) + 0.5
+    theta = np.arccos(1 - idx / n)              # half-sphere is enough for DWI
+    phi = np.pi * (1 + 5 ** 0.5) * idx
+    return np.stack([np.cos(phi) * np.sin(theta),
+                     np.sin(phi) * np.sin(theta),
+                     np.cos(theta)], axis=-1)
+
+
+def gradient_scheme(n_vols=33, shells=(1000,), n_b0=1):
+    """
+    Build a b-value/b-vector scheme with ``n_b0`` b0 volumes and the remaining
+    volumes spread evenly over ``shells``.
+
+    Returns
+    -------
+    bvals : np.ndarray
+        (N,) b-values.
+    bvecs : np.ndarray
+        (N, 3) unit gradient directions (zeros for b0 volumes).
+    """
+    n_dwi = n_vols - n_b0
+    if n_dwi < 6 * len(shells):
+        raise ValueError("Need at least 6 diffusion-weighted volumes per shell.")
+    counts = np.full(len(shells), n_dwi // len(shells))
+    counts[:n_dwi % len(shells)] += 1
+
+    bvals = [np.zeros(n_b0)]
+    bvecs = [np.zeros((n_b0, 3))]
+    for shell, count in zip(shells, counts):
+        bvals.append(np.full(count, float(shell)))
+        bvecs.append(sphere_directions(count))
+    return np.concatenate(bvals), np.concatenate(bvecs)
+
+
+def make_phantom(shape=(32, 32, 16), n_vols=33, shells=(1000,), n_b0=1,
+                 voxel_size=2.0, configuration="crossing", n_regions=(2, 4, 2),
+                 snr=30.0, seed=0):
+    """
+    Generate a synthetic DWI phantom with known fibre configuration and atlas.
+
+    The brain is an ellipsoid of grey matter with a CSF "ventricle" in its
+    centre. White matter is made of straight bundles: one along x for
+    ``configuration="single"``, one along x and one along y for ``"parallel"``
+    (side by side, non-overlapping) and for ``"crossing"`` (overlapping, with
+    a two-tensor signal in the crossing region).
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Matrix size of the volume.
+    n_vols : int
+        Total number of volumes, b0s included.
+    shells : sequence of float
+        b-values of the diffusion-weighted shells.
+    n_b0 : int
+        Number of leading b0 volumes.
+    voxel_size : float
+        Isotropic voxel size in mm.
+    configuration : {"single", "parallel", "crossing"}
+        Fibre configuration of the white matter.
+    n_regions : tuple of int
+        Number of atlas parcels along each axis; labels run from 1.
+    snr : float
+        b0 signal-to-noise ratio of the Rician noise (``None`` for no noise).
+    seed : int
+        Seed of the noise generator.
+
+    Returns
+    -------
+    dict
+        ``dwi``, ``affine``, ``bvals``, ``bvecs``, ``mask``, ``atlas``,
+        ``wm`` (bundle count per voxel) and ``directions`` (ground-truth
+        principal direction of the first bundle in each WM voxel).
+    """
+    if configuration not in ("single", "parallel", "crossing"):
+        raise ValueError(f"Unknown fibre configuration: {configuration}")
+    shape = tuple(int(s) for s in shape)
+    bvals, bvecs = gradient_scheme(n_vols, shells, n_b0)
+
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3, 3] = -voxel_size * (np.asarray(shape) - 1) / 2.0
+
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, s) for s in shape],
+                                indexing="ij"), axis=-1)
+    radius = np.sqrt(np.sum((grid / 0.9) ** 2, axis=-1))
+    mask = radius <= 1.0
+    csf = np.sqrt(np.sum((grid / 0.15) ** 2, axis=-1)) <= 1.0
+
+    # Straight bundles: x-bundle in the lower y band, y-bundle in the right x band
+    # (shifted on top of the x-bundle for the crossing configuration)
+    half_width = 0.2
+    z_band = np.abs(grid[..., 2]) <= 0.5
+    x_bundle = mask & z_band & (np.abs(grid[..., 1] + 0.4) <= half_width)
+    y_center = -0.4 if configuration == "crossing" else 0.4
+    y_bundle = mask & z_band & (np.abs(grid[..., 0] - y_center) <= half_width)
+    if configuration == "single":
+        y_bundle[:] = False
+    elif configuration == "parallel":
+        y_bundle &= ~x_bundle
+    x_bundle &= ~csf
+    y_bundle &= ~csf
+    wm = x_bundle.astype(np.uint8) + y_bundle.astype(np.uint8)
+
+    def tensor_signal(direction):
+        # S/S0 = exp(-b g^T D g) for a cylindrically symmetric tensor
+        cos2 = (bvecs @ np.asarray(direction, dtype=float)) ** 2
+        adc = WM_EVALS[1] + (WM_EVALS[0] - WM_EVALS[1]) * cos2
+        return np.exp(-bvals * adc)
+
+    x_signal = tensor_signal((1, 0, 0))
+    y_signal = tensor_signal((0, 1, 0))
+    gm_signal = np.exp(-bvals * GM_DIFFUSIVITY)
+    csf_signal = np.exp(-bvals * CSF_DIFFUSIVITY)
+
+    s0 = np.where(csf, 2000.0, 1000.0) * mask
+    attenuation = np.empty(shape + (len(bvals),), dtype=np.float32)
+    attenuation[...] = gm_signal
+    attenuation[csf] = csf_signal
+    attenuation[x_bundle] = x_signal
+    attenuation[y_bundle] = y_signal
+    attenuation[x_bundle & y_bundle] = 0.5 * (x_signal + y_signal)
+    dwi = (s0[..., None] * attenuation).astype(np.float32)
+
+    if snr:
+        rng = np.random.default_rng(seed)
+        sigma = 1000.0 / snr
+        real = dwi + rng.normal(0, sigma, dwi.shape).astype(np.float32)
+        imag = rng.normal(0, sigma, dwi.shape).astype(np.float32)
+        dwi = np.sqrt(real ** 2 + imag ** 2)
+
+    directions = np.zeros(shape + (3,), dtype=np.float32)
+    directions[x_bundle] = (1, 0, 0)
+    directions[y_bundle & ~x_bundle] = (0, 1, 0)
+
+    # Atlas: a regular block parcellation of the brain mask
+    idx = [np.minimum((np.arange(s) * n // s), n - 1)
+           for s, n in zip(shape, n_regions)]
+    ii, jj, kk = np.meshgrid(*idx, indexing="ij")
+    atlas = (ii * n_regions[1] * n_regions[2] + jj * n_regions[2] + kk + 1)
+    atlas = np.where(mask, atlas, 0).astype(np.int16)
+
+    return {
+        "dwi": dwi,
+        "affine": affine,
+        "bvals": bvals,
+        "bvecs": bvecs,
+        "mask": mask,
+        "atlas": atlas,
+        "wm": wm,
+        "directions": directions,
+    }
+
+
+def save_phantom(phantom, out_dir, template_shift=(4.0, -2.0, 2.0)):
+    """
+    Write a phantom to ``out_dir`` using the subject-directory file layout.
+
+    Besides the DWI, bval/bvec, mask and DWI-space atlas, a mean-b0 image and a
+    copy of the atlas on a grid translated by ``template_shift`` mm (standing
+    in for a template-space atlas that still needs registration) are saved.
+
+    Returns
+    -------
+    dict
+        Paths keyed by ``dwi``, ``bval``, ``bvec``, ``mask``, ``b0``,
+        ``atlas`` and ``atlas_template``.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    affine = phantom["affine"]
+    paths = {
+        "dwi": os.path.join(out_dir, "DTI-Mono_noPAT.nii.gz"),
+        "bval": os.path.join(out_dir, "DTI-Mono_noPAT.bval"),
+        "bvec": os.path.join(out_dir, "DTI-Mono_noPAT.bvec"),
+        "mask": os.path.join(out_dir, "mask.nii.gz"),
+        "b0": os.path.join(out_dir, "b0.nii.gz"),
+        "atlas": os.path.join(out_dir, "atlas_in_dwi.nii.gz"),
+        "atlas_template": os.path.join(out_dir, "atlas_template.nii.gz"),
+    }
+    b0s = phantom["bvals"] == 0
+    save_nifti(paths["dwi"], phantom["dwi"], affine)
+    np.savetxt(paths["bval"], phantom["bvals"][None], fmt="%g")
+    np.savetxt(paths["bvec"], phantom["bvecs"].T, fmt="%.6f")
+    save_nifti(paths["mask"], phantom["mask"].astype(np.uint8), affine)
+    save_nifti(paths["b0"], phantom["dwi"][..., b0s].mean(axis=-1), affine)
+    save_nifti(paths["atlas"], phantom["atlas"], affine)
+
+    template_affine = affine.copy()
+    template_affine[:3, 3] += template_shift
+    save_nifti(paths["atlas_template"], phantom["atlas"], template_affine)
+    return paths
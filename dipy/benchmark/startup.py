@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import subprocess
+
+# Directory holding the ``preprocess``/``tractography`` packages and ``tract.py``
+PIPELINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Import statement -> wall-time budget in seconds for a fresh interpreter.
+# Measured at ~0.06 s for the bare packages, ~0.2 s with numpy and ~0.3 s for
+# ``tract`` (against ~1.3 s when every module imported dipy eagerly); the
+# budgets leave headroom for slower nodes and shared file systems.
+STARTUP_BUDGETS = {
+    "import preprocess": 0.25,
+    "import tractography": 0.25,
+    "from preprocess import extract_b0": 0.5,
+    "from preprocess import screen_outliers": 0.5,
+    "from tractography import dot_to_matrix": 0.5,
+    "from tractography import connectivity_from_streamlines": 0.5,
+    "from tractography import save_density_maps": 0.5,
+    "from tractography.spatial_index import load_index": 0.5,
+    "import tract": 0.75,
+}
+
+
+def time_import(statement, repeat=5):
+    """
+    Best wall time of running ``statement`` in a fresh interpreter.
+
+    Interpreter start-up itself is included, as it is for every worker
+    invocation; the minimum over ``repeat`` runs filters out cold caches.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], cwd=PIPELINE_DIR, check=True,
+                       stdout=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def slowest_imports(statement, n=10):
+    """
+    Modules with the largest cumulative import time (``-X importtime``).
+
+    Returns
+    -------
+    list of (str, float)
+        Module name and cumulative import time in seconds, slowest first.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=PIPELINE_DIR,
+                            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(modules, key=lambda m: m[1], reverse=True)[:n]
+
+
+def check_startup(budgets=None, repeat=5):
+    """
+    Time every statement of ``budgets`` and compare with its budget.
+
+    Returns
+    -------
+    rows : list of dict
+        ``statement``, ``time``, ``budget`` and ``over`` per statement, plus
+        ``slowest`` (see ``slowest_imports``) for statements over budget.
+    over_budget : list of str
+        Statements slower than their budget.
+    """
+    budgets = STARTUP_BUDGETS if budgets is None else budgets
+    rows, over_budget = [], []
+    for statement, budget in budgets.items():
+        elapsed = time_import(statement, repeat=repeat)
+        row = {"statement": statement, "time": elapsed, "budget": budget, "over": elapsed > budget}
+        if row["over"]:
+            row["slowest"] = slowest_imports(statement, n=5)
+            over_budget.append(statement)
+        rows.append(row)
+    return rows, over_budget
+
+
+def format_startup(rows):
+    """Render the rows of ``check_startup`` as a plain-text table."""
+    lines = [f"{'statement':56s} {'time':>7s} {'budget':>7s}"]
+    for row in rows:
+        flag = "  <-- over budget" if row["over"] else ""
+        lines.append(f"{row['statement']:56s} {row['time']:6.3f}s {row['budget']:6.3f}s{flag}")
+        for name, cumulative in row.get("slowest", []):
+            lines.append(f"    {name:52s} {cumulative:6.3f}s")
+    return "\n".join(lines)
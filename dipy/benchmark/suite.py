@@ -0,0 +1,308 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+
+from dipy.core.gradients import gradient_table
+
+# Resolve the pipeline packages when executed outside the ``dipy/`` directory
+PIPELINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PIPELINE_DIR not in sys.path:
+    sys.path.insert(0, PIPELINE_DIR)
+
+from preprocess import denoise, remove_gibbs, motion_correction, brain_mask, registration, tensor_fit
+from tractography import deterministic_tractography, connectivity_from_streamlines
+from .phantom import make_phantom, save_phantom
+
+
+DOT_TO_MATRIX = os.path.join(PIPELINE_DIR, "tractography", "dot_to_matrix.py")
+# Rows/columns of the synthetic .dot matrix converted by the dot_to_matrix case
+DOT_SIZE = 400
+
+
+class Context:
+    """Phantom data and scratch space shared by the benchmark cases."""
+
+    def __init__(self, phantom, work_dir):
+        self.phantom = phantom
+        self.work_dir = work_dir
+        self.paths = save_phantom(phantom, os.path.join(work_dir, "subject"))
+        self.gtab = gradient_table(phantom["bvals"], bvecs=phantom["bvecs"])
+        self._streamlines = None
+
+    def out_dir(self, name):
+        path = os.path.join(self.work_dir, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def streamlines(self):
+        """Tractogram of the phantom, tracked once and reused."""
+        if self._streamlines is None:
+            self._streamlines = deterministic_tractography(
+                self.paths["dwi"], self.paths["mask"], self.paths["bval"],
+                self.paths["bvec"], self.out_dir("tracking_cache"))[:2]
+        return self._streamlines
+
+    def dot_file(self, n_rows=DOT_SIZE, n_cols=DOT_SIZE, density=0.05, seed=0):
+        """
+        Write a synthetic probtrackx ``.dot`` matrix of fixed size.
+
+        The size does not follow the phantom: ``dot_to_matrix.py`` writes a
+        dense square CSV, which for one row per mask voxel would time the
+        disk rather than the conversion.
+        """
+        path = os.path.join(self.work_dir, "fdt_matrix.dot")
+        if os.path.exists(path):
+            return path
+        rng = np.random.default_rng(seed)
+        n_entries = max(1, int(n_rows * n_cols * density))
+        flat = rng.choice(n_rows * n_cols, size=n_entries, replace=False)
+        rows, cols = np.unravel_index(np.sort(flat), (n_rows, n_cols))
+        values = rng.integers(1, 500, size=n_entries)
+        np.savetxt(path, np.column_stack([rows + 1, cols + 1, values]), fmt="%d")
+        return path
+
+
+# ----------------------------------------------------------------------------
+# Benchmark cases: each takes a Context and runs one pipeline stage
+# ----------------------------------------------------------------------------
+
+def bench_denoise(ctx):
+    denoise(ctx.phantom["dwi"])
+
+
+def bench_remove_gibbs(ctx):
+    remove_gibbs(ctx.phantom["dwi"])
+
+
+def bench_motion_correction(ctx):
+    motion_correction(ctx.phantom["dwi"], ctx.phantom["affine"])
+
+
+def bench_brain_mask(ctx):
+    brain_mask(ctx.phantom["dwi"], ctx.gtab)
+
+
+def bench_tensor_fit(ctx):
+    tensor_fit(ctx.phantom["dwi"], ctx.phantom["affine"], ctx.phantom["mask"],
+               ctx.gtab, out_dir=ctx.out_dir("tensor_fit"))
+
+
+def bench_registration(ctx):
+    registration(ctx.paths["atlas_template"], ctx.paths["b0"],
+                 out_dir=ctx.out_dir("registration"), out_name="atlas_in_dwi.nii.gz")
+
+
+def bench_deterministic_tractography(ctx):
+    deterministic_tractography(ctx.paths["dwi"], ctx.paths["mask"], ctx.paths["bval"],
+                               ctx.paths["bvec"], ctx.out_dir("tractography"))
+
+
+def bench_connectivity_from_streamlines(ctx):
+    streamlines, affine = ctx.streamlines()         # cached by SETUP
+    connectivity_from_streamlines(streamlines, ctx.paths["atlas"], affine,
+                                  ctx.out_dir("connectivity"))
+
+
+def bench_dot_to_matrix(ctx):
+    # Runs the converter as the pipelines do, in a separate interpreter
+    out_csv = os.path.join(ctx.out_dir("dot_to_matrix"), "connectivity_matrix.csv")
+    proc = subprocess.Popen([sys.executable, DOT_TO_MATRIX, ctx.dot_file(), out_csv])    # written by SETUP
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise RuntimeError(f"dot_to_matrix.py exited with status {proc.returncode}")
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss * scale
+
+
+CASES = {
+    "denoise": bench_denoise,
+    "remove_gibbs": bench_remove_gibbs,
+    "motion_correction": bench_motion_correction,
+    "brain_mask": bench_brain_mask,
+    "tensor_fit": bench_tensor_fit,
+    "registration": bench_registration,
+    "deterministic_tractography": bench_deterministic_tractography,
+    "connectivity_from_streamlines": bench_connectivity_from_streamlines,
+    "dot_to_matrix": bench_dot_to_matrix,
+}
+
+# Inputs a case reads from the Context, built (and cached) before it is timed
+SETUP = {
+    "connectivity_from_streamlines": Context.streamlines,
+    "dot_to_matrix": Context.dot_file,
+}
+
+
+# ----------------------------------------------------------------------------
+# Running, storing and comparing
+# ----------------------------------------------------------------------------
+
+def measure(case, ctx, repeat=3, setup=None):
+    """
+    Time ``case`` ``repeat`` times, then run it once more under tracemalloc.
+
+    ``setup(ctx)``, if given, runs first, outside the timed and traced runs
+    (e.g. to track the streamlines a connectivity case reads). Timing runs
+    are kept free of tracing overhead. The memory figure is the
+    tracemalloc peak of Python/NumPy allocations, or the peak resident set of
+    the child process for cases that return one.
+
+    Returns
+    -------
+    dict
+        ``times_s`` (all runs), ``median_s``, ``min_s`` and ``peak_mb``.
+    """
+    if setup is not None:
+        setup(ctx)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case(ctx)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        child_peak = case(ctx)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    if child_peak is not None:
+        peak = child_peak
+
+    return {
+        "times_s": times,
+        "median_s": float(np.median(times)),
+        "min_s": float(np.min(times)),
+        "peak_mb": peak / 2 ** 20,
+    }
+
+
+def run_suite(cases=None, repeat=3, work_dir=None, **phantom_kwargs):
+    """
+    Run the benchmark cases on a freshly generated phantom.
+
+    Parameters
+    ----------
+    cases : sequence of str or None
+        Names from ``CASES``; all cases by default.
+    repeat : int
+        Number of timed runs per case.
+    work_dir : str or None
+        Scratch directory; a temporary one is created and removed if None.
+    **phantom_kwargs
+        Forwarded to ``make_phantom`` (shape, n_vols, shells, configuration, ...).
+
+    Returns
+    -------
+    dict
+        ``config`` (phantom and environment description) and ``results``
+        keyed by case name. A case that raises is stored with an ``error``.
+    """
+    cases = list(cases or CASES)
+    unknown = sorted(set(cases) - set(CASES))
+    if unknown:
+        raise ValueError(f"Unknown benchmark case(s): {', '.join(unknown)}")
+
+    cleanup = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="dmri_bench_")
+    phantom = make_phantom(**phantom_kwargs)
+    config = {
+        "shape": list(phantom["dwi"].shape),
+        "shells": sorted(float(b) for b in np.unique(phantom["bvals"]) if b > 0),
+        "n_b0": int(np.sum(phantom["bvals"] == 0)),
+        "phantom": {k: (list(v) if isinstance(v, tuple) else v) for k, v in phantom_kwargs.items()},
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+    }
+
+    results = {}
+    try:
+        ctx = Context(phantom, work_dir)
+        for name in cases:
+            print(f"Benchmarking {name} ...")
+            try:
+                results[name] = measure(CASES[name], ctx, repeat=repeat, setup=SETUP.get(name))
+            except Exception as exc:  # keep going, the failure is part of the report
+                results[name] = {"error": f"{type(exc).__name__}: {exc}"}
+                print(f"  failed: {results[name]['error']}")
+                continue
+            print(f"  median {results[name]['median_s']:.3f} s, peak {results[name]['peak_mb']:.1f} MB")
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {"config": config, "results": results}
+
+
+def save_results(report, path):
+    """Write a benchmark report to JSON."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to: {path}")
+
+
+def load_results(path):
+    """Read a benchmark report written by ``save_results``."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(report, baseline, time_threshold=0.2, mem_threshold=0.2):
+    """
+    Compare a report against a baseline report.
+
+    A case regresses when its median time grows by more than ``time_threshold``
+    or its peak memory by more than ``mem_threshold`` (relative to the
+    baseline), or when it fails where the baseline succeeded.
+
+    Returns
+    -------
+    rows : list of dict
+        One row per case present in both reports, with the ratios.
+    regressions : list of str
+        Names of the regressed cases.
+    """
+    if report["config"].get("shape") != baseline["config"].get("shape"):
+        print("Warning: baseline was recorded on a different phantom shape.")
+
+    rows, regressions = [], []
+    for name, new in report["results"].items():
+        old = baseline["results"].get(name)
+        if old is None or "error" in old:
+            continue
+        if "error" in new:
+            rows.append({"case": name, "error": new["error"]})
+            regressions.append(name)
+            continue
+        time_ratio = new["median_s"] / old["median_s"] if old["median_s"] else float("inf")
+        mem_ratio = new["peak_mb"] / old["peak_mb"] if old["peak_mb"] else 1.0
+        regressed = time_ratio > 1 + time_threshold or mem_ratio > 1 + mem_threshold
+        rows.append({"case": name, "time_ratio": time_ratio, "mem_ratio": mem_ratio,
+                     "regressed": regressed})
+        if regressed:
+            regressions.append(name)
+    return rows, regressions
+
+
+def format_comparison(rows):
+    """Render the rows of ``compare`` as a plain-text table."""
+    lines = [f"{'case':32s} {'time':>8s} {'memory':>8s}"]
+    for row in rows:
+        if "error" in row:
+            lines.append(f"{row['case']:32s} FAILED: {row['error']}")
+            continue
+        flag = "  <-- regression" if row["regressed"] else ""
+        lines.append(f"{row['case']:32s} {row['time_ratio']:7.2f}x {row['mem_ratio']:7.2f}x{flag}")
+    return "\n".join(lines)
@@ -1,8 +1,49 @@
-from .denoise import denoise
-from .gibbs import remove_gibbs
-from .motion import motion_correction
-from .mask import brain_mask
-from .b0 import extract_b0
-from .preprocess import preprocess
-from .registration import registration
-from .tensor_fit import tensor_fit
+"""
+DWI preprocessing stages.
+
+Names are imported lazily on first access, so ``from preprocess import
+extract_b0`` loads neither dipy's alignment stack nor the denoisers.
+"""
+import sys
+import types
+import importlib
+
+_LAZY = {
+    "denoise": ".denoise",
+    "remove_gibbs": ".gibbs",
+    "motion_correction": ".motion",
+    "brain_mask": ".mask",
+    "screen_outliers": ".outliers",
+    "extract_b0": ".b0",
+    "preprocess": ".preprocess",
+    "registration": ".registration",
+    "resample_labels": ".resample",
+    "apply_label_transform": ".resample",
+    "tensor_fit": ".tensor_fit",
+}
+
+__all__ = sorted(_LAZY)
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        if not name.startswith("_"):     # plain submodule access, e.g. ``pkg.resample``
+            try:
+                return importlib.import_module(f".{name}", __name__)
+            except ModuleNotFoundError as err:
+                if err.name != f"{__name__}.{name}":
+                    raise
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    importlib.import_module(_LAZY[name], __name__)
+    # importing a submodule binds it on the package (``preprocess.denoise`` etc.);
+    # the function of the same name wins, as with the former star imports
+    for lazy_name, module in _LAZY.items():
+        loaded = sys.modules.get(__name__ + module)
+        if loaded is not None and (lazy_name not in globals()
+                                   or isinstance(globals()[lazy_name], types.ModuleType)):
+            globals()[lazy_name] = getattr(loaded, lazy_name)
+    return globals()[name]
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
@@ -1,8 +1,9 @@
 import numpy as np
-from dipy.denoise.localpca import mppca
 
 
 def denoise(dwi):
     """Denoise diffusion data using MPPCA."""
+    from dipy.denoise.localpca import mppca
+
     dwi = np.asarray(dwi)
-    return mppca(dwi, patch_shape=(5, 5, 5), returnsigma=False)
+    return mppca(dwi, patch_radius=2, return_sigma=False)
@@ -1,10 +1,11 @@
 import numpy as np
-from dipy.align.imaffine import AffineRegistration, AffineMap
-from dipy.align.transforms import RigidTransform3D
 
 
 def motion_correction(dwi, affine, reference_volume=0):
     """Simple volume-to-volume motion correction using rigid-body registration."""
+    from dipy.align.imaffine import AffineRegistration, AffineMap
+    from dipy.align.transforms import RigidTransform3D
+
     n_vols = dwi.shape[-1]
     ref_data = dwi[..., reference_volume].astype(np.float32)
     corrected = []
@@ -0,0 +1,135 @@
+import numpy as np
+
+
+def shell_groups(bvals, b0_threshold=50, shell_tol=100):
+    """Shell index of every volume (0 = b0, then shells by increasing b-value)."""
+    bvals = np.asarray(bvals, dtype=float)
+    rounded = np.where(bvals <= b0_threshold, 0, np.round(bvals / shell_tol) * shell_tol)
+    return np.unique(rounded, return_inverse=True)[1]
+
+
+def _robust_z(values, groups):
+    """Per-group robust z-score (median / MAD) along the last axis of ``values``."""
+    z = np.zeros_like(values, dtype=float)
+    ref = np.ones_like(values, dtype=float)
+    for g in np.unique(groups):
+        cols = groups == g
+        if cols.sum() < 3:            # too few volumes for a reference
+            ref[..., cols] = values[..., cols]
+            continue
+        med = np.median(values[..., cols], axis=-1, keepdims=True)
+        mad = 1.4826 * np.median(np.abs(values[..., cols] - med), axis=-1, keepdims=True)
+        mad = np.maximum(mad, 1e-6 * np.maximum(np.abs(med), 1e-12))
+        z[..., cols] = (values[..., cols] - med) / mad
+        ref[..., cols] = med
+    return z, ref
+
+
+def outlier_stats(dwi, bvals, mask=None, b0_threshold=50, z_threshold=4.0, min_drop=0.1,
+                  max_bad_slices=0.1):
+    """
+    Per-volume and per-slice signal statistics against the shell-matched median.
+
+    The mean signal of every axial slice of every volume (inside ``mask``)
+    is computed in one pass and compared with the median of the volumes of
+    the same shell (b0s with b0s). A slice is an outlier when it lies more
+    than ``z_threshold`` robust SDs below that reference and has lost more
+    than ``min_drop`` of its signal (dropout); a volume when its mean
+    deviates by more than ``z_threshold`` in either direction or more than
+    ``max_bad_slices`` of its slices are outliers.
+
+    Parameters
+    ----------
+    dwi : np.ndarray
+        4D DWI data.
+    bvals : np.ndarray
+        b-values, one per volume.
+    mask : np.ndarray or None
+        Brain mask; if None, voxels brighter than the mean b0 average are used.
+
+    Returns
+    -------
+    dict
+        ``slice_ratio`` (n_slices, n_vols) signal relative to the reference,
+        ``bad_slices`` (n_slices, n_vols) bool, ``volume_z`` (n_vols,),
+        ``outliers`` (sorted volume indices) and ``weights`` (fraction of
+        good slices per volume, 0 for outlier volumes).
+    """
+    bvals = np.asarray(bvals, dtype=float)
+    groups = shell_groups(bvals, b0_threshold)
+    if mask is None:
+        b0 = dwi[..., bvals <= b0_threshold] if np.any(bvals <= b0_threshold) else dwi
+        b0 = np.mean(b0, axis=-1)
+        mask = b0 > b0.mean()
+    mask = np.asarray(mask, dtype=np.float32)
+
+    # (n_slices, n_vols) masked slice sums in a single pass over the data
+    voxels = mask.sum(axis=(0, 1))
+    slice_sum = np.einsum("xyzv,xyz->zv", dwi, mask, dtype=np.float64)
+    valid = voxels > 0.05 * voxels.max() if voxels.max() > 0 else voxels > 0
+    slice_mean = slice_sum[valid] / voxels[valid, None]
+
+    slice_z, slice_ref = _robust_z(slice_mean, groups)
+    ratio = np.divide(slice_mean, slice_ref, out=np.ones_like(slice_mean), where=slice_ref > 0)
+    bad = (slice_z < -z_threshold) & (ratio < 1 - min_drop)
+
+    volume_mean = slice_sum[valid].sum(axis=0) / max(voxels[valid].sum(), 1)
+    volume_z = _robust_z(volume_mean[None], groups)[0][0]
+    bad_fraction = bad.mean(axis=0) if bad.size else np.zeros(len(bvals))
+    is_outlier = (np.abs(volume_z) > z_threshold) | (bad_fraction > max_bad_slices)
+
+    # never lose every b0
+    b0s = np.flatnonzero(groups == 0) if np.any(bvals <= b0_threshold) else np.empty(0, int)
+    if b0s.size and is_outlier[b0s].all():
+        is_outlier[b0s[np.argmin(np.abs(volume_z[b0s]))]] = False
+
+    full_ratio = np.ones((dwi.shape[2], len(bvals)))
+    full_bad = np.zeros((dwi.shape[2], len(bvals)), dtype=bool)
+    full_ratio[valid], full_bad[valid] = ratio, bad
+    weights = np.where(is_outlier, 0.0, 1.0 - bad_fraction)
+    return {
+        "slice_ratio": full_ratio,
+        "bad_slices": full_bad,
+        "volume_z": volume_z,
+        "outliers": np.flatnonzero(is_outlier),
+        "weights": weights,
+    }
+
+
+def screen_outliers(dwi, bvals, bvecs, mask=None, action="drop", **kwargs):
+    """
+    Detect outlier volumes and drop them with their bval/bvec entries.
+
+    Parameters
+    ----------
+    dwi : np.ndarray
+        4D DWI data.
+    bvals : np.ndarray
+        (n_vols,) b-values.
+    bvecs : np.ndarray
+        (n_vols, 3) gradient directions.
+    action : {"drop", "report"}
+        Remove the flagged volumes, or only report them. Either way
+        ``stats["weights"][stats["kept"]]`` matches the returned volumes and
+        can be passed to ``tensor_fit(..., volume_weights=...)``.
+    **kwargs
+        Thresholds passed to ``outlier_stats``.
+
+    Returns
+    -------
+    dwi, bvals, bvecs : np.ndarray
+        Screened data (unchanged with ``action="report"``).
+    stats : dict
+        Output of ``outlier_stats`` plus ``kept`` (indices of the kept volumes).
+    """
+    if action not in ("drop", "report"):
+        raise ValueError(f"Unknown outlier action: {action}")
+    stats = outlier_stats(dwi, bvals, mask=mask, **kwargs)
+    outliers = stats["outliers"]
+    keep = np.setdiff1d(np.arange(len(bvals)), outliers) if action == "drop" else np.arange(len(bvals))
+    stats["kept"] = keep
+    if len(outliers):
+        print(f"Outlier volumes: {outliers.tolist()} ({action})")
+    if action == "drop" and len(outliers):
+        dwi, bvals, bvecs = dwi[..., keep], np.asarray(bvals)[keep], np.asarray(bvecs)[keep]
+    return dwi, bvals, bvecs, stats
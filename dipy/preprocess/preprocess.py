@@ -1,16 +1,5 @@
 import os
 import numpy as np
-import nibabel as nib
-from dipy.align.metrics import CCMetric
-from dipy.denoise.localpca import mppca  # or nlmeans
-from dipy.reconst.dti import TensorModel
-from dipy.segment.mask import median_otsu
-from dipy.align.imaffine import AffineMap
-from dipy.denoise.gibbs import gibbs_removal
-from dipy.core.gradients import gradient_table
-from dipy.io.image import load_nifti, save_nifti
-from dipy.align.imaffine import AffineRegistration
-from dipy.align.transforms import TranslationTransform3D, RigidTransform3D, AffineTransform3D
 
 
 def preprocess(
@@ -60,6 +49,13 @@ def preprocess(
     gtab : dipy.core.gradients.GradientTable
         Gradient table constructed from bvals/bvecs.
     """
+    from dipy.io.image import load_nifti, save_nifti
+    from dipy.core.gradients import gradient_table
+    from dipy.denoise.localpca import mppca
+    from dipy.denoise.gibbs import gibbs_removal
+    from dipy.segment.mask import median_otsu
+    from dipy.align.imaffine import AffineRegistration, AffineMap
+    from dipy.align.transforms import RigidTransform3D
 
     os.makedirs(out_dir, exist_ok=True)
 
@@ -72,7 +68,7 @@ def preprocess(
     # 2. Denoise
     if do_denoise:
         print("Denoising data...")
-        dwi = mppca(dwi, patch_shape=(5, 5, 5), returnsigma=False)
+        dwi = mppca(dwi, patch_radius=2, return_sigma=False)
 
     # 3. Gibbs removal
     if do_gibbs:
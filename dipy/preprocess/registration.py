@@ -1,16 +1,7 @@
 import os
 import numpy as np
-import nibabel as nib
-from dipy.align.metrics import CCMetric
-from dipy.denoise.localpca import mppca  # or nlmeans
-from dipy.reconst.dti import TensorModel
-from dipy.segment.mask import median_otsu
-from dipy.align.imaffine import AffineMap
-from dipy.denoise.gibbs import gibbs_removal
-from dipy.core.gradients import gradient_table
-from dipy.io.image import load_nifti, save_nifti
-from dipy.align.imaffine import AffineRegistration
-from dipy.align.transforms import TranslationTransform3D, RigidTransform3D, AffineTransform3D
+
+from .resample import resample_labels
 
 
 def registration(
@@ -18,6 +9,7 @@ def registration(
     fixed_file,   # e.g., preprocessed DWI or FA image
     out_dir="./output",
     out_name="registered.nii.gz",
+    labels=False,
 ):
     """
     Registers ``moving_file`` to the space of ``fixed_file`` using an affine
@@ -33,12 +25,21 @@ def registration(
         Directory to save the transformed file.
     out_name : str
         Filename for the transformed volume.
+    labels : bool
+        ``moving_file`` is a label image (atlas, ROI mask): resample it by
+        nearest neighbour through a cached index map (``resample_labels``)
+        instead of interpolating. The estimated transform is always saved as
+        ``<out_name>_affine.txt`` so further label images can be resampled
+        with ``apply_label_transform`` without registering again.
 
     Returns
     -------
     str
         Path to the transformed NIfTI file.
     """
+    from dipy.io.image import load_nifti, save_nifti
+    from dipy.align.imaffine import AffineRegistration, AffineMap, MutualInformationMetric
+    from dipy.align.transforms import TranslationTransform3D, RigidTransform3D, AffineTransform3D
 
     # 1. Load data
     moving_data, moving_affine = load_nifti(moving_file)
@@ -46,7 +47,7 @@ def registration(
 
     # 2. Setup registration
     affreg = AffineRegistration(
-        metric=CCMetric(3),
+        metric=MutualInformationMetric(nbins=32, sampling_proportion=None),
         level_iters=[100, 50, 25],
         sigmas=[3.0, 1.0, 0.0],
         factors=[4, 2, 1]
@@ -56,33 +57,40 @@ def registration(
     transform = TranslationTransform3D()
     params0 = None
     translation = affreg.optimize(
-        fixed_data, moving_data, transform,
-        None, fixed_affine, moving_affine, starting_affine=params0
+        fixed_data, moving_data, transform, None,
+        static_grid2world=fixed_affine, moving_grid2world=moving_affine, starting_affine=params0
     )
 
     transform = RigidTransform3D()
     rigid = affreg.optimize(
-        fixed_data, translation.transform(moving_data), transform,
-        None, fixed_affine, moving_affine, starting_affine=translation.affine
+        fixed_data, moving_data, transform, None,
+        static_grid2world=fixed_affine, moving_grid2world=moving_affine, starting_affine=translation.affine
     )
 
     transform = AffineTransform3D()
     affine_opt = affreg.optimize(
-        fixed_data, rigid.transform(moving_data), transform,
-        None, fixed_affine, moving_affine, starting_affine=rigid.affine
+        fixed_data, moving_data, transform, None,
+        static_grid2world=fixed_affine, moving_grid2world=moving_affine, starting_affine=rigid.affine
     )
 
     # 3. Apply the final transformation
-    mapping = AffineMap(
-        affine_opt.affine,
-        moving_data.shape, moving_affine,
-        fixed_data.shape, fixed_affine
-    )
-    transformed_data = mapping.transform(moving_data)
+    if labels:
+        transformed_data = resample_labels(
+            np.rint(moving_data).astype(np.int32), moving_affine,
+            fixed_data.shape[:3], fixed_affine, affine_opt.affine
+        )
+    else:
+        mapping = AffineMap(
+            affine_opt.affine,
+            moving_data.shape, moving_affine,
+            fixed_data.shape, fixed_affine
+        )
+        transformed_data = mapping.transform(moving_data)
 
     # 4. Save output
     os.makedirs(out_dir, exist_ok=True)
     out_path = os.path.join(out_dir, out_name)
+    np.savetxt(os.path.join(out_dir, out_name.split(".nii")[0] + "_affine.txt"), affine_opt.affine)
     save_nifti(out_path, transformed_data, fixed_affine)
     print(f"Saved coregistered file to: {out_path}")
     return out_path
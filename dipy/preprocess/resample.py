@@ -0,0 +1,143 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+# (transform, source grid, target grid) -> flat source index of every target voxel
+_INDEX_MAPS = OrderedDict()
+MAX_CACHED_MAPS = 8
+
+
+def _grid_key(affine, shape):
+    return tuple(int(s) for s in shape[:3]), np.round(np.asarray(affine, dtype=np.float64), 6).tobytes()
+
+
+def nearest_index_map(source_shape, source_affine, target_shape, target_affine, transform=None):
+    """
+    Nearest source voxel of every target voxel, as flat C-order indices.
+
+    Parameters
+    ----------
+    source_shape, source_affine :
+        Grid of the image being resampled (e.g. the atlas).
+    target_shape, target_affine :
+        Output grid (e.g. the DWI).
+    transform : np.ndarray or None
+        4x4 world-to-world matrix from target to source space, i.e. the
+        ``affine`` of a DIPY ``AffineMap`` whose domain is the target grid
+        (identity if None).
+
+    Returns
+    -------
+    np.ndarray
+        int64 array of ``target_shape``; -1 where the target voxel falls
+        outside the source grid. Matches ``AffineMap.transform(...,
+        interpolation="nearest")`` up to rounding ties.
+    """
+    source_shape = tuple(int(s) for s in source_shape[:3])
+    target_shape = tuple(int(s) for s in target_shape[:3])
+    transform = np.eye(4) if transform is None else np.asarray(transform, dtype=np.float64)
+    # target voxel -> target world -> source world -> source voxel, as one matrix
+    vox_to_vox = np.linalg.inv(np.asarray(source_affine, dtype=np.float64)) @ transform \
+        @ np.asarray(target_affine, dtype=np.float64)
+
+    index = np.empty(target_shape, dtype=np.int64)
+    outside = np.zeros(target_shape, dtype=bool)
+    jj, kk = np.meshgrid(np.arange(target_shape[1]), np.arange(target_shape[2]), indexing="ij")
+    plane = np.stack([np.zeros_like(jj), jj, kk], axis=-1).reshape(-1, 3).astype(np.float64)
+    for i in range(target_shape[0]):               # one slab at a time keeps the temporaries small
+        plane[:, 0] = i
+        x = plane @ vox_to_vox[:3, :3].T + vox_to_vox[:3, 3]
+        # same support as AffineMap.transform: points beyond the outer voxel centres are outside
+        out = np.any((x < 0) | (x > np.asarray(source_shape) - 1), axis=1)
+        src = np.floor(x + 0.5).astype(np.int64)
+        src[out] = 0
+        index[i] = np.ravel_multi_index(tuple(src.T), source_shape).reshape(target_shape[1:])
+        outside[i] = out.reshape(target_shape[1:])
+    index[outside] = -1
+    return index
+
+
+def cached_index_map(source_shape, source_affine, target_shape, target_affine, transform=None):
+    """``nearest_index_map`` memoized on (transform, source grid, target grid)."""
+    key = (_grid_key(source_affine, source_shape), _grid_key(target_affine, target_shape),
+           None if transform is None else np.round(np.asarray(transform, dtype=np.float64), 6).tobytes())
+    if key in _INDEX_MAPS:
+        _INDEX_MAPS.move_to_end(key)
+        return _INDEX_MAPS[key]
+    index = nearest_index_map(source_shape, source_affine, target_shape, target_affine, transform)
+    index.setflags(write=False)
+    _INDEX_MAPS[key] = index
+    if len(_INDEX_MAPS) > MAX_CACHED_MAPS:
+        _INDEX_MAPS.popitem(last=False)
+    return index
+
+
+def clear_index_cache():
+    """Drop all cached index maps."""
+    _INDEX_MAPS.clear()
+
+
+def resample_labels(data, source_affine, target_shape, target_affine, transform=None, fill=0):
+    """
+    Nearest-neighbour resampling of a label (or mask) image as an integer gather.
+
+    The index map for this (transform, grids) combination is computed once
+    and reused for every further image on the same source grid.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        3D label volume, or 4D with one volume per last-axis entry.
+    source_affine : np.ndarray
+        Voxel-to-world affine of ``data``.
+    target_shape, target_affine :
+        Output grid.
+    transform : np.ndarray or None
+        Target-to-source world transform (see ``nearest_index_map``).
+    fill : int
+        Value outside the source grid.
+
+    Returns
+    -------
+    np.ndarray
+        Resampled volume with the dtype of ``data``.
+    """
+    data = np.asarray(data)
+    index = cached_index_map(data.shape[:3], source_affine, target_shape, target_affine, transform)
+    flat = data.reshape((-1,) + data.shape[3:])
+    out = flat[np.maximum(index, 0)]
+    out[index < 0] = fill
+    return out
+
+
+def apply_label_transform(label_files, fixed_file, transform=None, out_dir="./output", suffix="_in_dwi"):
+    """
+    Resample several label images onto the grid of ``fixed_file``.
+
+    Images sharing a grid (e.g. an atlas and ROI masks cut from it) reuse
+    one index map.
+
+    Returns
+    -------
+    list of str
+        Paths of the resampled images.
+    """
+    from dipy.io.image import load_nifti, save_nifti
+
+    fixed_data, fixed_affine = load_nifti(fixed_file)
+    if isinstance(transform, str):
+        transform = np.loadtxt(transform)
+    os.makedirs(out_dir, exist_ok=True)
+    out_paths = []
+    for label_file in label_files:
+        data, affine = load_nifti(label_file)
+        if data.dtype.kind == "f":
+            data = np.rint(data).astype(np.int32)
+        name = os.path.basename(label_file).split(".nii")[0]
+        out_path = os.path.join(out_dir, f"{name}{suffix}.nii.gz")
+        save_nifti(out_path, resample_labels(data, affine, fixed_data.shape[:3], fixed_affine, transform),
+                   fixed_affine)
+        out_paths.append(out_path)
+    return out_paths
@@ -1,19 +1,29 @@
 import os
 import numpy as np
-import nibabel as nib
-from dipy.align.metrics import CCMetric
-from dipy.denoise.localpca import mppca  # or nlmeans
-from dipy.reconst.dti import TensorModel
-from dipy.segment.mask import median_otsu
-from dipy.align.imaffine import AffineMap
-from dipy.denoise.gibbs import gibbs_removal
-from dipy.core.gradients import gradient_table
-from dipy.io.image import load_nifti, save_nifti
-from dipy.align.imaffine import AffineRegistration
-from dipy.align.transforms import TranslationTransform3D, RigidTransform3D, AffineTransform3D
-
-
-def tensor_fit(preproc_dwi, preproc_affine, mask, gtab, out_dir="./output"):
+
+
+def volume_weighted_wls(volume_weights):
+    """
+    WLS tensor fit method that also down-weights whole volumes.
+
+    The voxel weights are DIPY's default WLS weights (squared signal
+    predicted by an OLS fit) times ``volume_weights``, so a volume with
+    weight 0 drops out of the fit and partially corrupted volumes count less.
+    The returned function can be passed as ``TensorModel(fit_method=...)``.
+    """
+    from dipy.reconst.dti import ols_fit_tensor, wls_fit_tensor
+
+    volume_weights = np.asarray(volume_weights, dtype=np.float64)
+
+    def fit(design_matrix, data, *args, **kwargs):
+        ols, _ = ols_fit_tensor(design_matrix, data, return_lower_triangular=True)
+        weights = np.exp(2 * (ols @ design_matrix.T)) * volume_weights
+        return wls_fit_tensor(design_matrix, data, *args, weights=weights, **kwargs)
+
+    return fit
+
+
+def tensor_fit(preproc_dwi, preproc_affine, mask, gtab, out_dir="./output", volume_weights=None):
     """
     Fit a DTI model to the preprocessed data and save FA (and other metrics).
 
@@ -29,6 +39,9 @@ def tensor_fit(preproc_dwi, preproc_affine, mask, gtab, out_dir="./output"):
         DIPY gradient table.
     out_dir : str
         Output directory to save the tensor metrics.
+    volume_weights : np.ndarray or None
+        Per-volume weights in [0, 1] (e.g. ``screen_outliers(...)[3]["weights"]``);
+        if given, the WLS fit down-weights each volume accordingly.
 
     Returns
     -------
@@ -37,13 +50,21 @@ def tensor_fit(preproc_dwi, preproc_affine, mask, gtab, out_dir="./output"):
     md : np.ndarray
         Mean diffusivity volume.
     """
+    from dipy.io.image import save_nifti
+    from dipy.reconst.dti import TensorModel
+
     os.makedirs(out_dir, exist_ok=True)
     if mask is None:
         # If no explicit mask is given, just create a dummy full-volume mask
         mask = np.ones(preproc_dwi.shape[:3], dtype=bool)
 
     print("Fitting DTI model...")
-    tensor_model = TensorModel(gtab)
+    if volume_weights is None:
+        tensor_model = TensorModel(gtab)
+    else:
+        if len(volume_weights) != len(gtab.bvals):
+            raise ValueError(f"{len(volume_weights)} volume weights for {len(gtab.bvals)} volumes")
+        tensor_model = TensorModel(gtab, fit_method=volume_weighted_wls(volume_weights))
     tensor_fit = tensor_model.fit(preproc_dwi, mask=mask)
 
     fa = tensor_fit.fa
@@ -0,0 +1,46 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from tractography.flat_tractogram import (FlatTractogram, endpoint_indices, endpoint_voxels,  # noqa: E402
+                                          flatten_streamlines, streamline_lengths)
+
+# streamlines of 3, 0, 4, 3 and 0 points between a leading and a trailing empty one
+POINTS = np.cumsum(np.ones((10, 3)), axis=0)
+OFFSETS = np.array([0, 0, 3, 3, 7, 10, 10])
+STEP = np.sqrt(3.0)
+
+
+def test_trailing_empty_streamline():
+    assert streamline_lengths(np.zeros((3, 3)), np.array([0, 3, 3])).tolist() == [0.0, 0.0]
+    assert endpoint_indices(np.array([0, 3, 3])).tolist() == [[0, 2], [-1, -1]]
+
+
+def test_empty_streamlines_have_length_zero_and_no_endpoints():
+    assert streamline_lengths(POINTS, OFFSETS) == pytest.approx([0, 2 * STEP, 0, 3 * STEP, 2 * STEP, 0])
+    assert endpoint_indices(OFFSETS).tolist() == [[-1, -1], [0, 2], [-1, -1], [3, 6], [7, 9], [-1, -1]]
+    voxels = endpoint_voxels(POINTS, OFFSETS, np.eye(4))
+    assert voxels[[0, 2, 5]].tolist() == [[[-1] * 3] * 2] * 3
+    assert voxels[3].tolist() == [[4] * 3, [7] * 3]
+
+
+def test_lengths_skip_the_gap_between_streamlines():
+    offsets = np.array([0, 3, 7, 10])
+    expected = [np.sum(np.linalg.norm(np.diff(POINTS[a:b], axis=0), axis=1)) for a, b in zip(offsets, offsets[1:])]
+    assert streamline_lengths(POINTS, offsets) == pytest.approx(expected)
+
+
+def test_to_streamlines_wraps_the_buffer_and_keeps_empty_streamlines():
+    flat = FlatTractogram(POINTS.astype(np.float32), OFFSETS, np.eye(4), (12, 12, 12))
+    streamlines = flat.to_streamlines()
+    assert [len(s) for s in streamlines] == np.diff(OFFSETS).tolist()
+    assert np.shares_memory(streamlines[1], flat.points)                # no copy
+    for i, s in enumerate(streamlines):
+        np.testing.assert_array_equal(s, flat[i])
+    points, offsets = flatten_streamlines(streamlines)
+    assert points is streamlines._data
+    np.testing.assert_array_equal(offsets, OFFSETS)
@@ -0,0 +1,33 @@
+import csv
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from tractography.merge_omatrix import main  # noqa: E402
+
+
+def read_csv(path):
+    with open(path) as f:
+        return np.array([[float(v) for v in row] for row in csv.reader(f)])
+
+
+def test_default_sums_the_per_seed_fdt_matrix1(tmp_path):
+    mats = [np.array([[1., 2, 3], [2, 3, 1]]), np.array([[1., 2, 5], [2, 3, 2]])]
+    for n, mat in enumerate(mats, start=1):
+        (tmp_path / f"seed_{n}").mkdir()
+        np.savetxt(tmp_path / f"seed_{n}" / "fdt_matrix1.dot", mat, fmt="%g")
+    main([str(tmp_path), str(tmp_path / "out.csv")])
+    np.testing.assert_array_equal(read_csv(tmp_path / "out.csv"), mats[0] + mats[1])
+
+
+def test_os2t_builds_one_row_per_seed(tmp_path):
+    for n, rows in ((1, "1 0 2\n0 1 0\n"), (2, "0 3 0\n")):
+        (tmp_path / f"seed_{n}").mkdir()
+        (tmp_path / f"seed_{n}" / "matrix_seeds_to_all_targets").write_text(rows)
+        (tmp_path / f"seed_{n}" / "waytotal").write_text("10\n")
+    main([str(tmp_path), str(tmp_path / "out.csv"), "--os2t", "--normalized", str(tmp_path / "norm.csv")])
+    np.testing.assert_array_equal(read_csv(tmp_path / "out.csv"), [[1, 1, 2], [0, 3, 0]])
+    np.testing.assert_allclose(read_csv(tmp_path / "norm.csv"), [[0.1, 0.1, 0.2], [0, 0.3, 0]])
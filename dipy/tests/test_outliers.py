@@ -0,0 +1,73 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from preprocess.outliers import screen_outliers  # noqa: E402
+from preprocess.tensor_fit import volume_weighted_wls  # noqa: E402
+
+N_B0, N_DW = 2, 30
+
+
+def gradients():
+    rng = np.random.default_rng(0)
+    bvecs = rng.normal(size=(N_B0 + N_DW, 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, None]
+    bvecs[:N_B0] = 0
+    return np.r_[[0] * N_B0, [1000] * N_DW].astype(float), bvecs
+
+
+def synthetic_dwi(bvals, bvecs, shape=(6, 6, 10), evals=(1.7e-3, 0.3e-3, 0.3e-3), noise=5.0):
+    """One tensor everywhere, a few percent of signal drift between volumes and Gaussian noise."""
+    rng = np.random.default_rng(1)
+    D = np.diag(evals)
+    signal = 1000 * np.exp(-bvals * np.einsum("vi,ij,vj->v", bvecs, D, bvecs))
+    signal *= 1 + 0.03 * rng.standard_normal(len(bvals))
+    return signal + rng.normal(0, noise, shape + (len(bvals),))
+
+
+def test_dropout_and_scaled_volumes_are_dropped_with_their_gradients():
+    bvals, bvecs = gradients()
+    # isotropic, so every diffusion-weighted volume has the same mean signal
+    dwi = synthetic_dwi(bvals, bvecs, evals=(0.8e-3,) * 3)
+    dwi[:, :, 4, 6] *= 0.3              # one dropout slice: down-weighted, kept
+    dwi[:, :, 2:5, 11] *= 0.3           # three dropout slices: outlier
+    dwi[..., 20] *= 1.8                 # scaled volume: outlier
+    mask = np.ones(dwi.shape[:3], bool)
+
+    out, out_bvals, out_bvecs, stats = screen_outliers(dwi, bvals, bvecs, mask=mask)
+    assert stats["outliers"].tolist() == [11, 20]
+    assert stats["bad_slices"][4, 6] and stats["bad_slices"].sum() == 4
+    keep = stats["kept"]
+    assert keep.tolist() == [v for v in range(len(bvals)) if v not in (11, 20)]
+    assert out.shape[-1] == len(out_bvals) == len(out_bvecs) == len(keep)
+    np.testing.assert_array_equal(out, dwi[..., keep])
+    np.testing.assert_array_equal(out_bvals, bvals[keep])
+    np.testing.assert_array_equal(out_bvecs, bvecs[keep])
+    assert stats["weights"][6] == 0.9 and stats["weights"][[11, 20]].tolist() == [0, 0]
+
+    same, same_bvals, same_bvecs, reported = screen_outliers(dwi, bvals, bvecs, mask=mask, action="report")
+    assert same is dwi and reported["kept"].tolist() == list(range(len(bvals)))
+    assert reported["outliers"].tolist() == [11, 20]
+
+
+def test_volume_weights_remove_a_corrupted_volume_from_the_tensor_fit():
+    from dipy.core.gradients import gradient_table
+    from dipy.reconst.dti import TensorModel
+
+    bvals, bvecs = gradients()
+    gtab = gradient_table(bvals, bvecs=bvecs)
+    clean = synthetic_dwi(bvals, bvecs, shape=(3, 3, 2))
+    corrupted = clean.copy()
+    corrupted[..., 20] *= 0.2
+    weights = np.ones(len(bvals))
+
+    reference = TensorModel(gtab).fit(clean).fa
+    np.testing.assert_allclose(TensorModel(gtab, fit_method=volume_weighted_wls(weights)).fit(clean).fa,
+                               reference, atol=1e-10)
+    weights[20] = 0
+    weighted = TensorModel(gtab, fit_method=volume_weighted_wls(weights)).fit(corrupted).fa
+    unweighted = TensorModel(gtab).fit(corrupted).fa
+    assert np.abs(weighted - reference).max() < 0.5 * np.abs(unweighted - reference).max()
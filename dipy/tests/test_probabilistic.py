@@ -0,0 +1,58 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from tractography.probabilistic import probabilistic_tracking, tensor_fields, track_batch  # noqa: E402
+
+SHAPE = (20, 6, 6)
+
+
+def x_fields(spread=0.0):
+    """Principal direction along x everywhere; tracking allowed in x = 2..17."""
+    evecs = np.broadcast_to(np.eye(3), SHAPE + (3, 3))
+    allowed = np.zeros(SHAPE, bool)
+    allowed[2:18, 1:5, 1:5] = True
+    return tensor_fields(evecs, np.full(SHAPE + (2,), spread), allowed)
+
+
+def test_track_batch_orders_points_from_the_backward_end_to_the_forward_end():
+    seeds = np.array([[5.0, 2, 2], [10.0, 3, 3], [16.0, 2, 3]])
+    points, lengths = track_batch(seeds, np.random.SeedSequence(0), step=1.0, fields=x_fields())
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    for seed, a, b in zip(seeds, offsets[:-1], offsets[1:]):
+        line = points[a:b]
+        # straight along x (in either sense), one step apart, through the seed
+        steps = np.diff(line, axis=0)
+        assert np.allclose(np.abs(steps), [1, 0, 0])
+        assert np.all(steps[:, 0] == steps[0, 0])
+        assert any(np.array_equal(p, seed) for p in line)
+        assert sorted(line[[0, -1], 0]) == [2.0, 17.0]
+    assert lengths.tolist() == [16, 16, 16]
+
+
+def test_output_does_not_depend_on_the_number_of_workers():
+    rng = np.random.default_rng(0)
+    seeds = rng.uniform([2, 1, 1], [17, 4, 4], size=(50, 3))
+    fields = x_fields(spread=0.3)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    single = probabilistic_tracking(fields, seeds, affine, random_seed=3, batch_size=8, n_workers=1)
+    pooled = probabilistic_tracking(fields, seeds, affine, random_seed=3, batch_size=8, n_workers=3)
+    assert len(single) == len(pooled) > 0
+    assert [len(s) for s in single] == [len(s) for s in pooled]
+    np.testing.assert_array_equal(single.get_data(), pooled.get_data())
+    assert all(len(s) >= 2 for s in single)
+
+
+def test_unknown_tracker_is_refused(tmp_path):
+    import importlib.util
+
+    # by path: nipype/tract.py is importable as "tract" too
+    spec = importlib.util.spec_from_file_location("dipy_tract", Path(__file__).resolve().parents[1] / "tract.py")
+    tract = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tract)
+    with pytest.raises(ValueError, match="Unknown tracker"):
+        tract.run(str(tmp_path), "atlas.nii.gz", tracker="probablistic")
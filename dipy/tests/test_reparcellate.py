@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from tractography.reparcellate import reparcellate, save_endpoints  # noqa: E402
+from tractography.weighted_connectivity import weighted_connectivity  # noqa: E402
+
+SHAPE = (6, 6, 6)
+
+
+@pytest.fixture
+def atlas_file(tmp_path):
+    import nibabel as nib
+
+    atlas = np.zeros(SHAPE, dtype=np.int16)
+    atlas[:3] = 1
+    atlas[3:] = 2
+    path = tmp_path / "atlas.nii.gz"
+    nib.save(nib.Nifti1Image(atlas, np.eye(4)), str(path))
+    return path, atlas
+
+
+def test_reparcellate_matches_weighted_connectivity_and_skips_empty_streamlines(tmp_path, atlas_file):
+    path, atlas = atlas_file
+    streamlines = [np.array([[0., 1, 1], [5, 1, 1]]), np.zeros((0, 3)), np.array([[1., 1, 1], [2, 2, 2]])]
+    table = save_endpoints(str(tmp_path), streamlines, np.eye(4), SHAPE)
+    matrices, _ = reparcellate(table, str(path), str(tmp_path / "out"))
+    expected = weighted_connectivity(streamlines, np.eye(4), atlas)
+    np.testing.assert_array_equal(matrices["count"], expected["count"])
+    np.testing.assert_allclose(matrices["length"], expected["length"], rtol=1e-6)
+    assert matrices["count"][0].sum() == 0                             # nothing counted as background
+
+
+def test_endpoints_outside_the_atlas_are_refused(tmp_path, atlas_file):
+    path, atlas = atlas_file
+    streamlines = [np.array([[0., 1, 1], [5, 1, 1]]), np.array([[1., 1, 1], [8, 1, 1]])]
+    table = save_endpoints(str(tmp_path), streamlines, np.eye(4), SHAPE)
+    with pytest.raises(ValueError, match="1 streamlines end outside"):
+        reparcellate(table, str(path), str(tmp_path / "out"))
+    with pytest.raises(ValueError, match="1 streamlines end outside"):
+        weighted_connectivity(streamlines, np.eye(4), atlas)
@@ -0,0 +1,44 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from tractography import weighted_connectivity as wc  # noqa: E402
+
+AFFINE = np.diag([2.0, 2.0, 2.0, 1.0])
+
+
+def random_streamlines(n, shape, seed=0):
+    rng = np.random.default_rng(seed)
+    extent = (np.asarray(shape) - 1) * 2.0
+    return [rng.uniform(0, extent, size=(rng.integers(0, 12), 3)) for _ in range(n)]
+
+
+def test_scalar_means_match_a_per_streamline_loop_for_any_chunk_size():
+    shape = (6, 7, 5)
+    fa = np.random.default_rng(1).random(shape)
+    streamlines = random_streamlines(50, shape)
+    expected = []
+    for s in streamlines:
+        v = np.floor(s / 2.0 + 0.5).astype(int)
+        expected.append(fa[v[:, 0], v[:, 1], v[:, 2]].mean() if len(s) else 0.0)
+    points = np.concatenate(streamlines)
+    offsets = np.concatenate([[0], np.cumsum([len(s) for s in streamlines])])
+    for chunk_size in (None, 1, 7):
+        means = wc.sample_along_streamlines(points, offsets, AFFINE, {"fa": fa}, chunk_size)
+        np.testing.assert_allclose(means["fa"], expected)
+
+
+def test_without_scalars_only_the_endpoints_are_transformed(monkeypatch):
+    shape = (6, 7, 5)
+    atlas = np.arange(np.prod(shape)).reshape(shape) % 4
+    streamlines = [s for s in random_streamlines(30, shape) if len(s)]
+    transformed = []
+    real = wc.world_to_voxel
+    monkeypatch.setattr(wc, "world_to_voxel", lambda p, a: transformed.append(len(p)) or real(p, a))
+    wc.weighted_connectivity(streamlines, AFFINE, atlas)
+    assert transformed == []
+    wc.weighted_connectivity(streamlines, AFFINE, atlas, scalars={"fa": atlas * 0.5}, chunk_size=8)
+    assert transformed == [sum(len(s) for s in streamlines[i:i + 8]) for i in range(0, len(streamlines), 8)]
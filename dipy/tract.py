@@ -1,13 +1,35 @@
 import os
+import json
 import numpy as np
-from dipy.io.image import load_nifti, save_nifti
-from dipy.core.gradients import gradient_table
-from preprocess import denoise, remove_gibbs, motion_correction, brain_mask, registration, tensor_fit
-from tractography import deterministic_tractography, connectivity_from_streamlines
+from preprocess import (denoise, remove_gibbs, motion_correction, brain_mask, registration, tensor_fit,
+                        screen_outliers)
+from tractography import (deterministic_tractography, probabilistic_tractography, connectivity_from_streamlines,
+                          save_density_maps)
 
 
-def run(subject_dir, atlas_path):
-    """Run a simple DWI processing pipeline using DIPY."""
+def run(subject_dir, atlas_path, tracker="deterministic", outlier_action="drop", **tracking_kwargs):
+    """
+    Run a simple DWI processing pipeline using DIPY.
+
+    Corrupted volumes are screened right after loading (``screen_outliers``);
+    with ``outlier_action="drop"`` they are removed together with their
+    bval/bvec entries before any expensive stage, ``"report"`` keeps them and
+    ``None`` skips the screening. In both screening modes the tensor fit is
+    weighted by the fraction of good slices of every kept volume (0 for
+    reported outlier volumes) and ``outliers.json`` records the screening.
+
+    ``tracker`` is ``"deterministic"`` or ``"probabilistic"``; extra keyword
+    arguments go to the tracking function, e.g. ``seeding="adaptive",
+    seed_budget=200000, convergence_tol=0.01`` (deterministic) or
+    ``seeds_per_voxel=5, n_workers=8, random_seed=0`` (probabilistic).
+    """
+    from dipy.io.image import load_nifti, save_nifti
+    from dipy.core.gradients import gradient_table
+
+    trackers = {"deterministic": deterministic_tractography, "probabilistic": probabilistic_tractography}
+    if tracker not in trackers:
+        raise ValueError(f"Unknown tracker: {tracker}")
+
     out_dir = os.path.join(subject_dir, "analyzed_dipy")
     os.makedirs(out_dir, exist_ok=True)
 
@@ -18,6 +40,23 @@ def run(subject_dir, atlas_path):
     dwi, affine = load_nifti(dwi_file)
     bvals = np.loadtxt(bval_file)
     bvecs = np.loadtxt(bvec_file).T
+
+    volume_weights = None
+    if outlier_action:
+        print("Screening outlier volumes ...")
+        dwi, bvals, bvecs, stats = screen_outliers(dwi, bvals, bvecs, action=outlier_action)
+        with open(os.path.join(out_dir, "outliers.json"), "w") as f:
+            json.dump({"outliers": stats["outliers"].tolist(), "kept": stats["kept"].tolist(),
+                       "volume_z": stats["volume_z"].round(2).tolist(),
+                       "bad_slices": np.argwhere(stats["bad_slices"]).tolist(),
+                       "weights": stats["weights"].round(3).tolist()}, f, indent=1)
+        volume_weights = stats["weights"][stats["kept"]]
+        if outlier_action == "drop" and len(stats["outliers"]):
+            # later stages read the gradients from disk
+            bval_file = os.path.join(out_dir, "dwi_screened.bval")
+            bvec_file = os.path.join(out_dir, "dwi_screened.bvec")
+            np.savetxt(bval_file, bvals[None], fmt="%g")
+            np.savetxt(bvec_file, bvecs.T, fmt="%.6f")
     gtab = gradient_table(bvals, bvecs)
 
     print("Denoising ...")
@@ -35,7 +74,7 @@ def run(subject_dir, atlas_path):
     save_nifti(mask_path, mask.astype(np.uint8), affine)
 
     print("Tensor fitting ...")
-    tensor_fit(dwi, affine, mask, gtab, out_dir=out_dir)
+    fa, md = tensor_fit(dwi, affine, mask, gtab, out_dir=out_dir, volume_weights=volume_weights)[:2]
 
     print("Registering atlas ...")
     atlas_in_dwi = registration(
@@ -43,12 +82,16 @@ def run(subject_dir, atlas_path):
         preproc_path,
         out_dir=out_dir,
         out_name="atlas_in_dwi.nii.gz",
+        labels=True,
     )
 
-    print("Deterministic tractography ...")
-    streamlines, trk_affine, _ = deterministic_tractography(preproc_path, mask_path, bval_file, bvec_file, out_dir)
+    print(f"{tracker.capitalize()} tractography ...")
+    streamlines, trk_affine, _ = trackers[tracker](preproc_path, mask_path, bval_file, bvec_file, out_dir,
+                                       atlas_file=atlas_in_dwi, **tracking_kwargs)
     print("Computing connectivity matrix ...")
-    connectivity_from_streamlines(streamlines, atlas_in_dwi, trk_affine, out_dir)
+    connectivity_from_streamlines(streamlines, atlas_in_dwi, trk_affine, out_dir, scalars={"fa": fa, "md": md})
+    print("Tract density maps ...")
+    save_density_maps(out_dir, streamlines, trk_affine, mask.shape, atlas=load_nifti(atlas_in_dwi)[0], per_roi="sparse")
 
 
 if __name__ == "__main__":
@@ -1,3 +1,57 @@
-from .connectivity import *
-from .tractography import *
-from .dot_to_matrix import *
\ No newline at end of file
+"""
+Tractography and connectome stages.
+
+Names are imported lazily on first access, so ``from tractography import
+dot_to_matrix`` loads neither dipy's tracking stack nor scipy.
+"""
+import sys
+import types
+import importlib
+
+_LAZY = {
+    "tensor_direction_getter": ".connectivity",
+    "connectivity": ".connectivity",
+    "connectivity_from_streamlines": ".connectivity",
+    "save_tractogram": ".tractography",
+    "deterministic_tractography": ".tractography",
+    "tractography_connectivity": ".tractography",
+    "eigenvector_uncertainty": ".probabilistic",
+    "tensor_fields": ".probabilistic",
+    "sample_directions": ".probabilistic",
+    "track_batch": ".probabilistic",
+    "probabilistic_tracking": ".probabilistic",
+    "probabilistic_tractography": ".probabilistic",
+    "probabilistic_connectivity": ".probabilistic",
+    "iter_chunks": ".density",
+    "density_map": ".density",
+    "grouped_density": ".density",
+    "endpoint_groups": ".density",
+    "save_density_maps": ".density",
+    "dot_to_matrix": ".dot_to_matrix",
+}
+
+__all__ = sorted(_LAZY)
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        if not name.startswith("_"):     # plain submodule access, e.g. ``pkg.resample``
+            try:
+                return importlib.import_module(f".{name}", __name__)
+            except ModuleNotFoundError as err:
+                if err.name != f"{__name__}.{name}":
+                    raise
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    importlib.import_module(_LAZY[name], __name__)
+    # ``connectivity``, ``tractography`` and ``dot_to_matrix`` are also submodule
+    # names; the function wins, as with the former star imports
+    for lazy_name, module in _LAZY.items():
+        loaded = sys.modules.get(__name__ + module)
+        if loaded is not None and (lazy_name not in globals()
+                                   or isinstance(globals()[lazy_name], types.ModuleType)):
+            globals()[lazy_name] = getattr(loaded, lazy_name)
+    return globals()[name]
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
@@ -1,52 +1,67 @@
 import os
 import numpy as np
-from dipy.io.image import load_nifti
-from dipy.core.gradients import gradient_table
-from dipy.reconst.dti import TensorModel
-from dipy.tracking.local_tracking import LocalTracking
-from dipy.tracking.streamline import Streamlines
-from dipy.tracking.stopping_criterion import BinaryStoppingCriterion
-from dipy.tracking.utils import connectivity_matrix, seeds_from_mask
 
+if __package__ is None or __package__ == "":
+    from weighted_connectivity import weighted_connectivity, load_scalars, save_weighted_connectivity
+    from seeding import adaptive_seeds, adaptive_tracking, finalize_report
+else:
+    from .weighted_connectivity import weighted_connectivity, load_scalars, save_weighted_connectivity
+    from .seeding import adaptive_seeds, adaptive_tracking, finalize_report
 
-class CustomTensorDirectionGetter:
+
+def tensor_direction_getter(evecs, mask, max_angle=60.0, sphere_name="repulsion724"):
     """
-    Custom Direction Getter using the principal eigenvectors from the tensor model.
+    Deterministic direction getter following the tensor principal eigenvector.
+
+    The principal eigenvectors are quantized to the vertices of a DIPY sphere
+    and wrapped in a ``PeaksAndMetrics`` (EuDX) direction getter, the tensor
+    equivalent of DIPY's EuDX tracking, so ``LocalTracking`` can use it.
+    Tracking stops outside ``mask`` and on turns sharper than ``max_angle``.
+
+    Parameters
+    ----------
+    evecs : np.ndarray
+        (..., 3, 3) tensor eigenvectors in columns (``TensorFit.evecs``).
+    mask : np.ndarray
+        Voxels where a direction is defined.
+    max_angle : float
+        Largest angle (degrees) between consecutive steps.
+    sphere_name : str
+        Sphere the directions are quantized to (``dipy.data.get_sphere``).
+
+    Returns
+    -------
+    PeaksAndMetrics
     """
-    def __init__(self, principal_directions, mask):
-        # Ensure writable and contiguous arrays
-        self.principal_directions = np.ascontiguousarray(principal_directions)
-        self.mask = np.ascontiguousarray(mask)
-
-    def initial_direction(self, point):
-        """
-        Returns the initial direction at the given seed point.
-        """
-        return self._get_direction(point)
-
-    def get_direction(self, point, _):
-        """
-        Returns the direction at the given point (ignoring streamline context).
-        """
-        return self._get_direction(point)
-
-    def _get_direction(self, point):
-        """
-        Retrieve the direction from the principal eigenvectors.
-        """
-        i, j, k = np.round(point).astype(int)
-        if (0 <= i < self.principal_directions.shape[0] and
-            0 <= j < self.principal_directions.shape[1] and
-            0 <= k < self.principal_directions.shape[2]):
-            if self.mask[i, j, k]:
-                return self.principal_directions[i, j, k]
-        return None
-
-
-def connectivity(dwi_file, mask_file, atlas_file, bval_file, bvec_file, output_dir):
+    from dipy.data import get_sphere
+    from dipy.direction.peaks import PeaksAndMetrics
+    from dipy.reconst.dti import quantize_evecs
+
+    sphere = get_sphere(name=sphere_name)
+    pam = PeaksAndMetrics()
+    pam.sphere = sphere
+    pam.peak_indices = np.ascontiguousarray(
+        quantize_evecs(np.nan_to_num(evecs), odf_vertices=sphere.vertices)[..., None], dtype=np.int32)
+    pam.peak_values = np.ascontiguousarray(np.asarray(mask, dtype=bool)[..., None], dtype=np.float64)
+    pam.peak_dirs = sphere.vertices[pam.peak_indices]
+    pam.qa = pam.peak_values
+    pam.ang_thr = float(max_angle)
+    pam.qa_thr = 0.5
+    pam.total_weight = 0.5
+    return pam
+
+
+def connectivity(dwi_file, mask_file, atlas_file, bval_file, bvec_file, output_dir, seeding="mask",
+                 seed_budget=None, batch_size=5000, convergence_tol=None, random_seed=None):
     """
     Calculate the adjacency matrix from DWI data using a reference atlas.
 
+    ``seeding`` and the following arguments select the seeding strategy as in
+    ``tractography.deterministic_tractography``: ``"mask"`` seeds every mask
+    voxel, ``"adaptive"`` seeds voxels with FA > 0.2 in shuffled batches and
+    can stop once the connectome converges (report in
+    ``seeding_report.json``).
+
     Parameters
     ----------
     dwi_file : str
@@ -61,6 +76,17 @@ def connectivity(dwi_file, mask_file, atlas_file, bval_file, bvec_file, output_d
         Path to the b-vectors file.
     output_dir : str
         Directory where the adjacency matrix will be saved.
+    seeding : {"mask", "adaptive"}
+        Seeding strategy.
+    seed_budget : int or None
+        Adaptive seeding: maximum number of seeds (all candidates if None).
+    batch_size : int
+        Adaptive seeding: seeds per batch.
+    convergence_tol : float or None
+        Adaptive seeding: stop once the normalized connectome changes less
+        than this between batches.
+    random_seed : int or None
+        Adaptive seeding: seed of the batch shuffling.
 
     Returns
     -------
@@ -69,6 +95,17 @@ def connectivity(dwi_file, mask_file, atlas_file, bval_file, bvec_file, output_d
     labels : np.ndarray
         List of region labels from the atlas.
     """
+    from dipy.io.image import load_nifti
+    from dipy.core.gradients import gradient_table
+    from dipy.reconst.dti import TensorModel
+    from dipy.tracking.local_tracking import LocalTracking
+    from dipy.tracking.streamline import Streamlines
+    from dipy.tracking.stopping_criterion import BinaryStoppingCriterion
+    from dipy.tracking.utils import connectivity_matrix, seeds_from_mask
+
+    if seeding not in ("mask", "adaptive"):
+        raise ValueError(f"Unknown seeding strategy: {seeding}")
+
     os.makedirs(output_dir, exist_ok=True)
 
     # Load preprocessed DWI data and mask
@@ -92,24 +129,35 @@ def connectivity(dwi_file, mask_file, atlas_file, bval_file, bvec_file, output_d
     dti_fit = dti_model.fit(dwi, mask=mask)
 
     # Generate stopping criterion based on FA
+    fa_threshold = 0.2
     fa = np.ascontiguousarray(dti_fit.fa)  # Ensure FA is writable
-    stopping_criterion = BinaryStoppingCriterion(fa > 0.2)
-
-    # Create seeds from the mask
-    seeds = seeds_from_mask(mask, density=1, affine=affine)
+    stopping_criterion = BinaryStoppingCriterion(fa > fa_threshold)
 
     # Use principal eigenvectors for deterministic tractography
     print("Generating streamlines...")
-    principal_directions = np.ascontiguousarray(dti_fit.evecs[..., 0])  # Ensure writable array
-    direction_getter = CustomTensorDirectionGetter(principal_directions, mask)
-
-    # Perform deterministic tractography
-    streamlines_generator = LocalTracking(direction_getter, stopping_criterion, seeds, affine, step_size=0.5)
-    streamlines = Streamlines(streamlines_generator)
-
-    # Compute adjacency matrix
-    print("Computing adjacency matrix...")
-    connectivity = connectivity_matrix( streamlines, affine, atlas, return_mapping=False, mapping_as_streamlines=False, symmetric=True)
+    direction_getter = tensor_direction_getter(dti_fit.evecs, mask)
+
+    connectivity = None
+    if seeding == "adaptive":
+        seeds, n_mask_seeds = adaptive_seeds(mask, fa, affine, fa_threshold=fa_threshold)
+        streamlines, connectivity, report = adaptive_tracking(
+            lambda batch: LocalTracking(direction_getter, stopping_criterion, batch, affine, step_size=0.5),
+            seeds, atlas=atlas, affine=affine, seed_budget=seed_budget, batch_size=batch_size,
+            convergence_tol=convergence_tol, random_seed=random_seed,
+        )
+        finalize_report(report, n_mask_seeds, output_dir)
+    else:
+        # Create seeds from the mask
+        seeds = seeds_from_mask(mask, density=1, affine=affine)
+
+        # Perform deterministic tractography
+        streamlines_generator = LocalTracking(direction_getter, stopping_criterion, seeds, affine, step_size=0.5)
+        streamlines = Streamlines(streamlines_generator)
+
+    # Compute adjacency matrix (adaptive seeding accumulated it batch by batch)
+    if not isinstance(connectivity, np.ndarray):
+        print("Computing adjacency matrix...")
+        connectivity = connectivity_matrix( streamlines, affine, atlas, return_mapping=False, mapping_as_streamlines=False, symmetric=True)
     region_labels = np.unique(atlas)
 
     # Save adjacency matrix
@@ -120,13 +168,24 @@ def connectivity(dwi_file, mask_file, atlas_file, bval_file, bvec_file, output_d
     return connectivity, region_labels
 
 
-def connectivity_from_streamlines(streamlines, atlas_file, affine, output_dir):
-    """Compute an adjacency matrix from precomputed streamlines."""
+def connectivity_from_streamlines(streamlines, atlas_file, affine, output_dir, scalars=None):
+    """
+    Compute adjacency matrices from precomputed streamlines.
+
+    The streamline-count matrix is saved as ``connectivity.npy``; mean length,
+    length-normalized counts and the mean of every map in ``scalars`` (name ->
+    3D array or NIfTI path, e.g. the FA/MD maps of ``tensor_fit``) are saved as
+    ``connectivity_<name>.npy``. All matrices come from a single pass over the
+    streamline buffer (``weighted_connectivity``).
+    """
+    from dipy.io.image import load_nifti
+
     os.makedirs(output_dir, exist_ok=True)
     atlas, _ = load_nifti(atlas_file)
-    connectivity = connectivity_matrix( streamlines, affine, atlas, return_mapping=False, mapping_as_streamlines=False, symmetric=True)
+    atlas = np.rint(atlas).astype(np.int64)
+    matrices = weighted_connectivity(streamlines, affine, atlas, scalars=load_scalars(scalars))
     region_labels = np.unique(atlas)
-    connectivity_file = os.path.join(output_dir, "connectivity.npy")
-    np.save(connectivity_file, connectivity)
-    print(f"Adjacency matrix saved to: {connectivity_file}")
-    return connectivity, region_labels
+    files = save_weighted_connectivity(matrices, output_dir)
+    print(f"Adjacency matrix saved to: {files['count']}")
+    print("Weighted matrices: " + ", ".join(name for name in files if name != "count"))
+    return matrices["count"], region_labels
@@ -0,0 +1,153 @@
+import os
+import numpy as np
+
+if __package__ is None or __package__ == "":
+    from flat_tractogram import flatten_streamlines, streamline_ids, endpoint_voxels, label_lookup
+    from spatial_index import linear_voxels, unique_visits
+else:
+    from .flat_tractogram import flatten_streamlines, streamline_ids, endpoint_voxels, label_lookup
+    from .spatial_index import linear_voxels, unique_visits
+
+
+def iter_chunks(points, offsets, chunk_size=None):
+    """
+    Yield ``(first_id, points, offsets)`` blocks of at most ``chunk_size`` streamlines.
+
+    Blocks are views into the flat buffer (offsets rebased to 0), so a
+    memory-mapped tractogram is read one block at a time.
+    """
+    n = len(offsets) - 1
+    step = n if not chunk_size else int(chunk_size)
+    for start in range(0, n, max(step, 1)):
+        stop = min(start + step, n)
+        yield start, points[offsets[start]:offsets[stop]], offsets[start:stop + 1] - offsets[start]
+
+
+def density_map(streamlines, affine, shape, chunk_size=None):
+    """
+    Number of streamlines visiting every voxel (``--opd``-style path map).
+
+    Each streamline counts once per voxel, however many of its points fall
+    there.
+
+    Parameters
+    ----------
+    streamlines : Streamlines, FlatTractogram or sequence of arrays
+        World-space streamlines.
+    affine : np.ndarray
+        Voxel-to-world affine of the grid.
+    shape : tuple
+        Grid shape.
+    chunk_size : int or None
+        Streamlines per block; bounds the temporary memory to one block.
+
+    Returns
+    -------
+    np.ndarray
+        int32 volume of ``shape``.
+    """
+    shape = tuple(int(s) for s in shape[:3])
+    n_vox = int(np.prod(shape))
+    points, offsets = flatten_streamlines(streamlines)
+    counts = np.zeros(n_vox, dtype=np.int64)
+    for _, pts, offs in iter_chunks(points, offsets, chunk_size):
+        vox, _ = unique_visits(linear_voxels(pts, affine, shape), streamline_ids(offs), len(offs) - 1)
+        counts += np.bincount(vox, minlength=n_vox)
+    return counts.reshape(shape).astype(np.int32)
+
+
+def grouped_density(streamlines, affine, shape, groups, n_groups=None, chunk_size=None):
+    """
+    One density map per streamline group, as a sparse (n_groups, n_voxels) matrix.
+
+    Parameters
+    ----------
+    groups : np.ndarray
+        (n_streamlines,) or (n_streamlines, k) non-negative group ids; a
+        streamline contributes to each of its distinct groups once. Negative
+        ids are ignored.
+    n_groups : int or None
+        Number of rows (``groups.max() + 1`` if None).
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        int32 visit counts; row ``g`` reshaped to ``shape`` (C order) is the
+        map of group ``g``.
+    """
+    from scipy import sparse
+
+    shape = tuple(int(s) for s in shape[:3])
+    n_vox = int(np.prod(shape))
+    groups = np.asarray(groups).reshape(len(groups), -1).astype(np.int64)
+    if n_groups is None:
+        n_groups = int(groups.max()) + 1 if groups.size else 0
+    # the same group twice (e.g. both ends in one ROI) must count once
+    groups = np.sort(groups, axis=1)
+    groups[:, 1:][groups[:, 1:] == groups[:, :-1]] = -1
+
+    points, offsets = flatten_streamlines(streamlines)
+    maps = sparse.csr_matrix((n_groups, n_vox), dtype=np.int32)
+    for first, pts, offs in iter_chunks(points, offsets, chunk_size):
+        vox, sl = unique_visits(linear_voxels(pts, affine, shape), streamline_ids(offs), len(offs) - 1)
+        rows = groups[first + sl]                       # (n_visits, k)
+        valid = rows >= 0
+        cols = np.broadcast_to(vox[:, None], rows.shape)[valid]
+        block = sparse.coo_matrix((np.ones(len(cols), dtype=np.int32), (rows[valid], cols)),
+                                  shape=(n_groups, n_vox))
+        maps = maps + block.tocsr()
+    return maps
+
+
+def endpoint_groups(streamlines, affine, atlas):
+    """(n_streamlines, 2) atlas labels of both endpoints (0 = background or empty streamline)."""
+    points, offsets = flatten_streamlines(streamlines)
+    return label_lookup(endpoint_voxels(points, offsets, affine), np.asarray(atlas))
+
+
+def save_density_maps(out_dir, streamlines, affine, shape, atlas=None, per_roi=None, chunk_size=100000):
+    """
+    Save the tract-density map and, optionally, one path map per atlas ROI.
+
+    ``tract_density.nii.gz`` is the DIPY counterpart of probtrackx's
+    ``fdt_paths``. With ``per_roi`` the streamlines are grouped by the atlas
+    labels of their endpoints (mask seeding has no per-ROI seeds, so the
+    terminating ROIs stand in for them) and written either as
+    ``tract_density_rois.npz`` (``"sparse"``, rows = labels, columns = C-order
+    voxels) or as the 4D ``tract_density_rois.nii.gz`` (``"4d"``, volume
+    ``l - 1`` for label ``l``).
+
+    Returns
+    -------
+    dict
+        Output name -> path.
+    """
+    from scipy import sparse
+    from dipy.io.image import save_nifti
+
+    if per_roi not in (None, "sparse", "4d"):
+        raise ValueError(f"Unknown per-ROI output: {per_roi}")
+    shape = tuple(int(s) for s in shape[:3])
+    os.makedirs(out_dir, exist_ok=True)
+    files = {"density": os.path.join(out_dir, "tract_density.nii.gz")}
+    save_nifti(files["density"], density_map(streamlines, affine, shape, chunk_size=chunk_size), affine)
+    print(f"Tract density saved to: {files['density']}")
+    if per_roi is None:
+        return files
+    if atlas is None:
+        raise ValueError("per-ROI density maps need an atlas")
+
+    atlas = np.rint(np.asarray(atlas)).astype(np.int64)
+    groups = endpoint_groups(streamlines, affine, atlas)
+    groups[groups == 0] = -1                            # background is not an ROI
+    maps = grouped_density(streamlines, affine, shape, groups, n_groups=int(atlas.max()) + 1,
+                           chunk_size=chunk_size)
+    if per_roi == "sparse":
+        files["rois"] = os.path.join(out_dir, "tract_density_rois.npz")
+        sparse.save_npz(files["rois"], maps)
+    else:
+        files["rois"] = os.path.join(out_dir, "tract_density_rois.nii.gz")
+        volume = maps[1:].toarray().T.reshape(shape + (maps.shape[0] - 1,))
+        save_nifti(files["rois"], volume.astype(np.int32), affine)
+    print(f"Per-ROI path maps saved to: {files['rois']}")
+    return files
@@ -0,0 +1,277 @@
+import os
+import json
+import numpy as np
+
+
+FLAT_DIR_NAME = "streamlines_flat"
+
+
+def flatten_streamlines(streamlines):
+    """
+    Return the concatenated points buffer and offsets of ``streamlines``.
+
+    For a ``Streamlines`` (ArraySequence) that is not a sliced view the points
+    buffer is returned without copying. ArraySequence has no public accessor
+    for its buffer and lengths, so they are read from its internal
+    ``_data``/``_offsets``/``_lengths`` arrays (the layout ``ArraySequence.save``
+    and ``load`` use).
+
+    Returns
+    -------
+    points : np.ndarray
+        (N, 3) coordinates of all points, streamline after streamline.
+    offsets : np.ndarray
+        (n_streamlines + 1,) int64; streamline ``i`` is
+        ``points[offsets[i]:offsets[i + 1]]``.
+    """
+    if isinstance(streamlines, FlatTractogram):
+        return streamlines.points, streamlines.offsets
+    if hasattr(streamlines, "_data") and hasattr(streamlines, "_lengths"):   # ArraySequence / Streamlines
+        lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+        contiguous = (not streamlines.is_sliced_view and len(lengths) > 0
+                      and streamlines._offsets[0] == 0
+                      and np.array_equal(streamlines._offsets[1:], np.cumsum(lengths)[:-1]))
+        points = streamlines._data if contiguous else streamlines.get_data()
+    else:
+        arrays = [np.asarray(s) for s in streamlines]
+        lengths = np.array([len(s) for s in arrays], dtype=np.int64)
+        points = np.concatenate(arrays) if arrays else np.empty((0, 3))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return points, offsets
+
+
+def streamline_ids(offsets):
+    """Streamline index of every point of a flat buffer."""
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def streamline_lengths(points, offsets):
+    """Arc length (in the units of ``points``) of every streamline, vectorized; 0 if empty."""
+    n = len(offsets) - 1
+    if len(points) < 2:
+        return np.zeros(n)
+    seg = np.sqrt(np.sum(np.diff(np.asarray(points, dtype=np.float64), axis=0) ** 2, axis=1))
+    # the segment between the last point of one streamline and the first of the next is not real;
+    # boundaries at 0 or at the end of the buffer (leading/trailing empty streamlines) have none
+    bounds = offsets[1:-1]
+    seg[bounds[(bounds > 0) & (bounds < len(points))] - 1] = 0.0
+    cum = np.concatenate([[0.0], np.cumsum(seg)])
+    nonempty = offsets[1:] > offsets[:-1]
+    idx = endpoint_indices(offsets)
+    return np.where(nonempty, cum[idx[:, 1]] - cum[idx[:, 0]], 0.0)
+
+
+def endpoint_indices(offsets):
+    """
+    Point indices of the first and last point of each streamline, (n, 2).
+
+    Empty streamlines have no endpoints and get -1; mask them (e.g. with
+    ``offsets[1:] > offsets[:-1]``) before indexing the points.
+    """
+    first, last = offsets[:-1], offsets[1:] - 1
+    return np.where((last >= first)[:, None], np.stack([first, last], axis=1), -1)
+
+
+def endpoint_voxels(points, offsets, affine):
+    """
+    Nearest voxel indices (n, 2, 3) of both ends of every streamline.
+
+    Only the endpoints are transformed, not the whole buffer. Empty
+    streamlines get -1 (outside any grid).
+    """
+    idx = endpoint_indices(offsets)
+    voxels = np.full(idx.shape + (3,), -1, dtype=np.intp)
+    nonempty = idx[:, 0] >= 0
+    voxels[nonempty] = world_to_voxel(np.asarray(points)[idx[nonempty]], affine)
+    return voxels
+
+
+def check_endpoints_inside(end_voxels, shape):
+    """
+    Raise ValueError if any endpoint voxel (n, 2, 3) lies outside ``shape``.
+
+    ``label_lookup`` maps such voxels to label 0, which would silently count
+    them as background edges; DIPY's ``connectivity_matrix`` refuses them too.
+    """
+    outside = ~np.all((end_voxels >= 0) & (end_voxels < np.asarray(shape[:3])), axis=-1)
+    if outside.any():
+        raise ValueError(f"{int(outside.any(axis=-1).sum())} streamlines end outside the atlas volume; "
+                         "check that the atlas and affine match the tractogram")
+
+
+def streamlines_from_flat(points, offsets, dtype=None):
+    """
+    DIPY ``Streamlines`` over a flat ``points`` buffer, without copying it.
+
+    The arrays are set as the sequence's internal buffer, offsets and
+    lengths, as ``ArraySequence.load`` does; the public ``extend`` would
+    copy one streamline at a time and drop empty streamlines. ``dtype``
+    converts the points (None keeps theirs).
+    """
+    from dipy.tracking.streamline import Streamlines
+
+    offsets = np.asarray(offsets)
+    seq = Streamlines()
+    seq._data = np.asarray(points, dtype=dtype)
+    seq._offsets = np.asarray(offsets[:-1], dtype=np.intp)
+    seq._lengths = np.diff(offsets).astype(np.intp)
+    return seq
+
+
+def world_to_voxel(points, affine):
+    """Nearest voxel indices of world-space points (same rounding as DIPY)."""
+    inv = np.linalg.inv(np.asarray(affine, dtype=np.float64))
+    ijk = np.asarray(points, dtype=np.float64) @ inv[:3, :3].T + inv[:3, 3]
+    return np.floor(ijk + 0.5).astype(np.intp)
+
+
+def label_lookup(voxels, labels):
+    """Values of ``labels`` at integer ``voxels`` (..., 3); 0 outside the volume."""
+    shape = np.asarray(labels.shape[:3])
+    inside = np.all((voxels >= 0) & (voxels < shape), axis=-1)
+    out = np.zeros(voxels.shape[:-1], dtype=labels.dtype)
+    v = voxels[inside]
+    out[inside] = labels[v[:, 0], v[:, 1], v[:, 2]]
+    return out
+
+
+class FlatTractogram:
+    """
+    Streamlines stored as one flat points array plus offsets.
+
+    Arrays may be memory-mapped ``.npy`` files; indexing returns views into
+    the points buffer and nothing is read until it is touched.
+
+    Attributes
+    ----------
+    points : np.ndarray
+        (N, 3) world coordinates (mm), float16 or float32.
+    offsets : np.ndarray
+        (n_streamlines + 1,) int64 offsets into ``points``.
+    affine : np.ndarray
+        Voxel-to-world affine of the tracking grid.
+    shape : tuple
+        Shape of the tracking grid.
+    data : dict of np.ndarray
+        Per-streamline metadata arrays, e.g. ``lengths`` and ``endpoint_labels``.
+    """
+
+    def __init__(self, points, offsets, affine, shape, data=None, meta=None):
+        self.points = points
+        self.offsets = offsets
+        self.affine = np.asarray(affine, dtype=np.float64)
+        self.shape = tuple(int(s) for s in shape)
+        self.data = data or {}
+        self.meta = meta or {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.points[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_streamlines(self, dtype=np.float32):
+        """Wrap the buffer as a DIPY ``Streamlines`` (no copy for ``dtype`` points)."""
+        return streamlines_from_flat(self.points, self.offsets, dtype=dtype)
+
+
+def save_flat_tractogram(out_dir, streamlines, affine, shape, dtype="float32",
+                         compress_tol=None, max_segment_length=10.0, labels=None,
+                         dir_name=FLAT_DIR_NAME):
+    """
+    Save streamlines as memory-mappable flat arrays.
+
+    The output directory holds ``points.npy`` (N, 3), ``offsets.npy``
+    (n + 1,), one ``.npy`` per metadata array and ``meta.json`` (affine,
+    grid shape, dtype, compression settings).
+
+    Parameters
+    ----------
+    out_dir : str
+        Directory in which ``dir_name`` is created.
+    streamlines : Streamlines or sequence of (n_i, 3) arrays
+        World-space streamlines, as returned by ``LocalTracking``.
+    affine : np.ndarray
+        Voxel-to-world affine of the tracking grid.
+    shape : tuple
+        Shape of the tracking grid.
+    dtype : {"float32", "float16"}
+        Storage type of the coordinates. float16 keeps about 0.06 mm
+        precision for coordinates within ±128 mm.
+    compress_tol : float or None
+        If given, streamlines are linearized (``compress_streamlines``) so that
+        no removed point is further than ``compress_tol`` mm from the result.
+    max_segment_length : float
+        Longest segment (mm) allowed by the compression.
+    labels : np.ndarray or None
+        Label volume (e.g. atlas in DWI space); if given, the labels of both
+        endpoints are stored as ``endpoint_labels`` (n, 2).
+
+    Returns
+    -------
+    str
+        Path of the written directory.
+    """
+    from dipy.tracking.streamline import Streamlines
+    from dipy.tracking.streamlinespeed import compress_streamlines
+
+    if dtype not in ("float32", "float16"):
+        raise ValueError(f"Unsupported coordinate dtype: {dtype}")
+    path = os.path.join(out_dir, dir_name)
+    os.makedirs(path, exist_ok=True)
+
+    points, offsets = flatten_streamlines(streamlines)
+    # lengths are measured on the full-resolution streamlines
+    data = {"lengths": streamline_lengths(points, offsets).astype(np.float32)}
+    if labels is not None:
+        ends = points[endpoint_indices(offsets)]
+        data["endpoint_labels"] = label_lookup(world_to_voxel(ends, affine), np.asarray(labels))
+
+    if compress_tol is not None:
+        n_before = len(points)
+        compressed = compress_streamlines(Streamlines(streamlines), tol_error=compress_tol,
+                                          max_segment_length=max_segment_length)
+        points, offsets = flatten_streamlines(compressed)
+        print(f"Compressed {n_before} points to {len(points)} (tolerance {compress_tol} mm)")
+
+    np.save(os.path.join(path, "points.npy"), np.ascontiguousarray(points, dtype=dtype))
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    for name, values in data.items():
+        np.save(os.path.join(path, f"{name}.npy"), values)
+
+    meta = {
+        "affine": np.asarray(affine, dtype=float).tolist(),
+        "shape": [int(s) for s in shape[:3]],
+        "dtype": dtype,
+        "space": "world",
+        "n_streamlines": int(len(offsets) - 1),
+        "n_points": int(len(points)),
+        "compress_tol": compress_tol,
+        "max_segment_length": max_segment_length if compress_tol is not None else None,
+        "data": sorted(data),
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return path
+
+
+def load_flat_tractogram(path, mmap=True):
+    """
+    Load a tractogram written by ``save_flat_tractogram``.
+
+    With ``mmap=True`` the arrays are memory-mapped read-only, so loading is
+    independent of the tractogram size.
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    mode = "r" if mmap else None
+    points = np.load(os.path.join(path, "points.npy"), mmap_mode=mode)
+    offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode=mode)
+    data = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode)
+            for name in meta.get("data", [])}
+    return FlatTractogram(points, offsets, meta["affine"], meta["shape"], data=data, meta=meta)
@@ -1,13 +1,265 @@
-import sys, csv, glob, os, numpy as np
+#!/usr/bin/env python3
+"""
+Merge sharded probtrackx2 outputs into one connectome.
 
-src_dir, out_csv = sys.argv[1:]
-mats = sorted(glob.glob(os.path.join(src_dir, "seed_*", "fdt_matrix1.dot")))
-if not mats:
-    sys.exit("No per-seed matrices found – nothing to merge.")
+Three layouts are supported:
 
-all_mats = [np.loadtxt(f) for f in mats]
-conn2d   = np.sum(all_mats, axis=0)
+* per-seed directories ``seed_*/fdt_matrix1.dot`` (the default): the
+  matrices of all seed runs are summed element-wise into one CSV;
+* per-seed directories ``seed_<n>/`` (one probtrackx2 run per seed ROI with
+  ``--os2t --s2tastext``, selected with ``--os2t``): every run becomes one
+  row of the ROI×ROI matrix (the column sums of its
+  ``matrix_seeds_to_all_targets``) and keeps its own ``waytotal`` for
+  row-wise normalisation;
+* shards of one run split over seed ROIs, described by a manifest giving
+  each shard's directory and ``row_offset``:
 
-with open(out_csv, "w", newline="") as f:
-    csv.writer(f).writerows(conn2d)
-print(f"Merged {len(mats)} matrices → {out_csv}")
+  - ``fdt_matrix2.dot`` (``--omatrix2``, rows are seed voxels): rows are
+    shifted to their global index and streamed into one ``.dot`` file;
+  - ``fdt_matrix3.dot`` (``--omatrix3``, target3×target3, independent of
+    the seed): the shard matrices are summed element-wise.
+
+  Waytotals are summed in both cases.
+
+The per-seed and row merges stream the inputs line by line, so memory does
+not grow with the number or size of the shards; the element-wise sum holds
+the non-zeros of the merged matrix.
+
+Usage
+-----
+>>> python merge_omatrix.py <src_dir> <out.csv>
+>>> python merge_omatrix.py <src_dir> <out.csv> --os2t [--normalized <out_norm.csv>]
+>>> python merge_omatrix.py --manifest shards.json <out.dot> [--normalize] [--sum]
+"""
+import sys, csv, glob, os, json, argparse, numpy as np
+
+
+def read_waytotal(path):
+    """Sum of all numbers in a probtrackx ``waytotal`` file (0 if missing)."""
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return sum(int(float(v)) for v in f.read().split())
+
+
+def _s2t_matrix(run_dir):
+    for name in ("matrix_seeds_to_all_targets", "matrix_seeds_to_all_targets.txt"):
+        path = os.path.join(run_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def sum_seed_matrices(src_dir):
+    """
+    Element-wise sum of the ``seed_*/fdt_matrix1.dot`` files in ``src_dir``.
+
+    Returns
+    -------
+    matrix : np.ndarray
+        Sum of the loaded matrices.
+    n_runs : int
+        Number of matrices summed.
+    """
+    mats = sorted(glob.glob(os.path.join(src_dir, "seed_*", "fdt_matrix1.dot")))
+    if not mats:
+        raise FileNotFoundError("No per-seed matrices found – nothing to merge.")
+    total = np.loadtxt(mats[0])
+    for path in mats[1:]:
+        total = total + np.loadtxt(path)
+    return total, len(mats)
+
+
+def find_seed_dirs(src_dirs):
+    """All ``seed_*`` run directories below ``src_dirs``, in seed order."""
+    if isinstance(src_dirs, str):
+        src_dirs = [src_dirs]
+    seed_dirs = []
+    for src in src_dirs:
+        seed_dirs += [d for d in glob.glob(os.path.join(src, "**", "seed_*"), recursive=True)
+                      if os.path.isdir(d)]
+    # seed_<n> with n the global row index; sort numerically, not lexically
+    return sorted(set(seed_dirs), key=lambda d: int(os.path.basename(d).split("_")[-1]))
+
+
+def merge_seed_rows(src_dirs, n_targets=None):
+    """
+    Build a seed-ROI × target-ROI matrix from per-seed probtrackx2 runs.
+
+    Parameters
+    ----------
+    src_dirs : str or list of str
+        Directories containing ``seed_<n>/`` run directories (directly or
+        nested, e.g. one directory per shard).
+    n_targets : int or None
+        Number of target ROIs; inferred from the first run if None.
+
+    Returns
+    -------
+    counts : np.ndarray
+        (n_seeds, n_targets) streamline counts.
+    waytotal : np.ndarray
+        (n_seeds,) number of valid samples per seed ROI.
+    """
+    seed_dirs = find_seed_dirs(src_dirs)
+    if not seed_dirs:
+        raise FileNotFoundError("No per-seed probtrackx runs (seed_*/) found – nothing to merge.")
+
+    rows, waytotal = [], []
+    for run_dir in seed_dirs:
+        mat_path = _s2t_matrix(run_dir)
+        if mat_path is None:
+            raise FileNotFoundError(f"{run_dir} has no matrix_seeds_to_all_targets output")
+        row = None if n_targets is None else np.zeros(n_targets)
+        with open(mat_path) as f:
+            for ln in f:
+                if not ln.strip():
+                    continue
+                values = np.array(ln.split(), dtype=float)
+                if row is None:
+                    n_targets = values.size
+                    row = np.zeros(n_targets)
+                row += values
+        rows.append(row if row is not None else np.zeros(n_targets or 0))
+        waytotal.append(read_waytotal(os.path.join(run_dir, "waytotal")))
+    return np.vstack(rows), np.asarray(waytotal, dtype=np.int64)
+
+
+def normalize_rows(counts, waytotal):
+    """Divide each row by its seed's waytotal (rows with no samples stay 0)."""
+    waytotal = np.asarray(waytotal, dtype=float)
+    scale = np.divide(1.0, waytotal, out=np.zeros_like(waytotal), where=waytotal > 0)
+    return counts * scale[:, None]
+
+
+def _read_dot(shard_dir, name):
+    path = os.path.join(shard_dir, f"{name}.dot")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{shard_dir} has no {name}.dot output")
+    return path
+
+
+def _write_waytotal(out_dot, shards):
+    waytotal = sum(read_waytotal(os.path.join(s["dir"], "waytotal")) for s in shards)
+    with open(os.path.splitext(out_dot)[0] + "_waytotal", "w") as f:
+        f.write(f"{waytotal}\n")
+    return waytotal
+
+
+def merge_row_shards(shards, out_dot, normalize=False):
+    """
+    Stream seed-row shards of ``fdt_matrix2.dot`` into one ``.dot`` file.
+
+    Parameters
+    ----------
+    shards : list of dict
+        One entry per shard with ``dir`` (probtrackx2 output directory) and
+        ``row_offset`` (number of seed rows in all preceding shards).
+    out_dot : str
+        Merged ``.dot`` file (1-based ``row col value`` triplets).
+    normalize : bool
+        If True, values are divided by the summed waytotal of all shards.
+
+    Returns
+    -------
+    waytotal : int
+        Total number of valid samples over all shards.
+    """
+    waytotal = _write_waytotal(out_dot, shards)
+    scale = 1.0 / waytotal if normalize and waytotal > 0 else 1.0
+
+    tmp_out = out_dot + ".part"
+    with open(tmp_out, "w") as fout:
+        for shard in sorted(shards, key=lambda s: s["row_offset"]):
+            offset = int(shard["row_offset"])
+            with open(_read_dot(shard["dir"], "fdt_matrix2")) as f:
+                for ln in f:
+                    if ln.startswith('#') or not ln.strip():
+                        continue
+                    i, j, v = ln.split()[:3]
+                    fout.write(f"{int(i) + offset} {j} {_fmt(float(v) * scale)}\n")
+    os.replace(tmp_out, out_dot)
+    return waytotal
+
+
+def sum_shards(shards, out_dot, normalize=False):
+    """
+    Sum the ``fdt_matrix3.dot`` (target3×target3) outputs of seed shards.
+
+    Every path adds to the matrix whichever seed it started from, so the
+    sum over disjoint seed shards equals the matrix of one unsharded run.
+    Arguments and return value as for ``merge_row_shards`` (``row_offset``
+    is not used).
+    """
+    waytotal = _write_waytotal(out_dot, shards)
+    scale = 1.0 / waytotal if normalize and waytotal > 0 else 1.0
+
+    totals = {}
+    for shard in shards:
+        with open(_read_dot(shard["dir"], "fdt_matrix3")) as f:
+            for ln in f:
+                if ln.startswith('#') or not ln.strip():
+                    continue
+                i, j, v = ln.split()[:3]
+                key = (int(i), int(j))
+                totals[key] = totals.get(key, 0.0) + float(v)
+
+    tmp_out = out_dot + ".part"
+    with open(tmp_out, "w") as fout:
+        for (i, j), v in sorted(totals.items()):
+            fout.write(f"{i} {j} {_fmt(v * scale)}\n")
+    os.replace(tmp_out, out_dot)
+    return waytotal
+
+
+def _fmt(value):
+    return f"{value:.0f}" if float(value).is_integer() else f"{value:.8g}"
+
+
+def write_csv(matrix, out_csv):
+    with open(out_csv, "w", newline="") as f:
+        csv.writer(f).writerows(matrix)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge sharded probtrackx2 matrices")
+    parser.add_argument("src", help="Directory with seed_*/ runs, or a shard manifest (with --manifest)")
+    parser.add_argument("out", help="Output CSV (seed runs) or .dot (row shards)")
+    parser.add_argument("--os2t", action="store_true",
+                        help="Seed runs made with --os2t: one row per seed from matrix_seeds_to_all_targets")
+    parser.add_argument("--manifest", action="store_true", help="src is a JSON manifest of row shards")
+    parser.add_argument("--normalize", action="store_true", help="Row shards: divide by the total waytotal")
+    parser.add_argument("--sum", action="store_true", help="Shards of fdt_matrix3.dot: sum instead of row-shifting")
+    parser.add_argument("--normalized", default=None,
+                        help="--os2t seed runs: also write the waytotal-normalised CSV here")
+    args = parser.parse_args(argv)
+
+    if args.manifest:
+        with open(args.src) as f:
+            shards = json.load(f)["shards"]
+        merge = sum_shards if args.sum else merge_row_shards
+        waytotal = merge(shards, args.out, normalize=args.normalize)
+        print(f"Merged {len(shards)} shards (waytotal {waytotal}) → {args.out}")
+        return
+
+    if not args.os2t:
+        if args.normalized:
+            parser.error("--normalized needs --os2t (fdt_matrix1.dot runs have no per-seed waytotal)")
+        matrix, n_runs = sum_seed_matrices(args.src)
+        write_csv(matrix, args.out)
+        print(f"Merged {n_runs} matrices → {args.out}")
+        return
+
+    counts, waytotal = merge_seed_rows(args.src)
+    write_csv(counts, args.out)
+    np.savetxt(os.path.splitext(args.out)[0] + "_waytotal.txt", waytotal, fmt="%d")
+    if args.normalized:
+        write_csv(normalize_rows(counts, waytotal), args.normalized)
+    print(f"Merged {len(waytotal)} seed runs → {args.out}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except FileNotFoundError as exc:
+        sys.exit(str(exc))
@@ -0,0 +1,316 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+if __package__ is None or __package__ == "":
+    from tractography import save_tractogram
+    from connectivity import connectivity_from_streamlines
+    from flat_tractogram import streamlines_from_flat
+else:
+    from .tractography import save_tractogram
+    from .connectivity import connectivity_from_streamlines
+    from .flat_tractogram import streamlines_from_flat
+
+
+# Tensor fields of the running tracker, set once per worker process
+_FIELDS = None
+
+# Cap on the angular SD (radians); beyond this the sampled direction is
+# essentially uniform in the e1/e2/e3 frame anyway
+MAX_SPREAD = 1.0
+
+
+def eigenvector_uncertainty(dwi, gtab, evecs, evals, mask):
+    """
+    Angular standard deviation of the principal eigenvector from the fit residuals.
+
+    The log-linear tensor model is fitted by least squares in every mask
+    voxel; the residual variance ``s2`` gives the covariance of the six tensor
+    elements, ``s2 * inv(X'X)``. First-order perturbation of the
+    eigen-decomposition then gives the spread of ``e1`` towards ``e2`` and
+    ``e3``: ``std(e_k' dD e1) / (l1 - l_k)`` radians. The spread is therefore
+    wide where the data are noisy or the tensor is close to planar/isotropic,
+    and narrow where the principal direction is well determined.
+
+    Parameters
+    ----------
+    dwi : np.ndarray
+        4D DWI data the tensors were fitted to.
+    gtab : GradientTable
+    evecs, evals : np.ndarray
+        Eigenvectors (in columns) and eigenvalues of the fitted tensors.
+    mask : np.ndarray
+        Voxels to evaluate; the spread is 0 elsewhere.
+
+    Returns
+    -------
+    np.ndarray
+        (..., 2) float32 angular SD (radians) towards ``e2`` and ``e3``.
+    """
+    from dipy.reconst.dti import design_matrix
+
+    X = design_matrix(gtab)
+    if X.shape[0] <= X.shape[1]:
+        raise ValueError(f"{X.shape[0]} volumes are too few to estimate the tensor fit residuals")
+    mask = np.asarray(mask, dtype=bool)
+    signal = np.asarray(dwi[mask], dtype=np.float64)
+    log_signal = np.log(np.maximum(signal, np.finfo(np.float32).tiny))
+    residuals = log_signal - (log_signal @ np.linalg.pinv(X).T) @ X.T
+    s2 = np.sum(residuals ** 2, axis=1) / (X.shape[0] - X.shape[1])
+    cov = np.linalg.inv(X.T @ X)[:6, :6]       # Dxx, Dxy, Dyy, Dxz, Dyz, Dzz
+
+    e = np.nan_to_num(np.asarray(evecs, dtype=np.float64)[mask])
+    lam = np.clip(np.nan_to_num(np.asarray(evals, dtype=np.float64)[mask]), 0, None)
+    e1 = e[:, :, 0]
+    spread = np.zeros(mask.shape + (2,), dtype=np.float32)
+    out = np.empty((len(e1), 2))
+    for col, k in enumerate((1, 2)):
+        ek = e[:, :, k]
+        # d(e_k' D e1) / d(Dxx, Dxy, Dyy, Dxz, Dyz, Dzz)
+        g = np.stack([ek[:, 0] * e1[:, 0],
+                      ek[:, 0] * e1[:, 1] + ek[:, 1] * e1[:, 0],
+                      ek[:, 1] * e1[:, 1],
+                      ek[:, 0] * e1[:, 2] + ek[:, 2] * e1[:, 0],
+                      ek[:, 1] * e1[:, 2] + ek[:, 2] * e1[:, 1],
+                      ek[:, 2] * e1[:, 2]], axis=1)
+        sd = np.sqrt(s2 * np.einsum("ni,ij,nj->n", g, cov, g))
+        gap = lam[:, 0] - lam[:, k]
+        # a (near) degenerate eigenvalue leaves e1 undetermined in that plane
+        out[:, col] = np.divide(sd, gap, out=np.full(len(sd), np.inf), where=gap > 0)
+    spread[mask] = np.minimum(out, MAX_SPREAD)
+    return spread
+
+
+def tensor_fields(evecs, spread, allowed, dispersion=1.0):
+    """
+    Arrays the tracker samples from.
+
+    ``spread`` is the angular SD of the principal eigenvector ``e1`` towards
+    ``e2`` and ``e3`` (see ``eigenvector_uncertainty``); ``dispersion`` scales
+    it, e.g. to widen the cone beyond the fit uncertainty.
+    """
+    return {
+        "evecs": np.ascontiguousarray(np.nan_to_num(evecs), dtype=np.float32),
+        "spread": np.ascontiguousarray(np.minimum(dispersion * np.asarray(spread), MAX_SPREAD), dtype=np.float32),
+        "allowed": np.ascontiguousarray(allowed, dtype=bool),
+    }
+
+
+def sample_directions(fields, voxels, rng):
+    """
+    One random unit direction per voxel in ``voxels`` (m, 3).
+
+    The offsets along ``e2``/``e3`` are Gaussian with the angular SD of
+    ``fields["spread"]`` (small-angle approximation).
+    """
+    i, j, k = voxels.T
+    e = fields["evecs"][i, j, k].astype(np.float64)          # (m, 3, 3), eigenvectors in columns
+    s = fields["spread"][i, j, k].astype(np.float64)         # (m, 2)
+    g = rng.standard_normal((len(voxels), 2)) * s
+    d = e[:, :, 0] + g[:, :1] * e[:, :, 1] + g[:, 1:] * e[:, :, 2]
+    return d / np.linalg.norm(d, axis=1, keepdims=True)
+
+
+def _track(fields, pos, direction, rng, step, cos_max, max_steps):
+    """
+    Propagate all streamlines of a batch in lock step.
+
+    Returns the ids and positions of every new point, in step order.
+    """
+    shape = np.asarray(fields["allowed"].shape)
+    pos, direction = pos.copy(), direction.copy()
+    active = np.arange(len(pos))
+    out_ids, out_pts = [], []
+    for _ in range(max_steps):
+        if not active.size:
+            break
+        p = pos[active] + step * direction[active]
+        vox = np.floor(p + 0.5).astype(np.intp)
+        ok = np.all((vox >= 0) & (vox < shape), axis=1)
+        ok[ok] = fields["allowed"][tuple(vox[ok].T)]
+        active, p, vox = active[ok], p[ok], vox[ok]
+        if not active.size:
+            break
+        out_ids.append(active)
+        out_pts.append(p)
+        pos[active] = p
+
+        d = sample_directions(fields, vox, rng)
+        cos = np.sum(d * direction[active], axis=1)
+        d[cos < 0] *= -1
+        keep = np.abs(cos) >= cos_max
+        direction[active[keep]] = d[keep]
+        active = active[keep]
+    if not out_ids:
+        return np.empty(0, dtype=np.intp), np.empty((0, 3))
+    return np.concatenate(out_ids), np.concatenate(out_pts)
+
+
+def track_batch(seeds, seed_seq, step=0.25, max_angle=60.0, max_steps=1000, fields=None):
+    """
+    Track one batch of voxel-space seeds in both directions.
+
+    The generator is built from ``seed_seq`` alone, so a batch gives the same
+    streamlines whichever worker runs it.
+
+    Returns
+    -------
+    points : np.ndarray
+        Voxel-space points of all streamlines, concatenated.
+    lengths : np.ndarray
+        Number of points per streamline (one per seed, possibly 1).
+    """
+    fields = _FIELDS if fields is None else fields
+    rng = np.random.default_rng(seed_seq)
+    seeds = np.asarray(seeds, dtype=np.float64)
+    n = len(seeds)
+    vox = np.floor(seeds + 0.5).astype(np.intp)
+    initial = sample_directions(fields, vox, rng)
+    cos_max = np.cos(np.deg2rad(max_angle))
+
+    f_ids, f_pts = _track(fields, seeds, initial, rng, step, cos_max, max_steps)
+    b_ids, b_pts = _track(fields, seeds, -initial, rng, step, cos_max, max_steps)
+
+    # order within a streamline: backward points reversed, seed, forward points
+    f_order = np.zeros(len(f_ids), dtype=np.int64)
+    b_order = np.zeros(len(b_ids), dtype=np.int64)
+    for ids, order, sign in ((f_ids, f_order, 1), (b_ids, b_order, -1)):
+        if len(ids):
+            # k-th point of each streamline: position among the equal ids (ids are in step order)
+            sort = np.argsort(ids, kind="stable")
+            run_start = np.searchsorted(ids[sort], ids[sort])
+            order[sort] = sign * (np.arange(len(ids)) - run_start + 1)
+    ids = np.concatenate([np.arange(n), f_ids, b_ids])
+    order = np.concatenate([np.zeros(n, dtype=np.int64), f_order, b_order])
+    points = np.concatenate([seeds, f_pts, b_pts])
+    sort = np.lexsort((order, ids))
+    return points[sort], np.bincount(ids, minlength=n)
+
+
+def _init_worker(fields):
+    global _FIELDS
+    _FIELDS = fields
+
+
+def probabilistic_tracking(fields, seeds, affine, random_seed=None, batch_size=2000, n_workers=None,
+                           step_size=0.5, max_angle=60.0, max_steps=1000, min_points=2):
+    """
+    Probabilistic tensor tracking of voxel-space ``seeds`` over a process pool.
+
+    Seeds are cut into fixed batches and batch ``b`` draws from
+    ``SeedSequence(random_seed).spawn(n_batches)[b]``; results are collected
+    in batch order, so the tractogram depends on ``random_seed`` and
+    ``batch_size`` only, not on ``n_workers``.
+
+    Parameters
+    ----------
+    fields : dict
+        Output of ``tensor_fields``.
+    seeds : np.ndarray
+        (N, 3) seed points in voxel coordinates.
+    affine : np.ndarray
+        Voxel-to-world affine; streamlines are returned in world coordinates.
+    random_seed : int, SeedSequence or None
+        Root ``SeedSequence`` (or its entropy).
+    batch_size : int
+        Seeds per task.
+    n_workers : int or None
+        Worker processes (``os.cpu_count()`` if None, in-process if 1).
+    step_size : float
+        Step length in mm.
+    max_angle : float
+        Largest angle (degrees) between consecutive steps.
+    max_steps : int
+        Maximum number of steps in each direction.
+    min_points : int
+        Streamlines with fewer points are dropped.
+
+    Returns
+    -------
+    Streamlines
+    """
+    affine = np.asarray(affine, dtype=np.float64)
+    step = step_size / float(np.mean(np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))))
+    seeds = np.asarray(seeds, dtype=np.float64)
+    batches = [seeds[i:i + batch_size] for i in range(0, len(seeds), batch_size)]
+    root = random_seed if isinstance(random_seed, np.random.SeedSequence) else np.random.SeedSequence(random_seed)
+    seed_seqs = root.spawn(len(batches))
+    kwargs = {"step": step, "max_angle": max_angle, "max_steps": max_steps}
+
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers == 1 or len(batches) <= 1:
+        results = [track_batch(b, s, fields=fields, **kwargs) for b, s in zip(batches, seed_seqs)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(fields,)) as pool:
+            futures = [pool.submit(track_batch, b, s, **kwargs) for b, s in zip(batches, seed_seqs)]
+            results = [f.result() for f in futures]
+
+    # drop short streamlines with a per-point mask and wrap one concatenated buffer
+    points = np.concatenate([p[np.repeat(n >= min_points, n)] for p, n in results] or [np.empty((0, 3))])
+    lengths = np.concatenate([n[n >= min_points] for _, n in results] or [np.empty(0, np.intp)])
+    world = points @ affine[:3, :3].T + affine[:3, 3]
+    return streamlines_from_flat(world, np.concatenate([[0], np.cumsum(lengths)]))
+
+
+def probabilistic_tractography(dwi_file, mask_file, bval_file, bvec_file, out_dir, step_size=0.5,
+                               fa_threshold=0.2, max_angle=60.0, dispersion=1.0, seeds_per_voxel=1,
+                               seed_file=None, random_seed=0, batch_size=2000, n_workers=None,
+                               max_steps=1000, **save_kwargs):
+    """
+    Probabilistic tensor tractography sampling directions from the tensor shape.
+
+    At every step the direction is drawn around the principal eigenvector
+    with the angular spread implied by the tensor fit residuals (see
+    ``eigenvector_uncertainty``), scaled by ``dispersion``;
+    tracking stops outside the mask, where FA <= ``fa_threshold`` or when the
+    turn exceeds ``max_angle``. Seeds are ``seeds_per_voxel`` random points in
+    every voxel of ``seed_file`` (the brain mask if None), and are tracked in
+    batches over ``n_workers`` processes with reproducible per-batch random
+    streams (see ``probabilistic_tracking``).
+
+    Extra keyword arguments go to ``save_tractogram`` (``out_format``,
+    ``atlas_file``, ``spatial_index``, ...). Returns the streamlines, the
+    affine and the path of the saved tractogram, like
+    ``deterministic_tractography``.
+    """
+    from dipy.io.image import load_nifti
+    from dipy.core.gradients import gradient_table
+    from dipy.reconst.dti import TensorModel
+    from dipy.tracking.utils import seeds_from_mask
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    dwi, affine = load_nifti(dwi_file)
+    mask = load_nifti(mask_file)[0].astype(bool)
+    bvals = np.loadtxt(bval_file)
+    bvecs = np.loadtxt(bvec_file).T
+    gtab = gradient_table(bvals, bvecs)
+
+    print("Fitting tensor model for probabilistic tractography...")
+    ten_fit = TensorModel(gtab).fit(dwi, mask=mask)
+    allowed = mask & (np.nan_to_num(ten_fit.fa) > fa_threshold)
+    spread = eigenvector_uncertainty(dwi, gtab, ten_fit.evecs, ten_fit.evals, mask)
+    fields = tensor_fields(ten_fit.evecs, spread, allowed, dispersion=dispersion)
+
+    seed_mask = mask if seed_file is None else load_nifti(seed_file)[0] > 0
+    # independent streams for the seed jitter and the tracking itself
+    jitter_seq, tracking_seq = np.random.SeedSequence(random_seed).spawn(2)
+    seeds = np.repeat(seeds_from_mask(seed_mask, np.eye(4), density=1), seeds_per_voxel, axis=0)
+    seeds += np.random.default_rng(jitter_seq).uniform(-0.5, 0.5, seeds.shape)
+
+    print(f"Tracking {len(seeds)} seeds...")
+    streamlines = probabilistic_tracking(fields, seeds, affine, random_seed=tracking_seq,
+                                         batch_size=batch_size, n_workers=n_workers,
+                                         step_size=step_size, max_angle=max_angle, max_steps=max_steps)
+    print(f"{len(streamlines)} streamlines")
+
+    tract_file = save_tractogram(out_dir, streamlines, affine, dwi.shape[:3], **save_kwargs)
+    return streamlines, affine, tract_file
+
+
+def probabilistic_connectivity(dwi_file, mask_file, atlas_file, bval_file, bvec_file, out_dir, **kwargs):
+    """Probabilistic tracking followed by ``connectivity_from_streamlines``."""
+    streamlines, affine, _ = probabilistic_tractography(dwi_file, mask_file, bval_file, bvec_file, out_dir,
+                                                        atlas_file=atlas_file, **kwargs)
+    return connectivity_from_streamlines(streamlines, atlas_file, affine, out_dir)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Rebuild connectomes from a saved endpoint table, without re-tracking.
+
+Tracking writes ``endpoints.npz`` next to the tractogram: the voxel
+coordinates of both ends of every streamline (int16), the streamline
+lengths and the voxel grid (affine, shape). Any atlas already registered to
+that DWI grid can then be looked up in one vectorized gather.
+
+Usage
+-----
+>>> python reparcellate.py <endpoints.npz> <atlas_in_dwi.nii.gz> <out_dir> [--name BN_2mm]
+"""
+import os
+import sys
+import argparse
+import numpy as np
+
+if __package__ is None or __package__ == "":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from flat_tractogram import (flatten_streamlines, streamline_lengths, endpoint_voxels,
+                                 check_endpoints_inside, label_lookup)
+    from weighted_connectivity import edge_sums, save_weighted_connectivity
+else:
+    from .flat_tractogram import (flatten_streamlines, streamline_lengths, endpoint_voxels,
+                                  check_endpoints_inside, label_lookup)
+    from .weighted_connectivity import edge_sums, save_weighted_connectivity
+
+
+ENDPOINTS_FILE = "endpoints.npz"
+
+
+def save_endpoints(out_dir, streamlines, affine, shape, file_name=ENDPOINTS_FILE):
+    """
+    Save the endpoint voxel table of ``streamlines``.
+
+    Parameters
+    ----------
+    out_dir : str
+        Output directory.
+    streamlines : Streamlines, FlatTractogram or sequence of arrays
+        World-space streamlines.
+    affine : np.ndarray
+        Voxel-to-world affine of the tracking grid.
+    shape : tuple
+        Shape of the tracking grid.
+
+    Returns
+    -------
+    str
+        Path of the ``.npz`` file (``voxels`` (n, 2, 3), ``lengths``,
+        ``affine``, ``shape``). Empty streamlines have no endpoints and are
+        stored as -1 with length 0.
+    """
+    points, offsets = flatten_streamlines(streamlines)
+    voxels = endpoint_voxels(points, offsets, affine)          # -1 for empty streamlines
+    # voxels outside the grid (-1 or shape) still fit comfortably in int16
+    dtype = np.int16 if max(shape[:3]) < np.iinfo(np.int16).max else np.int32
+    path = os.path.join(out_dir, file_name)
+    np.savez(path, voxels=voxels.astype(dtype),
+             lengths=streamline_lengths(points, offsets).astype(np.float32),
+             affine=np.asarray(affine, dtype=np.float64),
+             shape=np.asarray(shape[:3], dtype=np.int64))
+    return path
+
+
+def load_endpoints(path):
+    """Return ``(voxels, lengths, affine, shape)`` from an endpoint table."""
+    with np.load(path) as table:
+        return table["voxels"], table["lengths"], table["affine"], tuple(int(s) for s in table["shape"])
+
+
+def reparcellate(endpoints_file, atlas_file, output_dir, name=None, atol=1e-3):
+    """
+    Connectome of a saved endpoint table over a new DWI-space atlas.
+
+    Matrices have the ``connectivity_matrix`` layout (symmetric,
+    ``atlas.max() + 1`` rows) and are saved like
+    ``connectivity_from_streamlines``: ``connectivity.npy`` (counts),
+    ``connectivity_length.npy`` and ``connectivity_inverse_length.npy``.
+
+    Parameters
+    ----------
+    endpoints_file : str
+        ``endpoints.npz`` written by the tracking stage.
+    atlas_file : str
+        Atlas on the same voxel grid as the tracking.
+    output_dir : str
+        Output directory; ``name`` (if given) becomes a subdirectory.
+
+    Raises
+    ------
+    ValueError
+        If the atlas is not on the tracking grid, has negative labels, or a
+        streamline ends outside it.
+
+    Returns
+    -------
+    matrices : dict of np.ndarray
+    region_labels : np.ndarray
+    """
+    from dipy.io.image import load_nifti
+
+    voxels, lengths, affine, shape = load_endpoints(endpoints_file)
+    atlas, atlas_affine = load_nifti(atlas_file)
+    if atlas.shape[:3] != shape or not np.allclose(atlas_affine, affine, atol=atol):
+        raise ValueError(f"{atlas_file} is not on the tracking grid {shape}; "
+                         "register it to DWI space first.")
+    atlas = np.rint(atlas).astype(np.int64)
+    if atlas.min() < 0:
+        raise ValueError("atlas must have non-negative label values")
+    n_labels = int(atlas.max()) + 1
+
+    # empty streamlines are stored as -1 with length 0 and join no edge
+    nonempty = ~(np.all(voxels == -1, axis=(1, 2)) & (lengths == 0))
+    voxels, lengths = voxels[nonempty].astype(np.intp), lengths[nonempty]
+    check_endpoints_inside(voxels, atlas.shape)
+    end_labels = label_lookup(voxels, atlas)
+    count = edge_sums(end_labels, n_labels)
+    inverse = np.divide(1.0, lengths, out=np.zeros(len(lengths)), where=lengths > 0)
+    matrices = {
+        "count": np.rint(count).astype(np.int64),      # same dtype as weighted_connectivity
+        "length": edge_sums(end_labels, n_labels, lengths.astype(np.float64)) / np.maximum(count, 1),
+        "inverse_length": edge_sums(end_labels, n_labels, inverse),
+    }
+    if name:
+        output_dir = os.path.join(output_dir, name)
+    save_weighted_connectivity(matrices, output_dir)
+    return matrices, np.unique(atlas)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild a connectome from saved streamline endpoints")
+    parser.add_argument("endpoints", help="endpoints.npz written by the tracking stage")
+    parser.add_argument("atlas", help="Atlas registered to DWI space (same grid as the tracking)")
+    parser.add_argument("out_dir", help="Output directory")
+    parser.add_argument("--name", default=None, help="Subdirectory for this parcellation")
+    args = parser.parse_args(argv)
+
+    matrices, labels = reparcellate(args.endpoints, args.atlas, args.out_dir, name=args.name)
+    count = matrices["count"]
+    print(f"{int(np.triu(count).sum())} streamlines over {len(labels)} labels → "
+          f"{os.path.join(args.out_dir, args.name or '')}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (FileNotFoundError, ValueError) as exc:
+        sys.exit(str(exc))
@@ -0,0 +1,148 @@
+import json
+import os
+import numpy as np
+
+
+def propagating_mask(mask, fa, fa_threshold=0.2):
+    """
+    Voxels from which tracking can actually start.
+
+    The tractography stops wherever ``fa <= fa_threshold``
+    (``BinaryStoppingCriterion``), so seeds outside that region – CSF, grey
+    matter – never produce a streamline.
+    """
+    return np.asarray(mask, dtype=bool) & (np.nan_to_num(fa) > fa_threshold)
+
+
+def normalized_connectome(matrix):
+    """Connectome scaled to unit sum (all zeros stays all zeros)."""
+    total = matrix.sum()
+    return matrix / total if total > 0 else matrix.astype(float)
+
+
+def adaptive_tracking(track, seeds, atlas=None, affine=None, seed_budget=None, batch_size=5000,
+                      convergence_tol=None, patience=2, min_batches=2, random_seed=None):
+    """
+    Spend a seed budget in randomized batches, optionally stopping early.
+
+    Seeds are shuffled and tracked ``batch_size`` at a time. When
+    ``convergence_tol`` is given, the streamline-count connectome over
+    ``atlas`` is updated after every batch, and tracking stops once the L1
+    change of the unit-sum normalized matrix has stayed below
+    ``convergence_tol`` for ``patience`` consecutive batches.
+
+    Parameters
+    ----------
+    track : callable
+        ``track(seeds) -> iterable of streamlines`` for an (n, 3) seed array.
+    seeds : np.ndarray
+        (N, 3) candidate seed points in world coordinates.
+    atlas : np.ndarray or None
+        Label volume in DWI space; needed for ``convergence_tol``.
+    affine : np.ndarray or None
+        Voxel-to-world affine of ``atlas``.
+    seed_budget : int or None
+        Maximum number of seeds to track (all seeds if None).
+    batch_size : int
+        Seeds per batch.
+    convergence_tol : float or None
+        Stop when the normalized connectome changes less than this.
+    patience : int
+        Consecutive converged batches required before stopping.
+    min_batches : int
+        Never stop before this many batches.
+    random_seed : int or None
+        Seed of the shuffling generator.
+
+    Returns
+    -------
+    streamlines : Streamlines
+        All streamlines tracked.
+    connectome : np.ndarray or None
+        Streamline-count matrix (``connectivity_matrix`` layout, symmetric) or
+        None without an atlas.
+    report : dict
+        Seeds used/available, number of batches, whether the connectome
+        converged and the per-batch matrix changes.
+    """
+    from dipy.tracking.streamline import Streamlines
+    from dipy.tracking.utils import connectivity_matrix
+
+    if convergence_tol is not None and atlas is None:
+        raise ValueError("convergence_tol needs an atlas to build the connectome.")
+    rng = np.random.default_rng(random_seed)
+    seeds = np.asarray(seeds)[rng.permutation(len(seeds))]
+    budget = len(seeds) if seed_budget is None else min(int(seed_budget), len(seeds))
+
+    streamlines = Streamlines()
+    connectome = None
+    previous = None
+    changes = []
+    n_used = 0
+    quiet = 0
+    converged = False
+    while n_used < budget:
+        batch = seeds[n_used:min(n_used + batch_size, budget)]
+        n_used += len(batch)
+        batch_streamlines = Streamlines(track(batch))
+        streamlines.extend(batch_streamlines)
+
+        if atlas is None:
+            continue
+        counts = connectivity_matrix(batch_streamlines, affine, atlas, symmetric=True) \
+            if len(batch_streamlines) else 0
+        connectome = counts if connectome is None else connectome + counts
+        current = normalized_connectome(connectome) if np.ndim(connectome) else None
+        if previous is not None and current is not None:
+            changes.append(float(np.abs(current - previous).sum()))
+            quiet = quiet + 1 if changes[-1] < (convergence_tol or 0) else 0
+        previous = current
+        if convergence_tol is not None and quiet >= patience and len(changes) + 1 >= min_batches:
+            converged = True
+            break
+
+    report = {
+        "n_candidate_seeds": int(len(seeds)),
+        "seed_budget": int(budget),
+        "n_seeds_used": int(n_used),
+        "n_batches": int(np.ceil(n_used / batch_size)) if n_used else 0,
+        "n_streamlines": int(len(streamlines)),
+        "converged": converged,
+        "final_change": changes[-1] if changes else None,
+        "changes": changes,
+    }
+    return streamlines, connectome, report
+
+
+def adaptive_seeds(mask, fa, affine, fa_threshold=0.2, density=1):
+    """
+    Seed points restricted to voxels that can propagate.
+
+    Returns
+    -------
+    seeds : np.ndarray
+        (N, 3) world-space seeds from ``propagating_mask``.
+    n_mask_seeds : int
+        Number of seeds the plain ``seeds_from_mask(mask)`` would have used.
+    """
+    from dipy.tracking.utils import seeds_from_mask
+
+    mask = np.asarray(mask, dtype=bool)
+    seeds = seeds_from_mask(propagating_mask(mask, fa, fa_threshold), affine, density=density)
+    return seeds, int(mask.sum()) * int(density) ** 3
+
+
+def finalize_report(report, n_mask_seeds, out_dir=None):
+    """Add the seed savings to ``report``, print them and save as JSON."""
+    report["n_mask_seeds"] = int(n_mask_seeds)
+    report["n_seeds_saved"] = int(n_mask_seeds - report["n_seeds_used"])
+    report["seed_fraction_saved"] = report["n_seeds_saved"] / n_mask_seeds if n_mask_seeds else 0.0
+    change = report["final_change"]
+    print(f"Adaptive seeding: {report['n_seeds_used']} of {n_mask_seeds} mask seeds tracked "
+          f"({100 * report['seed_fraction_saved']:.1f}% saved, {report['n_batches']} batches"
+          + (f", last connectome change {change:.4g}" if change is not None else "") + ")")
+    if out_dir is not None:
+        path = os.path.join(out_dir, "seeding_report.json")
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Voxel → streamline inverted index for ROI queries and virtual dissection.
+
+The index is built once per tractogram (tracking with ``spatial_index=True``)
+and stored beside it as ``streamlines_index/`` (memory-mappable ``.npy``
+files):
+
+* ``indptr`` (n_voxels + 1,) and ``indices`` – CSR rows, one per voxel of the
+  tracking grid (C order); ``indices[indptr[v]:indptr[v + 1]]`` are the
+  sorted ids of the streamlines passing through voxel ``v``;
+* ``endpoints`` (n_streamlines, 2) – linear voxel index of both ends
+  (-1 outside the grid).
+
+ROI queries are then gathers and integer set operations; no streamline
+point is read.
+
+Usage
+-----
+>>> python spatial_index.py <index_dir> <atlas_in_dwi.nii.gz> --include 87 --end 112 \\
+...     [--exclude 3 4] [--trk streamlines.trk --out bundle.trk]
+"""
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+if __package__ is None or __package__ == "":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from flat_tractogram import flatten_streamlines, streamline_ids, endpoint_indices, world_to_voxel
+else:
+    from .flat_tractogram import flatten_streamlines, streamline_ids, endpoint_indices, world_to_voxel
+
+
+INDEX_DIR_NAME = "streamlines_index"
+
+
+def linear_voxels(points, affine, shape):
+    """C-order linear voxel index of world-space ``points`` (-1 outside the grid)."""
+    voxels = world_to_voxel(points, affine)
+    i, j, k = voxels[:, 0], voxels[:, 1], voxels[:, 2]
+    linear = (i * shape[1] + j) * shape[2] + k
+    outside = (i < 0) | (i >= shape[0]) | (j < 0) | (j >= shape[1]) | (k < 0) | (k >= shape[2])
+    linear[outside] = -1
+    return linear.astype(np.int64, copy=False)
+
+
+def unique_visits(linear, ids, n_streamlines):
+    """
+    Distinct (voxel, streamline) pairs of a flat buffer, sorted by voxel then id.
+
+    A streamline is counted once per voxel however many of its points fall
+    there; points outside the grid (``linear == -1``) are dropped.
+    """
+    # consecutive points mostly fall in the same voxel: drop those repeats before sorting
+    keep = linear >= 0
+    keep[1:] &= (linear[1:] != linear[:-1]) | (ids[1:] != ids[:-1])
+    n = max(int(n_streamlines), 1)
+    keys = linear[keep] * n + ids[keep]
+    keys.sort()
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
+    return np.divmod(keys, n)
+
+
+class StreamlineIndex:
+    """
+    CSR voxel → streamline-id index of one tractogram.
+
+    Attributes
+    ----------
+    indptr : np.ndarray
+        (n_voxels + 1,) int64 row pointers.
+    indices : np.ndarray
+        uint32 streamline ids, sorted within every voxel.
+    endpoints : np.ndarray
+        (n_streamlines, 2) int64 linear voxel index of both ends.
+    affine : np.ndarray
+        Voxel-to-world affine of the grid.
+    shape : tuple
+        Grid shape.
+    """
+
+    def __init__(self, indptr, indices, endpoints, affine, shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.endpoints = endpoints
+        self.affine = np.asarray(affine, dtype=np.float64)
+        self.shape = tuple(int(s) for s in shape[:3])
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def _voxels(self, roi):
+        roi = np.asarray(roi)
+        if roi.dtype == bool:
+            if roi.shape != self.shape:
+                raise ValueError(f"ROI mask shape {roi.shape} does not match the index grid {self.shape}")
+            return np.flatnonzero(roi.ravel())
+        return roi.astype(np.int64).ravel()
+
+    def traversing(self, roi):
+        """
+        Ids of the streamlines passing through ``roi``.
+
+        ``roi`` is a boolean mask on the grid or an array of linear voxel
+        indices. Returns a sorted unique int64 array.
+        """
+        voxels = self._voxels(roi)
+        starts, stops = self.indptr[voxels], self.indptr[voxels + 1]
+        sizes = stops - starts
+        total = int(sizes.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64)
+        # positions starts[k] .. stops[k] - 1 for every voxel, without a Python loop
+        keep = sizes > 0
+        starts, sizes = starts[keep], sizes[keep]
+        steps = np.ones(total, dtype=np.int64)
+        steps[0] = starts[0]
+        first = np.cumsum(sizes)[:-1]
+        steps[first] = starts[1:] - (starts[:-1] + sizes[:-1] - 1)
+        return np.unique(np.asarray(self.indices)[np.cumsum(steps)].astype(np.int64))
+
+    def ending_in(self, roi, both=False):
+        """Ids of the streamlines with one (or ``both``) endpoints in ``roi``."""
+        member = np.zeros(int(np.prod(self.shape)) + 1, dtype=bool)   # last slot: outside (-1)
+        member[self._voxels(roi)] = True
+        hits = member[np.asarray(self.endpoints)]
+        return np.flatnonzero(hits.all(axis=1) if both else hits.any(axis=1))
+
+    def query(self, atlas, include=(), exclude=(), end=(), end_both=False):
+        """
+        Virtual dissection over atlas labels.
+
+        Parameters
+        ----------
+        atlas : np.ndarray
+            Label volume on the index grid (e.g. the atlas in DWI space).
+        include : iterable of int
+            Labels every selected streamline must pass through.
+        exclude : iterable of int
+            Labels no selected streamline may touch.
+        end : iterable of int
+            Labels the streamline must end in (any of them).
+        end_both : bool
+            Require both endpoints in ``end`` instead of one.
+
+        Returns
+        -------
+        np.ndarray
+            Sorted streamline ids.
+        """
+        atlas = np.asarray(atlas)
+        if atlas.shape != self.shape:
+            raise ValueError(f"Atlas shape {atlas.shape} does not match the index grid {self.shape}")
+        flat = atlas.ravel()
+        selected = np.arange(len(self), dtype=np.int64)
+        for label in include:
+            selected = np.intersect1d(selected, self.traversing(np.flatnonzero(flat == label)),
+                                      assume_unique=True)
+        if len(end):
+            selected = np.intersect1d(selected, self.ending_in(np.flatnonzero(np.isin(flat, end)),
+                                                               both=end_both), assume_unique=True)
+        if len(exclude):
+            selected = np.setdiff1d(selected, self.traversing(np.flatnonzero(np.isin(flat, exclude))),
+                                    assume_unique=True)
+        return selected
+
+
+def build_index(streamlines, affine, shape):
+    """
+    Build the ``StreamlineIndex`` of ``streamlines`` from the flat point buffer.
+
+    Parameters
+    ----------
+    streamlines : Streamlines, FlatTractogram or sequence of arrays
+        World-space streamlines.
+    affine : np.ndarray
+        Voxel-to-world affine of the tracking grid.
+    shape : tuple
+        Shape of the tracking grid.
+    """
+    shape = tuple(int(s) for s in shape[:3])
+    points, offsets = flatten_streamlines(streamlines)
+    linear = linear_voxels(points, affine, shape)
+    ids = streamline_ids(offsets)
+    ends = endpoint_indices(offsets)                     # -1 for empty streamlines
+    endpoints = np.where(ends >= 0, linear[ends] if len(linear) else -1, -1)
+    vox, sl = unique_visits(linear, ids, len(offsets) - 1)
+
+    indptr = np.zeros(int(np.prod(shape)) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(vox, minlength=int(np.prod(shape))), out=indptr[1:])
+    return StreamlineIndex(indptr, sl.astype(np.uint32), endpoints.astype(np.int64), affine, shape)
+
+
+def save_index(out_dir, index, dir_name=INDEX_DIR_NAME):
+    """Write ``index`` as ``.npy`` files plus ``meta.json``; return the directory."""
+    path = os.path.join(out_dir, dir_name)
+    os.makedirs(path, exist_ok=True)
+    for name in ("indptr", "indices", "endpoints"):
+        np.save(os.path.join(path, f"{name}.npy"), getattr(index, name))
+    meta = {
+        "affine": index.affine.tolist(),
+        "shape": list(index.shape),
+        "n_streamlines": len(index),
+        "n_entries": int(len(index.indices)),
+        "order": "C",
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return path
+
+
+def load_index(path, mmap=True):
+    """Load an index written by ``save_index`` (memory-mapped by default)."""
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    mode = "r" if mmap else None
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode)
+              for name in ("indptr", "indices", "endpoints")}
+    return StreamlineIndex(arrays["indptr"], arrays["indices"], arrays["endpoints"],
+                           meta["affine"], meta["shape"])
+
+
+def main(argv=None):
+    from dipy.io.image import load_nifti
+    from dipy.io.streamline import load_trk, save_trk
+
+    parser = argparse.ArgumentParser(description="Select streamlines by atlas ROIs using the voxel index")
+    parser.add_argument("index", help="streamlines_index/ directory")
+    parser.add_argument("atlas", help="Atlas in DWI space (same grid as the tracking)")
+    parser.add_argument("--include", type=int, nargs="*", default=[], help="Labels to pass through")
+    parser.add_argument("--exclude", type=int, nargs="*", default=[], help="Labels to avoid")
+    parser.add_argument("--end", type=int, nargs="*", default=[], help="Labels to end in")
+    parser.add_argument("--end_both", action="store_true", help="Both endpoints in --end labels")
+    parser.add_argument("--trk", default=None, help="Tractogram to extract the selection from")
+    parser.add_argument("--out", default=None, help="Output .trk (needs --trk) or .txt of ids")
+    args = parser.parse_args(argv)
+
+    index = load_index(args.index)
+    atlas = np.rint(load_nifti(args.atlas)[0]).astype(np.int64)
+    selected = index.query(atlas, include=args.include, exclude=args.exclude,
+                           end=args.end, end_both=args.end_both)
+    print(f"{len(selected)} of {len(index)} streamlines selected")
+
+    if args.out and args.trk:
+        sft = load_trk(args.trk, "same", bbox_valid_check=False)
+        save_trk(sft[selected], args.out, bbox_valid_check=False)
+        print(f"Selection saved to: {args.out}")
+    elif args.out:
+        np.savetxt(args.out, selected, fmt="%d")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (FileNotFoundError, ValueError) as exc:
+        sys.exit(str(exc))
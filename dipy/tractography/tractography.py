@@ -2,25 +2,106 @@ import os
 import sys
 import numpy as np
 
-from dipy.io.image import load_nifti
-from dipy.core.gradients import gradient_table
-from dipy.reconst.dti import TensorModel
-from dipy.tracking.local_tracking import LocalTracking
-from dipy.tracking.streamline import Streamlines
-from dipy.tracking.stopping_criterion import BinaryStoppingCriterion
-from dipy.tracking.utils import seeds_from_mask
-from dipy.io.streamline import save_trk
 
 # Resolve relative imports when executed outside a package
 if __package__ is None or __package__ == "":
     current_dir = os.path.dirname(os.path.abspath(__file__))
     sys.path.insert(0, current_dir)
-    from connectivity import CustomTensorDirectionGetter, connectivity_from_streamlines
+    from connectivity import tensor_direction_getter, connectivity_from_streamlines
+    from flat_tractogram import save_flat_tractogram
+    from seeding import adaptive_seeds, adaptive_tracking, finalize_report
+    from reparcellate import save_endpoints
+    from spatial_index import build_index, save_index
 else:
-    from .connectivity import CustomTensorDirectionGetter, connectivity_from_streamlines
+    from .connectivity import tensor_direction_getter, connectivity_from_streamlines
+    from .flat_tractogram import save_flat_tractogram
+    from .seeding import adaptive_seeds, adaptive_tracking, finalize_report
+    from .reparcellate import save_endpoints
+    from .spatial_index import build_index, save_index
 
 
-def deterministic_tractography( dwi_file, mask_file, bval_file, bvec_file, out_dir, step_size=0.5, fa_threshold=0.2):
+def save_tractogram(out_dir, streamlines, affine, shape, out_format="trk", coord_dtype="float32",
+                    compress_tol=None, atlas_file=None, spatial_index=False):
+    """
+    Save tracking outputs: the tractogram, the endpoint table and, with
+    ``spatial_index``, the voxel index.
+
+    See ``deterministic_tractography`` for ``out_format``, ``coord_dtype``,
+    ``compress_tol`` and ``atlas_file``. Returns the path of the saved
+    tractogram (the ``.trk`` file unless ``out_format="flat"``).
+    """
+    import nibabel as nib
+    from dipy.io.image import load_nifti
+    from dipy.io.streamline import save_trk
+    from dipy.io.stateful_tractogram import StatefulTractogram, Space
+
+    if out_format not in ("trk", "flat", "both"):
+        raise ValueError(f"Unknown tractogram format: {out_format}")
+    shape = tuple(int(s) for s in shape[:3])
+
+    tract_file = None
+    if out_format in ("trk", "both"):
+        tract_file = os.path.join(out_dir, "streamlines.trk")
+        voxel_sizes = np.sqrt(np.sum(np.asarray(affine)[:3, :3] ** 2, axis=0))
+        reference = (affine, np.array(shape), voxel_sizes, "".join(nib.aff2axcodes(affine)))
+        save_trk(StatefulTractogram(streamlines, reference, Space.RASMM), tract_file, bbox_valid_check=False)
+        print(f"Streamlines saved to: {tract_file}")
+    if out_format in ("flat", "both"):
+        labels = load_nifti(atlas_file)[0].astype(np.int32) if atlas_file else None
+        flat_dir = save_flat_tractogram(out_dir, streamlines, affine, shape, dtype=coord_dtype,
+                                        compress_tol=compress_tol, labels=labels)
+        print(f"Flat streamlines saved to: {flat_dir}")
+        tract_file = tract_file or flat_dir
+    endpoints_file = save_endpoints(out_dir, streamlines, affine, shape)
+    print(f"Endpoint table saved to: {endpoints_file}")
+    if spatial_index:
+        index_dir = save_index(out_dir, build_index(streamlines, affine, shape))
+        print(f"Streamline index saved to: {index_dir}")
+    return tract_file
+
+
+def deterministic_tractography( dwi_file, mask_file, bval_file, bvec_file, out_dir, step_size=0.5, fa_threshold=0.2,
+                               out_format="trk", coord_dtype="float32", compress_tol=None, atlas_file=None,
+                               seeding="mask", seed_budget=None, batch_size=5000, convergence_tol=None,
+                               random_seed=None, spatial_index=False):
+    """
+    Deterministic tensor tractography.
+
+    With ``seeding="mask"`` every mask voxel is seeded. ``seeding="adaptive"``
+    seeds only voxels above ``fa_threshold``, in shuffled batches of
+    ``batch_size`` up to ``seed_budget`` seeds, and stops early once the
+    connectome over ``atlas_file`` changes less than ``convergence_tol``
+    between batches (see ``seeding.adaptive_tracking``). The seeding report
+    is saved as ``seeding_report.json``.
+
+    ``out_format`` selects the saved tractogram: ``"trk"`` (``streamlines.trk``),
+    ``"flat"`` (memory-mappable ``streamlines_flat/``, see ``flat_tractogram``)
+    or ``"both"``. The flat output stores ``coord_dtype`` coordinates, is
+    linearized within ``compress_tol`` mm if given, and carries per-streamline
+    lengths plus endpoint labels when ``atlas_file`` (in DWI space) is given.
+
+    The voxel coordinates of both ends of every streamline are always saved
+    as ``endpoints.npz``, so ``reparcellate.py`` can rebuild the connectome
+    for another DWI-space atlas without re-tracking. With ``spatial_index=True``
+    a voxel → streamline index (``streamlines_index/``, see ``spatial_index``)
+    is saved as well for ROI queries; it is off by default because it costs
+    a pass over every point and is as large as the tractogram itself.
+
+    Returns the in-memory streamlines, the affine and the path of the saved
+    tractogram (the ``.trk`` file unless ``out_format="flat"``).
+    """
+    from dipy.io.image import load_nifti
+    from dipy.core.gradients import gradient_table
+    from dipy.reconst.dti import TensorModel
+    from dipy.tracking.local_tracking import LocalTracking
+    from dipy.tracking.streamline import Streamlines
+    from dipy.tracking.stopping_criterion import BinaryStoppingCriterion
+    from dipy.tracking.utils import seeds_from_mask
+
+    if out_format not in ("trk", "flat", "both"):
+        raise ValueError(f"Unknown tractogram format: {out_format}")
+    if seeding not in ("mask", "adaptive"):
+        raise ValueError(f"Unknown seeding strategy: {seeding}")
 
     os.makedirs(out_dir, exist_ok=True)
 
@@ -38,23 +119,33 @@ def deterministic_tractography( dwi_file, mask_file, bval_file, bvec_file, out_d
     ten_fit = ten_model.fit(dwi, mask=mask)
     fa = ten_fit.fa
 
-    seeds = seeds_from_mask(mask, density=1, affine=affine)
     stopping_criterion = BinaryStoppingCriterion(fa > fa_threshold)
-    principal_dirs = np.asarray(ten_fit.evecs[..., 0], dtype=np.float64)
-    principal_dirs = np.ascontiguousarray(principal_dirs)
-    direction_getter = CustomTensorDirectionGetter(principal_dirs, mask)
+    direction_getter = tensor_direction_getter(ten_fit.evecs, mask)
 
-    streamlines_generator = LocalTracking( direction_getter, stopping_criterion, seeds, affine, step_size=step_size)
-    streamlines = Streamlines(streamlines_generator)
+    if seeding == "adaptive":
+        atlas = load_nifti(atlas_file)[0].astype(np.int32) if atlas_file else None
+        seeds, n_mask_seeds = adaptive_seeds(mask, fa, affine, fa_threshold=fa_threshold)
+        streamlines, _, report = adaptive_tracking(
+            lambda batch: LocalTracking(direction_getter, stopping_criterion, batch, affine, step_size=step_size),
+            seeds, atlas=atlas, affine=affine, seed_budget=seed_budget, batch_size=batch_size,
+            convergence_tol=convergence_tol, random_seed=random_seed,
+        )
+        finalize_report(report, n_mask_seeds, out_dir)
+    else:
+        seeds = seeds_from_mask(mask, density=1, affine=affine)
+        streamlines_generator = LocalTracking( direction_getter, stopping_criterion, seeds, affine, step_size=step_size)
+        streamlines = Streamlines(streamlines_generator)
 
-    tract_file = os.path.join(out_dir, "streamlines.trk")
-    save_trk(tract_file, streamlines, affine, dwi.shape[:3])
-    print(f"Streamlines saved to: {tract_file}")
+    tract_file = save_tractogram(out_dir, streamlines, affine, dwi.shape[:3], out_format=out_format,
+                                 coord_dtype=coord_dtype, compress_tol=compress_tol, atlas_file=atlas_file,
+                                 spatial_index=spatial_index)
 
     return streamlines, affine, tract_file
 
 
-def tractography_connectivity( dwi_file, mask_file, atlas_file, bval_file, bvec_file, out_dir, step_size=0.5, fa_threshold=0.2):
+def tractography_connectivity( dwi_file, mask_file, atlas_file, bval_file, bvec_file, out_dir, step_size=0.5, fa_threshold=0.2,
+                               **tracking_kwargs):
     
-    streamlines, affine, _ = deterministic_tractography( dwi_file, mask_file, bval_file, bvec_file, out_dir, step_size=step_size, fa_threshold=fa_threshold)
+    streamlines, affine, _ = deterministic_tractography( dwi_file, mask_file, bval_file, bvec_file, out_dir, step_size=step_size, fa_threshold=fa_threshold,
+                                                         atlas_file=atlas_file, **tracking_kwargs)
     return connectivity_from_streamlines(streamlines, atlas_file, affine, out_dir)
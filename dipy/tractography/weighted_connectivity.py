@@ -0,0 +1,167 @@
+import os
+import numpy as np
+
+if __package__ is None or __package__ == "":
+    from flat_tractogram import (flatten_streamlines, streamline_ids, streamline_lengths,
+                                 endpoint_voxels, check_endpoints_inside, world_to_voxel,
+                                 label_lookup)
+    from density import iter_chunks
+else:
+    from .flat_tractogram import (flatten_streamlines, streamline_ids, streamline_lengths,
+                                  endpoint_voxels, check_endpoints_inside, world_to_voxel,
+                                  label_lookup)
+    from .density import iter_chunks
+
+
+def sample_along_streamlines(points, offsets, affine, volumes, chunk_size=100000):
+    """
+    Mean of every map in ``volumes`` over the points of every streamline.
+
+    Points are transformed to voxels one block of ``chunk_size`` streamlines
+    at a time, so the temporary voxel array stays bounded and a
+    memory-mapped tractogram is read once for all maps.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        (N, 3) world-space points (flat buffer).
+    offsets : np.ndarray
+        (n_streamlines + 1,) offsets into ``points``.
+    affine : np.ndarray
+        Voxel-to-world affine of the maps.
+    volumes : dict
+        Name -> 3D scalar map (e.g. FA or MD) on the voxel grid.
+    chunk_size : int or None
+        Streamlines per block (None: all at once).
+
+    Returns
+    -------
+    dict of np.ndarray
+        Name -> (n_streamlines,) mean value; points outside the volume are
+        ignored and streamlines without any point inside get 0.
+    """
+    n = len(offsets) - 1
+    volumes = {name: np.nan_to_num(np.asarray(v, dtype=np.float64)) for name, v in volumes.items()}
+    means = {name: np.zeros(n) for name in volumes}
+    for first, pts, offs in iter_chunks(points, offsets, chunk_size):
+        m = len(offs) - 1
+        ids = streamline_ids(offs)
+        voxels = world_to_voxel(pts, affine)
+        for name, volume in volumes.items():
+            inside = np.all((voxels >= 0) & (voxels < np.asarray(volume.shape[:3])), axis=-1)
+            sums = np.bincount(ids, weights=label_lookup(voxels, volume) * inside, minlength=m)
+            counts = np.bincount(ids, weights=inside.astype(np.float64), minlength=m)
+            np.divide(sums, counts, out=means[name][first:first + m], where=counts > 0)
+    return means
+
+
+def edge_sums(end_labels, n_labels, weights=None, symmetric=True):
+    """
+    Sum ``weights`` per (start, end) label pair, in ``connectivity_matrix`` layout.
+
+    With ``symmetric=True`` the pair is sorted, so every edge is summed in
+    the upper triangle, which is then mirrored to the lower one as DIPY does
+    (``matrix[i, j] == matrix[j, i]``).
+    """
+    a, b = end_labels[:, 0].astype(np.int64), end_labels[:, 1].astype(np.int64)
+    if symmetric:
+        a, b = np.minimum(a, b), np.maximum(a, b)
+    flat = np.bincount(a * n_labels + b, weights=weights, minlength=n_labels * n_labels)
+    matrix = flat.reshape(n_labels, n_labels)
+    if symmetric:
+        matrix = np.triu(matrix) + np.triu(matrix, 1).T
+    return matrix
+
+
+def weighted_connectivity(streamlines, affine, atlas, scalars=None, symmetric=True, chunk_size=100000):
+    """
+    Build several weighted connectomes in one pass over the streamline buffer.
+
+    Endpoint labels and streamline lengths are computed vectorized on the
+    concatenated points/offsets buffer, transforming only the endpoints to
+    voxels; the mean of every scalar map is sampled block by block. Every
+    matrix is then one ``bincount`` over the endpoint pairs.
+
+    Parameters
+    ----------
+    streamlines : Streamlines, FlatTractogram or sequence of arrays
+        World-space streamlines.
+    affine : np.ndarray
+        Voxel-to-world affine of ``atlas`` and the scalar maps.
+    atlas : np.ndarray
+        Non-negative integer label volume in DWI space.
+    scalars : dict or None
+        Name -> 3D map (e.g. ``{"fa": fa, "md": md}``) sampled along the tracts.
+    symmetric : bool
+        Ignore streamline direction (as ``connectivity_matrix`` does).
+    chunk_size : int or None
+        Streamlines per block when sampling ``scalars``.
+
+    Raises
+    ------
+    ValueError
+        If ``atlas`` is not a non-negative integer volume, or a streamline
+        ends outside it.
+
+    Returns
+    -------
+    dict of np.ndarray
+        ``count`` (int64, identical to ``connectivity_matrix``),
+        ``length`` (mean length in mm), ``inverse_length`` (sum of 1/length,
+        i.e. length-normalized counts) and ``<name>`` (mean of each scalar map
+        over the streamlines of the edge). Matrices are
+        ``(atlas.max() + 1, atlas.max() + 1)``.
+    """
+    atlas = np.asarray(atlas)
+    if atlas.dtype.kind not in "iu" or atlas.ndim != 3 or atlas.min() < 0:
+        raise ValueError("atlas must be a 3d integer array with non-negative label values")
+    n_labels = int(atlas.max()) + 1
+
+    points, offsets = flatten_streamlines(streamlines)
+    # empty streamlines have no endpoints and join no edge
+    nonempty = offsets[1:] > offsets[:-1]
+    end_voxels = endpoint_voxels(points, offsets, affine)[nonempty]
+    check_endpoints_inside(end_voxels, atlas.shape)
+    end_labels = label_lookup(end_voxels, atlas)
+    lengths = streamline_lengths(points, offsets)[nonempty]
+
+    count = edge_sums(end_labels, n_labels, symmetric=symmetric)
+    count_safe = np.maximum(count, 1)
+    matrices = {
+        "count": np.rint(count).astype(np.int64),
+        "length": edge_sums(end_labels, n_labels, lengths, symmetric) / count_safe,
+        "inverse_length": edge_sums(end_labels, n_labels,
+                                    np.divide(1.0, lengths, out=np.zeros_like(lengths), where=lengths > 0),
+                                    symmetric),
+    }
+    if scalars:
+        # only the scalar means need every point in voxel space
+        for name, mean_values in sample_along_streamlines(points, offsets, affine, scalars, chunk_size).items():
+            matrices[name] = edge_sums(end_labels, n_labels, mean_values[nonempty], symmetric) / count_safe
+    return matrices
+
+
+def load_scalars(scalar_files):
+    """Load ``{name: path}`` scalar maps; arrays are passed through."""
+    from dipy.io.image import load_nifti
+
+    return {name: load_nifti(v)[0] if isinstance(v, str) else np.asarray(v)
+            for name, v in (scalar_files or {}).items()}
+
+
+def save_weighted_connectivity(matrices, output_dir):
+    """
+    Save every matrix as ``connectivity_<name>.npy``; counts stay ``connectivity.npy``.
+
+    Returns
+    -------
+    dict
+        Name -> saved file.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    files = {}
+    for name, matrix in matrices.items():
+        fname = "connectivity.npy" if name == "count" else f"connectivity_{name}.npy"
+        files[name] = os.path.join(output_dir, fname)
+        np.save(files[name], matrix)
+    return files
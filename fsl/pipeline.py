@@ -0,0 +1,656 @@
+#!/usr/bin/env python3
+"""
+Concurrent FSL pipeline orchestrator
+====================================
+Python replacement for the serial subject loop of ``tract.sh``. The same
+stages (same commands) are modelled as a per-subject dependency graph and
+scheduled across subjects within a core/memory budget. This lets, for
+example, T1/atlas registration run while eddy is busy, or the next
+subject's preprocessing run while bedpostx runs.
+
+Every stage declares its outputs and is skipped when they exist. Stages
+that may legitimately produce nothing (no fieldmap, no eddy QC) leave a
+marker file instead. ``dwi.nii.gz`` and ``dwi_unwarped.nii.gz`` are
+intermediates removed by ``cleanup``; their stages are skipped as long as
+every stage that reads them is up to date, so a re-run of a finished subject
+runs only ``cleanup`` (and ``dot_csv`` when there is no matrix to convert).
+
+T1 and atlas are registered to the eddy-corrected ``nodif_posteddy``, as in
+``tract.sh``. ``--register_to b0`` registers them to the first volume of
+the raw DWI instead (before fugue/topup/eddy), so that registration overlaps
+with eddy. That b0 is on the grid of ``dwi_eddy`` but lacks eddy's motion
+and susceptibility correction: with strong distortion or head motion the
+ROIs can be misaligned with the corrected data.
+
+As in ``tract.sh``, a failing ``eddy_quad`` or ``slicer`` only prints a
+warning; QC never stops a subject. With ``--skip_on_eddy_fail 1`` a subject
+whose eddy fails is dropped and reported as skipped; it does not make the
+run fail. Any other failed stage does (exit status 1).
+
+Every external command is started in its own process group and tracked, so
+Ctrl-C/SIGTERM cancels exactly the children of this run; ``cpulimit`` and the
+pattern matching of ``kill.sh`` are not needed.
+
+Usage
+-----
+>>> python pipeline.py /path/to/dataset --subjects subj_01 subj_02 \
+...                    --cores 8 --mem_gb 24 --matrix_mode 1 --nsamples 5000
+
+``--bin_dir`` makes every FSL tool resolve to ``<bin_dir>/<tool>``, e.g. a
+directory of stub executables for testing the orchestration without FSL.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+DOT_TO_MATRIX = SCRIPT_DIR.parent / "dipy" / "tractography" / "dot_to_matrix.py"
+
+
+class SkipSubject(Exception):
+    """Raised by a stage to drop the rest of its subject (e.g. eddy failed)."""
+
+
+class StageFailed(Exception):
+    """A stage could not produce its outputs."""
+
+
+################################################################################
+# --------------------------  Command execution  ----------------------------- #
+################################################################################
+
+class CommandRunner:
+    """Runs external commands in their own process groups and tracks them.
+
+    Parameters
+    ----------
+    bin_dir : str or None
+        If given, tools resolve to ``bin_dir/<tool>`` instead of ``$PATH``.
+    python : str
+        Interpreter used for the project's Python helpers.
+    """
+
+    def __init__(self, bin_dir=None, python=sys.executable):
+        self.bin_dir = Path(bin_dir).resolve() if bin_dir else None
+        self.python = python
+        self._groups = set()
+        self._lock = threading.Lock()
+        self.cancelled = threading.Event()
+
+    def tool(self, name):
+        return str(self.bin_dir / name) if self.bin_dir else name
+
+    def run(self, cmd, log, check=True, capture=False):
+        """Run ``cmd`` (tool name first), append its output to ``log``."""
+        if self.cancelled.is_set():
+            raise StageFailed("run cancelled")
+        cmd = [self.tool(cmd[0])] + [str(c) for c in cmd[1:]]
+        with open(log, "a") as flog:
+            flog.write(f"$ {' '.join(cmd)}\n")
+            flog.flush()
+            proc = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE if capture else flog,
+                stderr=flog,
+                text=True,
+                start_new_session=True,          # own process group → clean kill
+            )
+            with self._lock:
+                self._groups.add(proc.pid)
+            try:
+                out, _ = proc.communicate()
+            finally:
+                with self._lock:
+                    self._groups.discard(proc.pid)
+        if check and proc.returncode != 0:
+            raise StageFailed(f"{Path(cmd[0]).name} exited with status {proc.returncode}")
+        return out if capture else proc.returncode
+
+    def cancel(self, grace=10.0):
+        """Terminate every running process group, then kill stragglers."""
+        self.cancelled.set()
+        with self._lock:
+            groups = list(self._groups)
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            for pgid in groups:
+                try:
+                    os.killpg(pgid, sig)
+                except ProcessLookupError:
+                    pass
+            deadline = time.time() + grace
+            while sig == signal.SIGTERM and time.time() < deadline:
+                with self._lock:
+                    if not self._groups:
+                        return
+                time.sleep(0.2)
+
+
+################################################################################
+# -------------------------------  Stages  ----------------------------------- #
+################################################################################
+
+class Stage:
+    """One node of the per-subject graph.
+
+    ``outputs`` are checked before running: if they all exist the stage is
+    skipped, mirroring the ``if [[ ! -f ... ]]`` guards of ``tract.sh``. Any
+    of ``markers`` existing also counts as done (the stage ran and had
+    nothing to produce). The outputs of an ``intermediate`` stage may be
+    deleted once consumed; it is then skipped if all its dependants are up
+    to date (see ``Orchestrator.up_to_date``).
+    """
+
+    def __init__(self, name, action, deps=(), outputs=(), markers=(), intermediate=False,
+                 cores=1, mem_gb=1.0, enabled=True):
+        self.name = name
+        self.action = action
+        self.deps = tuple(deps)
+        self.outputs = tuple(outputs)
+        self.markers = tuple(markers)
+        self.intermediate = intermediate
+        self.cores = cores
+        self.mem_gb = mem_gb
+        self.enabled = enabled
+
+    def is_done(self):
+        if any(Path(p).exists() for p in self.markers):
+            return True
+        return bool(self.outputs) and all(Path(p).exists() for p in self.outputs)
+
+
+class Subject:
+    """Paths and run state of one subject (the variables of ``tract.sh``)."""
+
+    def __init__(self, dataset, name, runner, config):
+        self.name = name
+        self.runner = runner
+        self.config = config
+        self.datadir = dataset / name
+        self.outdir = self.datadir / "analyzed_fsl"
+        self.logdir = self.outdir / "logs"
+        self.dwi = self.datadir / "DTI-Mono_noPAT.nii.gz"
+        self.dwi_json = self.datadir / "DTI-Mono_noPAT.json"
+        self.bval = self.datadir / "DTI-Mono_noPAT.bval"
+        self.bvec = self.datadir / "DTI-Mono_noPAT.bvec"
+        self.topup_ap = self.datadir / "ap_b0.nii.gz"
+        self.topup_pa = self.datadir / "pa_b0.nii.gz"
+        self.mag = self.datadir / "gre_field_mapping_2mm_e1.nii.gz"
+        self.phase = self.datadir / "gre_field_mapping_2mm_e2.nii.gz"
+        self.t1 = self.datadir / "t1_mprage_tra.nii.gz"
+        self.atlas = dataset / "atlases" / "BN_Atlas_246_2mm.nii.gz"
+        self.rois_dir = self.outdir / "rois"
+        self.roi_list = self.outdir / "roi_list.txt"
+        self.seed_mask = self.outdir / "seed_mask.nii.gz"
+
+    def o(self, name):
+        return self.outdir / name
+
+    def run(self, stage, *cmd, check=True):
+        return self.runner.run(list(cmd), self.logdir / f"{stage}.log", check=check)
+
+    def output(self, stage, *cmd):
+        return self.runner.run(list(cmd), self.logdir / f"{stage}.log", capture=True)
+
+    def dims(self, stage, image):
+        """``dim1 x dim2 x dim3`` of ``image`` from ``fslhd``."""
+        hdr = dict(ln.split(None, 1) for ln in self.output(stage, "fslhd", image).splitlines()
+                   if ln.strip() and len(ln.split(None, 1)) == 2)
+        return tuple(hdr.get(f"dim{i}", "").strip() for i in (1, 2, 3))
+
+    @property
+    def reg_ref(self):
+        """Reference image of the T1/atlas registrations."""
+        return self.o("nodif_posteddy.nii.gz" if self.config.register_to == "posteddy" else "b0.nii.gz")
+
+    @property
+    def out_mat(self):
+        mode = self.config.matrix_mode
+        name = "fdt_network_matrix" if mode == 1 else f"fdt_matrix{mode}.dot"
+        return self.o("probtrackx") / name
+
+
+def copy_dwi(s):
+    shutil.copy(s.dwi, s.o("dwi.nii.gz"))
+    s.run("copy_dwi", "fslcpgeom", s.dwi, s.o("dwi.nii.gz"))
+    shutil.copy(s.bval, s.o("bvals"))
+    shutil.copy(s.bvec, s.o("bvecs"))
+
+
+def prepare_fieldmap(s):
+    status = s.run("fieldmap", "fsl_prepare_fieldmap", "SIEMENS", s.phase, s.mag,
+                   s.o("fieldmap_rads.nii.gz"), 2.46, "--nocheck", check=False)
+    if status != 0:
+        print(f"[{s.name}] Fieldmap preparation failed, continuing without distortion correction")
+        s.o("fieldmap_failed").touch()
+    else:
+        s.o("fieldmap_failed").unlink(missing_ok=True)
+
+
+def create_b0(s):
+    s.run("b0", "fslroi", s.o("dwi.nii.gz"), s.o("b0"), 0, 1)
+    s.run("b0", "bet", s.o("b0"), s.o("b0_brain"), "-f", 0.3, "-m")
+
+
+def align_fieldmap(s):
+    """Write the fieldmap on the DWI grid to ``fieldmap_dwi.nii.gz``."""
+    fmap = s.o("fieldmap_rads.nii.gz")
+    if not fmap.exists():
+        return
+    if s.dims("fmap_align", s.o("dwi.nii.gz")) != s.dims("fmap_align", fmap):
+        print(f"[{s.name}] Resampling fieldmap to match DWI dimensions...")
+        s.run("fmap_align", "flirt", "-in", fmap, "-ref", s.o("b0"), "-applyxfm", "-usesqform",
+              "-out", s.o("fieldmap_dwi.nii.gz"))
+    else:
+        shutil.copy(fmap, s.o("fieldmap_dwi.nii.gz"))
+
+
+def distortion_correction(s):
+    fieldmap = s.o("fieldmap_dwi.nii.gz")
+    if not fieldmap.exists():
+        print(f"[{s.name}] Fieldmap not available, skipping distortion correction")
+        shutil.copy(s.o("dwi.nii.gz"), s.o("dwi_unwarped.nii.gz"))
+        return
+    dwell = json.loads(s.dwi_json.read_text()).get("EffectiveEchoSpacing", "")
+    status = s.run("fugue", "fugue", "-i", s.o("dwi.nii.gz"), f"--loadfmap={fieldmap}",
+                   "--unwarpdir=z", f"--dwell={dwell}", f"--mask={s.o('b0_brain_mask.nii.gz')}",
+                   "-u", s.o("dwi_unwarped.nii.gz"), check=False)
+    if status != 0:
+        print(f"[{s.name}] FUGUE failed, using original DWI volume")
+        shutil.copy(s.o("dwi.nii.gz"), s.o("dwi_unwarped.nii.gz"))
+
+
+def _dwell_time(s, stage):
+    meta = json.loads(s.dwi_json.read_text())
+    dwell = meta.get("TotalReadoutTime")
+    if dwell is None:
+        dims = s.dims(stage, s.o("dwi.nii.gz"))
+        pe_dim = int(dims[0] if str(meta.get("PhaseEncodingDirection", "j")).startswith("i") else dims[1])
+        dwell = f"{meta['EffectiveEchoSpacing'] * (pe_dim - 1):.8f}"
+    return dwell
+
+
+def eddy_correction(s):
+    cfg = s.config
+    # remembered on disk: a re-run skips eddy but eddy_qc still needs to know
+    s.o("eddy_failed").unlink(missing_ok=True)
+    if s.topup_ap.exists() and s.topup_pa.exists():
+        (s.o("eddy")).mkdir(exist_ok=True)
+        ro = []
+        for img in (s.topup_ap, s.topup_pa):
+            out = str(img)[: -len(".nii.gz")] + "_ro.nii.gz"
+            s.run("eddy", "fslreorient2std", img, out)
+            ro.append(out)
+        if not s.o("topup_fieldmap.nii.gz").exists():
+            s.run("eddy", "fslmerge", "-t", s.o("topup_b0s"), *ro)
+            dwell = _dwell_time(s, "eddy")
+            nvols_topup = int(s.output("eddy", "fslnvols", s.o("topup_b0s")).split()[0])
+            lines = [f"0 -1 0 {dwell}" if v <= nvols_topup // 2 else f"0  1 0 {dwell}"
+                     for v in range(1, nvols_topup + 1)]
+            s.o("acqparams.txt").write_text("\n".join(lines) + "\n")
+            s.run("eddy", "topup", f"--imain={s.o('topup_b0s')}", f"--datain={s.o('acqparams.txt')}",
+                  "--config=b02b0.cnf", f"--out={s.o('topup_results')}",
+                  f"--iout={s.o('topup_corrected_b0')}", f"--fout={s.o('topup_fieldmap')}")
+        nvols = int(s.output("eddy", "fslnvols", s.o("dwi.nii.gz")).split()[0])
+        s.o("index.txt").write_text(" ".join(["1"] * nvols) + "\n")
+        s.run("eddy", "fslroi", s.o("dwi.nii.gz"), s.o("nodif"), 0, 1)
+        s.run("eddy", "bet", s.o("nodif"), s.o("nodif_brain"), "-m", "-f", 0.2)
+        status = s.run("eddy", "eddy", "diffusion",
+                       f"--imain={s.o('dwi.nii.gz')}", f"--mask={s.o('nodif_brain_mask.nii.gz')}",
+                       f"--acqp={s.o('acqparams.txt')}", f"--index={s.o('index.txt')}",
+                       f"--bvecs={s.o('bvecs')}", f"--bvals={s.o('bvals')}",
+                       f"--topup={s.o('topup_results')}", f"--out={s.o('dwi_eddy')}", check=False)
+        if status != 0 or not s.o("dwi_eddy.nii.gz").exists():
+            print(f"[{s.name}] Eddy failed.")
+            if cfg.skip_on_eddy_fail:
+                raise SkipSubject("eddy failed")
+            print(f"[{s.name}] Continuing with unwarped DWI instead.")
+            shutil.copy(s.o("dwi_unwarped.nii.gz"), s.o("dwi_eddy.nii.gz"))
+            s.o("eddy_failed").touch()
+    else:
+        s.run("eddy", "fslroi", s.o("dwi_unwarped.nii.gz"), s.o("nodif"), 0, 1)
+        s.run("eddy", "bet", s.o("nodif"), s.o("nodif_brain"), "-f", 0.3, "-m")
+        s.run("eddy", "eddy_correct", s.o("dwi_unwarped.nii.gz"), s.o("dwi_eddy.nii.gz"), 0)
+
+
+def eddy_qc(s):
+    if s.o("eddy_failed").exists():
+        s.o("eddy_qc_skipped").touch()
+        return
+    if s.o("index.txt").exists() and s.o("acqparams.txt").exists():
+        status = s.run("eddy_qc", "eddy_quad", s.o("dwi_eddy"), "-idx", s.o("index.txt"),
+                       "-par", s.o("acqparams.txt"), "-m", s.o("nodif_brain_mask.nii.gz"),
+                       "-b", s.bval, "-g", s.bvec, "-o", s.o("eddy_qc"), check=False)
+        if status != 0:
+            print(f"[{s.name}] eddy_quad failed, continuing without the QC report")
+    else:
+        print(f"[{s.name}] Skipping eddy_quad QC (index/acqparams not found)")
+        s.o("eddy_qc_skipped").touch()
+
+
+def brain_mask(s):
+    s.run("brain_mask", "fslroi", s.o("dwi_eddy.nii.gz"), s.o("nodif_posteddy"), 0, 1)
+    s.run("brain_mask", "bet", s.o("nodif_posteddy"), s.o("nodif_brain_posteddy"), "-f", 0.3, "-m")
+    shutil.copy(s.o("nodif_brain_posteddy_mask.nii.gz"), s.o("brain_mask.nii.gz"))
+
+
+def tensor_fit(s):
+    s.run("dtifit", "dtifit", "-k", s.o("dwi_eddy.nii.gz"), "-o", s.o("dti"),
+          "-m", s.o("brain_mask.nii.gz"), "-r", s.o("bvecs"), "-b", s.o("bvals"))
+
+
+def register_t1(s):
+    # --register_to b0: on the dwi_eddy grid but not motion/distortion
+    # corrected; see the module docstring
+    s.run("t1_reg", "flirt", "-in", s.t1, "-ref", s.reg_ref, "-out", s.o("t1_in_dwi.nii.gz"),
+          "-omat", s.o("t1_to_dwi.mat"), "-dof", 6)
+
+
+def register_atlas(s):
+    s.run("atlas_reg", "flirt", "-in", s.atlas, "-ref", s.reg_ref,
+          "-out", s.o("atlas_in_dwi.nii.gz"), "-applyxfm", "-usesqform")
+
+
+def roi_masks(s):
+    s.rois_dir.mkdir(exist_ok=True)
+    kept = []
+    for idx in range(1, 247):
+        roi = s.rois_dir / f"roi_{idx}.nii.gz"
+        s.run("rois", "fslmaths", s.o("atlas_in_dwi.nii.gz"), "-thr", idx, "-uthr", idx, "-bin", roi)
+        # keep only non-empty masks (in case some labels are outside FOV)
+        if int(float(s.output("rois", "fslstats", roi, "-V").split()[0])) > 0:
+            kept.append(str(roi))
+        else:
+            roi.unlink(missing_ok=True)
+    s.roi_list.write_text("".join(f"{r}\n" for r in kept))
+
+
+def seed_mask(s):
+    rois = [r for r in s.roi_list.read_text().splitlines() if r.strip()]
+    s.run("seed_mask", "fslmaths", rois[0], "-mul", 0, s.seed_mask)
+    for roi in rois:
+        s.run("seed_mask", "fslmaths", s.seed_mask, "-add", roi, s.seed_mask)
+    s.run("seed_mask", "fslmaths", s.seed_mask, "-bin", s.seed_mask)
+
+
+def bedpostx(s):
+    bpx = Path(f"{s.outdir}.bedpostX")
+    samples = bpx / "merged_th1samples.nii.gz"
+    if samples.exists():
+        print(f"[{s.name}] BedpostX samples already present – skipping")
+        return
+    shutil.rmtree(bpx, ignore_errors=True)
+    for link, target in (("data.nii.gz", "dwi_eddy.nii.gz"), ("nodif_brain_mask.nii.gz", "brain_mask.nii.gz")):
+        s.o(link).unlink(missing_ok=True)
+        s.o(link).symlink_to(s.o(target))
+    (bpx / "logs").mkdir(parents=True, exist_ok=True)
+    s.run("bedpostx", "bedpostx", s.outdir)
+    # bedpostx may hand its last steps to fsl_sub; wait for the samples
+    deadline = time.time() + 60
+    while not samples.exists() and time.time() < deadline:
+        time.sleep(1)
+
+
+def probtrackx(s):
+    cfg = s.config
+    opts = {
+        1: ["--network", f"--seed={s.roi_list}", f"--targetmasks={s.roi_list}"],
+        2: ["--omatrix2", f"--seed={s.roi_list}"],
+        3: ["--os2t", "--omatrix1", f"--seed={s.seed_mask}", f"--targetmasks={s.roi_list}"],
+        4: ["--omatrix3", f"--seed={s.seed_mask}"],
+    }[cfg.matrix_mode]
+    s.o("probtrackx").mkdir(exist_ok=True)
+    s.run("probtrackx", "probtrackx2", f"--samples={s.outdir}.bedpostX/merged",
+          f"--mask={s.o('nodif_brain_mask.nii.gz')}", "--loopcheck", "--forcedir",
+          f"--nsamples={cfg.nsamples}", *opts, "--opd", f"--dir={s.o('probtrackx')}")
+
+
+def dot_to_csv(s):
+    out_mat = s.out_mat
+    if out_mat.exists() and out_mat.suffix == ".dot":
+        s.runner.run([s.runner.python, DOT_TO_MATRIX, out_mat, s.o("connectivity_matrix.csv")],
+                     s.logdir / "dot_csv.log")
+        print(f"[{s.name}] Connectivity matrix saved: {s.o('connectivity_matrix.csv')}")
+    else:
+        print(f"[{s.name}] {out_mat} not found! Skipping Dot-to-CSV...")
+
+
+def quality_control(s):
+    if s.run("qc", "slicer", s.o("dti_FA.nii.gz"), "-a", s.o("qc_fa_slices.png"), check=False) != 0:
+        print(f"[{s.name}] slicer failed, no FA QC image")
+
+
+def cleanup(s):
+    for name in ("data.nii.gz", "dwi_unwarped.nii.gz", "dwi.nii.gz"):
+        s.o(name).unlink(missing_ok=True)
+
+
+def build_stages(s):
+    """The ``tract.sh`` stages of subject ``s`` as a dependency graph."""
+    cfg = s.config
+    tract = bool(cfg.do_tract)
+    reg_dep = "brain_mask" if cfg.register_to == "posteddy" else "b0"
+    return [
+        # dwi.nii.gz and dwi_unwarped.nii.gz are deleted by cleanup
+        Stage("copy_dwi", copy_dwi, outputs=[s.o("dwi.nii.gz"), s.o("bvals"), s.o("bvecs")],
+              intermediate=True),
+        Stage("fieldmap", prepare_fieldmap, outputs=[s.o("fieldmap_rads.nii.gz")],
+              markers=[s.o("fieldmap_failed")]),
+        # tract.sh tests for "$outdir/b0" without extension; check what fslroi writes
+        Stage("b0", create_b0, deps=["copy_dwi"], outputs=[s.o("b0.nii.gz"), s.o("b0_brain_mask.nii.gz")]),
+        Stage("fmap_align", align_fieldmap, deps=["copy_dwi", "fieldmap", "b0"],
+              outputs=[s.o("fieldmap_dwi.nii.gz")], markers=[s.o("fieldmap_failed")]),
+        Stage("fugue", distortion_correction, deps=["copy_dwi", "b0", "fmap_align"],
+              outputs=[s.o("dwi_unwarped.nii.gz")], intermediate=True),
+        Stage("eddy", eddy_correction, deps=["copy_dwi", "fugue"], outputs=[s.o("dwi_eddy.nii.gz")],
+              cores=cfg.eddy_cores, mem_gb=cfg.eddy_mem_gb),
+        Stage("eddy_qc", eddy_qc, deps=["eddy"], outputs=[s.o("eddy_qc")], markers=[s.o("eddy_qc_skipped")]),
+        Stage("brain_mask", brain_mask, deps=["eddy"], outputs=[s.o("brain_mask.nii.gz")]),
+        Stage("dtifit", tensor_fit, deps=["brain_mask"], outputs=[s.o("dti_FA.nii.gz")]),
+        Stage("t1_reg", register_t1, deps=[reg_dep], outputs=[s.o("t1_in_dwi.nii.gz")]),
+        Stage("atlas_reg", register_atlas, deps=[reg_dep], outputs=[s.o("atlas_in_dwi.nii.gz")]),
+        Stage("rois", roi_masks, deps=["atlas_reg"], outputs=[s.roi_list, s.rois_dir]),
+        Stage("seed_mask", seed_mask, deps=["rois"], outputs=[s.seed_mask]),
+        Stage("bedpostx", bedpostx, deps=["brain_mask"], enabled=tract,
+              outputs=[Path(f"{s.outdir}.bedpostX") / "merged_th1samples.nii.gz"],
+              cores=cfg.bedpostx_cores, mem_gb=cfg.bedpostx_mem_gb),
+        Stage("probtrackx", probtrackx, deps=["bedpostx", "seed_mask"], enabled=tract,
+              outputs=[s.out_mat, s.o("probtrackx") / "fdt_paths.nii.gz"],
+              mem_gb=cfg.probtrackx_mem_gb),
+        Stage("dot_csv", dot_to_csv, deps=["probtrackx"] if tract else ["seed_mask"],
+              outputs=[s.o("connectivity_matrix.csv")]),
+        Stage("qc", quality_control, deps=["dtifit"], outputs=[s.o("qc_fa_slices.png")]),
+        # no outputs: runs every time, deleting the intermediates
+        Stage("cleanup", cleanup,
+              deps=["eddy_qc", "dtifit", "t1_reg", "dot_csv", "qc"] + (["probtrackx"] if tract else [])),
+    ]
+
+
+################################################################################
+# ------------------------------  Scheduler  --------------------------------- #
+################################################################################
+
+class Orchestrator:
+    """Runs the stage graphs of several subjects within a resource budget.
+
+    Ready stages are started in subject order (then stage order) whenever
+    enough cores and memory are free, so the earliest subject finishes first
+    and spare capacity goes to the following ones. A stage that fails blocks
+    its dependants; ``SkipSubject`` drops the remaining stages of the subject
+    (status ``dropped``, not a failure).
+    """
+
+    def __init__(self, subjects, cores, mem_gb, runner):
+        self.subjects = subjects
+        self.cores = cores
+        self.mem_gb = mem_gb
+        self.runner = runner
+        self.graphs = {}
+        for s in subjects:
+            stages = [st for st in build_stages(s) if st.enabled]
+            names = {st.name for st in stages}
+            for st in stages:
+                st.deps = tuple(d for d in st.deps if d in names)
+            self.graphs[s.name] = {st.name: st for st in stages}
+        self.dependants = {
+            subj: {name: [st for st in graph.values() if name in st.deps] for name in graph}
+            for subj, graph in self.graphs.items()
+        }
+        self.status = {(s.name, st): "pending" for s in subjects for st in self.graphs[s.name]}
+        self._cond = threading.Condition()
+        self._free_cores = cores
+        self._free_mem = mem_gb
+
+    def up_to_date(self, subject, stage):
+        """True if ``stage`` need not run: its outputs exist, or it is an
+        intermediate stage whose dependants are all up to date."""
+        if stage.is_done():
+            return True
+        dependants = self.dependants[subject.name][stage.name]
+        return (stage.intermediate and bool(dependants)
+                and all(self.up_to_date(subject, d) for d in dependants))
+
+    def _ready(self):
+        for s in self.subjects:
+            for name, stage in self.graphs[s.name].items():
+                if self.status[(s.name, name)] != "pending":
+                    continue
+                dep_status = [self.status[(s.name, d)] for d in stage.deps]
+                if any(st in ("failed", "blocked", "cancelled", "dropped") for st in dep_status):
+                    self.status[(s.name, name)] = "blocked"
+                    continue
+                if all(st in ("done", "skipped") for st in dep_status):
+                    yield s, stage
+
+    def _execute(self, subject, stage, cores, mem_gb):
+        key = (subject.name, stage.name)
+        try:
+            if self.up_to_date(subject, stage):
+                result = "skipped"
+                print(f"[{subject.name}] ✔️ {stage.name}")
+            else:
+                print(f"[{subject.name}] ▶ {stage.name} ({time.strftime('%H:%M:%S')})")
+                stage.action(subject)
+                result = "done"
+        except SkipSubject as exc:
+            print(f"[{subject.name}] Skipping subject: {exc}")
+            result = "dropped"
+            with self._cond:
+                for other in self.graphs[subject.name]:
+                    if self.status[(subject.name, other)] == "pending":
+                        self.status[(subject.name, other)] = "dropped"
+        except Exception as exc:
+            print(f"[{subject.name}] ❌ {stage.name}: {exc} (log: {subject.logdir / stage.name}.log)")
+            result = "failed"
+        with self._cond:
+            self.status[key] = result
+            self._free_cores += cores
+            self._free_mem += mem_gb
+            self._cond.notify_all()
+
+    def run(self):
+        for s in self.subjects:
+            s.logdir.mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(1, self.cores)) as pool:
+            with self._cond:
+                while True:
+                    if self.runner.cancelled.is_set():
+                        for key, st in self.status.items():
+                            if st == "pending":
+                                self.status[key] = "cancelled"
+                    for subject, stage in list(self._ready()):
+                        cores = min(stage.cores, self.cores)
+                        mem_gb = min(stage.mem_gb, self.mem_gb)
+                        if cores > self._free_cores or mem_gb > self._free_mem:
+                            continue
+                        self._free_cores -= cores
+                        self._free_mem -= mem_gb
+                        self.status[(subject.name, stage.name)] = "running"
+                        pool.submit(self._execute, subject, stage, cores, mem_gb)
+                    states = set(self.status.values())
+                    if not states & {"pending", "running"}:
+                        break
+                    self._cond.wait(timeout=1.0)
+        return self.summary()
+
+    def summary(self):
+        """``{subject: {stage: status}}`` after the run."""
+        out = {}
+        for (subj, stage), st in self.status.items():
+            out.setdefault(subj, {})[stage] = st
+        return out
+
+
+################################################################################
+# ---------------------------  Argument parsing  ----------------------------- #
+################################################################################
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent multi-subject FSL diffusion pipeline")
+    parser.add_argument("dataset", type=Path, help="Dataset directory with subject folders and atlases/")
+    parser.add_argument("--subjects", nargs="*", default=None, help="Subjects to process; defaults to all folders")
+    parser.add_argument("--skip_on_eddy_fail", type=int, default=0, help="1 = skip subject if eddy fails")
+    parser.add_argument("--do_tract", type=int, default=1, help="1 = run bedpostx/probtrackx2")
+    parser.add_argument("--matrix_mode", type=int, choices=[1, 2, 3, 4], default=1)
+    parser.add_argument("--nsamples", type=int, default=5000)
+    parser.add_argument("--register_to", choices=["posteddy", "b0"], default="posteddy",
+                        help="T1/atlas registration reference: the eddy-corrected b0 of tract.sh "
+                             "(default) or the raw b0 (overlaps with eddy, may misalign the ROIs)")
+    parser.add_argument("--cores", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Core budget (default: half of the machine, like the cpulimit wrapper)")
+    parser.add_argument("--mem_gb", type=float, default=16.0, help="Memory budget in GB")
+    parser.add_argument("--eddy_cores", type=int, default=1)
+    parser.add_argument("--eddy_mem_gb", type=float, default=6.0)
+    parser.add_argument("--bedpostx_cores", type=int, default=1)
+    parser.add_argument("--bedpostx_mem_gb", type=float, default=4.0)
+    parser.add_argument("--probtrackx_mem_gb", type=float, default=4.0)
+    parser.add_argument("--bin_dir", default=None, help="Resolve FSL tools in this directory (e.g. stubs)")
+    parser.add_argument("--python", default=sys.executable, help="Interpreter for the Python helpers")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    dataset = args.dataset.resolve()
+    names = args.subjects or sorted(p.name for p in dataset.iterdir()
+                                    if p.is_dir() and p.name != "atlases")
+    runner = CommandRunner(bin_dir=args.bin_dir, python=args.python)
+    subjects = []
+    for name in names:
+        s = Subject(dataset, name, runner, args)
+        s.outdir.mkdir(parents=True, exist_ok=True)
+        subjects.append(s)
+
+    def _cancel(signum, _frame):
+        print(f"Received signal {signum}, cancelling running stages...")
+        threading.Thread(target=runner.cancel, daemon=True).start()
+
+    signal.signal(signal.SIGINT, _cancel)
+    signal.signal(signal.SIGTERM, _cancel)
+
+    print(f"FSL run started @ {time.strftime('%Y-%m-%d %H:%M:%S')} "
+          f"({len(subjects)} subjects, {args.cores} cores, {args.mem_gb:g} GB)")
+    summary = Orchestrator(subjects, args.cores, args.mem_gb, runner).run()
+
+    failed = False
+    for subj, stages in summary.items():
+        bad = {k: v for k, v in stages.items() if v in ("failed", "blocked", "cancelled")}
+        failed |= bool(bad)
+        if not bad and "dropped" in stages.values():      # --skip_on_eddy_fail
+            print(f"⏭️ {subj}: skipped")
+            continue
+        print(f"{'✅' if not bad else '⚠️'} {subj}" + (f": {bad}" if bad else ""))
+    print(f"FSL pipeline complete @ {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
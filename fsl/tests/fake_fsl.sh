@@ -0,0 +1,64 @@
+#!/usr/bin/env bash
+# Stand-in for the FSL tools called by pipeline.py, used to test the
+# orchestration without FSL. Symlink it under each tool name into a
+# directory and pass that as --bin_dir; the name it is called by selects the
+# tool. Every tool writes the files the pipeline checks for (contents are
+# placeholders) and nothing else.
+#
+#   FAKE_FSL_LOG   append "<tool> <args>" per call to this file
+#   FAKE_FSL_FAIL  space-separated "<tool>:<pattern>" rules; the tool exits 1
+#                  when its arguments contain <pattern> (e.g. "eddy:subj_02")
+#
+# Only labels 1-3 of the atlas are non-empty, so a subject gets three ROIs.
+
+tool=$(basename "$0")
+[[ -n $FAKE_FSL_LOG ]] && echo "$tool $*" >> "$FAKE_FSL_LOG"
+for rule in $FAKE_FSL_FAIL; do
+    [[ $tool == "${rule%%:*}" && "$*" == *"${rule#*:}"* ]] && exit 1
+done
+
+image() {       # FSL appends .nii.gz to image names given without extension
+    case $1 in *.nii.gz|*.nii) echo "$1" ;; *) echo "$1.nii.gz" ;; esac
+}
+write() { mkdir -p "$(dirname "$1")" && echo placeholder > "$1"; }
+after() {       # value following option $1
+    local key=$1; shift
+    while (($#)); do [[ $1 == "$key" ]] && { echo "$2"; return; }; shift; done
+}
+value() {       # value of --option=value
+    local key=$1; shift
+    for arg; do [[ $arg == "$key"* ]] && { echo "${arg#"$key"}"; return; }; done
+}
+
+case $tool in
+    fslcpgeom) ;;
+    fslhd) printf 'dim1\t10\ndim2\t10\ndim3\t5\n' ;;
+    fslnvols) echo 4 ;;
+    fslstats)
+        [[ $1 =~ roi_([0-9]+) ]] && ((BASH_REMATCH[1] <= 3)) && echo "8 64" || echo "0 0" ;;
+    fslroi|fslreorient2std|eddy_correct) write "$(image "$2")" ;;
+    fslmerge) write "$(image "$2")" ;;
+    fslmaths) write "$(image "${@: -1}")" ;;
+    bet) write "$(image "$2")"; write "$(image "${2%.nii.gz}_mask")" ;;
+    fsl_prepare_fieldmap) [[ -f $2 && -f $3 ]] || exit 1; write "$(image "$4")" ;;
+    flirt)
+        write "$(image "$(after -out "$@")")"
+        omat=$(after -omat "$@")
+        if [[ -n $omat ]]; then write "$omat"; fi ;;
+    fugue) write "$(image "$(after -u "$@")")" ;;
+    topup) write "$(image "$(value --fout= "$@")")" ;;
+    eddy) write "$(image "$(value --out= "$@")")" ;;
+    eddy_quad) mkdir -p "$(after -o "$@")" ;;
+    dtifit) write "$(after -o "$@")_FA.nii.gz" ;;
+    slicer) write "${@: -1}" ;;
+    bedpostx) write "$1.bedpostX/merged_th1samples.nii.gz" ;;
+    probtrackx2)
+        dir=$(value --dir= "$@")
+        mkdir -p "$dir"
+        write "$dir/fdt_paths.nii.gz"
+        for mode in 1 2 3; do
+            if [[ " $* " == *" --omatrix$mode "* ]]; then printf '1 1 5\n1 2 3\n2 3 1\n' > "$dir/fdt_matrix$mode.dot"; fi
+        done
+        if [[ " $* " == *" --network "* ]]; then printf '0 5 3\n5 0 1\n3 1 0\n' > "$dir/fdt_network_matrix"; fi ;;
+    *) echo "fake_fsl.sh: unknown tool $tool" >&2; exit 1 ;;
+esac
@@ -0,0 +1,123 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+FSL_DIR = Path(__file__).resolve().parents[1]
+PIPELINE = FSL_DIR / "pipeline.py"
+FAKE_FSL = Path(__file__).resolve().parent / "fake_fsl.sh"
+TOOLS = ["bedpostx", "bet", "dtifit", "eddy", "eddy_correct", "eddy_quad", "flirt", "fsl_prepare_fieldmap",
+         "fslcpgeom", "fslhd", "fslmaths", "fslmerge", "fslnvols", "fslreorient2std", "fslroi", "fslstats",
+         "fugue", "probtrackx2", "slicer", "topup"]
+SUBJECTS = ["subj_01", "subj_02"]
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    """Two subjects with topup b0s (so eddy runs) and no fieldmap."""
+    root = tmp_path / "dataset"
+    (root / "atlases").mkdir(parents=True)
+    (root / "atlases" / "BN_Atlas_246_2mm.nii.gz").write_text("atlas")
+    for name in SUBJECTS:
+        subj = root / name
+        subj.mkdir()
+        for fname in ("DTI-Mono_noPAT.nii.gz", "t1_mprage_tra.nii.gz", "ap_b0.nii.gz", "pa_b0.nii.gz"):
+            (subj / fname).write_text("image")
+        (subj / "DTI-Mono_noPAT.json").write_text('{"TotalReadoutTime": 0.05, "EffectiveEchoSpacing": 0.0005}')
+        (subj / "DTI-Mono_noPAT.bval").write_text("0 1000 1000 1000\n")
+        (subj / "DTI-Mono_noPAT.bvec").write_text("0 1 0 0\n0 0 1 0\n0 0 0 1\n")
+    return root
+
+
+@pytest.fixture
+def bin_dir(tmp_path):
+    path = tmp_path / "bin"
+    path.mkdir()
+    for tool in TOOLS:
+        (path / tool).symlink_to(FAKE_FSL)
+    return path
+
+
+def run_pipeline(dataset, bin_dir, *args, fail=""):
+    log = dataset.parent / "calls.log"
+    log.unlink(missing_ok=True)
+    env = dict(os.environ, FAKE_FSL_LOG=str(log), FAKE_FSL_FAIL=fail)
+    result = subprocess.run([sys.executable, str(PIPELINE), str(dataset), "--bin_dir", str(bin_dir),
+                             "--cores", "4", "--mem_gb", "16", "--matrix_mode", "2", *args],
+                            env=env, capture_output=True, text=True, timeout=300)
+    calls = log.read_text().splitlines() if log.exists() else []
+    return result, calls
+
+
+def first_call(calls, tool, *patterns):
+    """Index of the first ``tool`` call whose arguments contain all ``patterns``."""
+    for i, line in enumerate(calls):
+        name, _, args = line.partition(" ")
+        if name == tool and all(p in args for p in patterns):
+            return i
+    raise AssertionError(f"{tool} {patterns} was never called")
+
+
+def started(stdout, subject):
+    return [ln.split("▶ ")[1].split()[0] for ln in stdout.splitlines() if ln.startswith(f"[{subject}] ▶")]
+
+
+def test_two_subjects_run_in_dependency_order_and_rerun_skips_everything(dataset, bin_dir):
+    result, calls = run_pipeline(dataset, bin_dir)
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    for name in SUBJECTS:
+        out = str(dataset / name / "analyzed_fsl") + "/"
+        topup = first_call(calls, "topup", out)
+        eddy = first_call(calls, "eddy", out)
+        posteddy = first_call(calls, "fslroi", out + "dwi_eddy.nii.gz")
+        atlas_reg = first_call(calls, "flirt", "BN_Atlas", out)
+        seed = first_call(calls, "fslmaths", out + "seed_mask.nii.gz")
+        bedpostx = first_call(calls, "bedpostx", out[:-1])
+        probtrackx = first_call(calls, "probtrackx2", out)
+        assert topup < eddy < posteddy < first_call(calls, "dtifit", out)
+        # registration follows eddy and uses the eddy-corrected b0, as in tract.sh
+        assert posteddy < atlas_reg < seed < probtrackx
+        assert "nodif_posteddy" in calls[atlas_reg]
+        assert posteddy < bedpostx < probtrackx
+        assert (dataset / name / "analyzed_fsl" / "connectivity_matrix.csv").exists()
+        assert not (dataset / name / "analyzed_fsl" / "dwi.nii.gz").exists()       # removed by cleanup
+
+    rerun, calls = run_pipeline(dataset, bin_dir)
+    assert rerun.returncode == 0
+    assert calls == []
+    for name in SUBJECTS:
+        assert started(rerun.stdout, name) == ["cleanup"]
+
+
+def test_eddy_failure_drops_the_subject_without_failing_the_run(dataset, bin_dir):
+    result, calls = run_pipeline(dataset, bin_dir, "--skip_on_eddy_fail", "1", fail="eddy:subj_02")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "⏭️ subj_02: skipped" in result.stdout
+    assert "✅ subj_01" in result.stdout
+    assert not any("subj_02" in ln for ln in calls if ln.startswith(("dtifit", "bedpostx", "probtrackx2")))
+    assert (dataset / "subj_01" / "analyzed_fsl" / "connectivity_matrix.csv").exists()
+
+
+def test_eddy_failure_without_skipping_continues_with_the_unwarped_dwi(dataset, bin_dir):
+    result, calls = run_pipeline(dataset, bin_dir, fail="eddy:subj_02")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "dtifit" in started(result.stdout, "subj_02")
+    assert "eddy_qc" in started(result.stdout, "subj_02")
+    assert not any(ln.startswith("eddy_quad") and "subj_02" in ln for ln in calls)
+
+
+def test_failed_stage_blocks_its_dependants_and_fails_the_run(dataset, bin_dir):
+    result, _ = run_pipeline(dataset, bin_dir, fail="bedpostx:subj_01")
+    assert result.returncode == 1
+    assert "✅ subj_02" in result.stdout
+    summary = next(ln for ln in result.stdout.splitlines() if ln.startswith("⚠️ subj_01"))
+    assert "'bedpostx': 'failed'" in summary and "'probtrackx': 'blocked'" in summary
+
+
+def test_qc_failures_are_not_fatal(dataset, bin_dir):
+    result, _ = run_pipeline(dataset, bin_dir, fail="eddy_quad: slicer:")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "eddy_quad failed" in result.stdout and "slicer failed" in result.stdout
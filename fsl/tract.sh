@@ -1,4 +1,6 @@
 #!/bin/bash
+# Serial reference pipeline. pipeline.py runs the same stages as a dependency
+# graph, concurrently across stages and subjects within a core/memory budget.
 # set -e
 
 # -------- USER CONFIG --------
@@ -0,0 +1,129 @@
+"""
+Sharded probtrackx2 execution
+=============================
+Function-node bodies used by ``tract.py --shards N``. The seed ROI list is
+split into contiguous shards; each shard runs probtrackx2 with exactly the
+options of the unsharded run (only ``--seed`` differs) as one item of a
+``MapNode``, and the per-shard outputs are merged by
+``dipy/tractography/merge_omatrix.py``. Only matrix modes whose result is
+additive over seeds are sharded:
+
+* mode 2 (``--omatrix2``) – rows are seed voxels in ROI-list order, so a
+  shard's rows are shifted by the number of voxels in all preceding ROIs;
+* mode 4 (``--omatrix3``) – the target3×target3 matrix counts paths between
+  target voxels, whatever their seed, so the shard matrices are summed.
+
+Modes 1 (``--network``: targets are the other seeds of the same run) and
+3 (``--omatrix1``: columns are the run's own seed voxels) cannot be split
+over seeds and always run unsharded. The functions are self-contained
+because Nipype ships their source to the worker processes. The tracker is
+invoked through ``probtrackx_cmd``; ``tests/fake_probtrackx2.py`` stands in
+for it to exercise the workflow without FSL.
+"""
+
+# Matrix modes that can be split over seed ROIs
+SHARDABLE_MODES = (2, 4)
+
+
+def split_seeds(roi_list, seed_mask, matrix_mode, n_shards):
+    """Write one JSON spec per shard and return their paths."""
+    import json
+    import os
+    import nibabel as nib
+    import numpy as np
+
+    cwd = os.getcwd()
+    with open(roi_list) as f:
+        rois = [ln.strip() for ln in f if ln.strip()]
+
+    if matrix_mode not in (2, 4):
+        raise ValueError(f"Matrix mode {matrix_mode} cannot be sharded (only modes 2 and 4)")
+    n_vox = [int(np.count_nonzero(nib.load(r).dataobj)) for r in rois]
+    offsets = np.concatenate([[0], np.cumsum(n_vox)])
+
+    specs = []
+    for k, chunk in enumerate(np.array_split(np.arange(len(rois)), min(n_shards, len(rois)))):
+        shard_list = os.path.join(cwd, f"shard_{k:03d}.txt")
+        with open(shard_list, "w") as f:
+            f.write("\n".join(rois[i] for i in chunk) + "\n")
+        specs.append({
+            "index": k,
+            "seed": shard_list,
+            "rois": [rois[i] for i in chunk],
+            "row_offset": int(offsets[chunk[0]]),
+            "n_rows": int(offsets[chunk[-1] + 1] - offsets[chunk[0]]),
+        })
+
+    spec_files = []
+    for spec in specs:
+        spec["matrix_mode"] = int(matrix_mode)
+        path = os.path.join(cwd, f"shard_{spec['index']:03d}.json")
+        with open(path, "w") as f:
+            json.dump(spec, f, indent=1)
+        spec_files.append(path)
+    return spec_files
+
+
+def run_probtrackx_shard(shard_spec, thsamples, mask, roi_list, seed_mask,
+                         nsamples, probtrackx_cmd="probtrackx2"):
+    """Track one shard and return its output directory."""
+    import json
+    import os
+    import shlex
+    import subprocess
+
+    with open(shard_spec) as f:
+        spec = json.load(f)
+    mode = spec["matrix_mode"]
+
+    samples = thsamples[0] if isinstance(thsamples, (list, tuple)) else thsamples
+    for suffix in ("_th1samples.nii.gz", "_th1samples.nii", "_thsamples.nii.gz"):
+        if samples.endswith(suffix):
+            samples = samples[: -len(suffix)]
+            break
+
+    out_dir = os.path.join(os.getcwd(), f"shard_{spec['index']:03d}")
+    base = shlex.split(probtrackx_cmd) + [
+        f"--samples={samples}",
+        f"--mask={mask}",
+        "--loopcheck",
+        "--forcedir",
+        f"--nsamples={nsamples}",
+    ]
+
+    # same matrix options as the unsharded ProbTrackX2 node in tract.py
+    if mode == 2:
+        opts = ["--omatrix2", f"--target2={mask}"]
+    else:
+        opts = ["--omatrix3", f"--target3={seed_mask}", f"--lrtarget3={seed_mask}"]
+    subprocess.check_call(base + [f"--seed={spec['seed']}", f"--targetmasks={roi_list}"]
+                          + opts + [f"--dir={out_dir}"])
+    return out_dir
+
+
+def merge_shards(shard_dirs, shard_specs, matrix_mode, merge_script):
+    """Merge shard outputs; return (matrix, normalised matrix, waytotal) files."""
+    import importlib.util
+    import json
+    import os
+
+    spec = importlib.util.spec_from_file_location("merge_omatrix", merge_script)
+    merge = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(merge)
+    cwd = os.getcwd()
+
+    shards = []
+    for shard_dir, spec_file in zip(shard_dirs, shard_specs):
+        with open(spec_file) as f:
+            shards.append({"dir": shard_dir, "row_offset": json.load(f)["row_offset"]})
+    with open(os.path.join(cwd, "shards.json"), "w") as f:
+        json.dump({"shards": shards}, f, indent=1)
+
+    # mode 2 (--omatrix2) shards hold disjoint seed rows; mode 4 (--omatrix3) shards add up
+    name, merge_fn = ("fdt_matrix2", merge.merge_row_shards) if matrix_mode == 2 else ("fdt_matrix3", merge.sum_shards)
+    matrix_file = os.path.join(cwd, f"{name}.dot")
+    normalized_file = os.path.join(cwd, f"{name}_norm.dot")
+    merge_fn(shards, matrix_file)
+    merge_fn(shards, normalized_file, normalize=True)
+    waytotal_file = os.path.splitext(matrix_file)[0] + "_waytotal"
+    return matrix_file, normalized_file, waytotal_file
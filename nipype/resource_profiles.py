@@ -0,0 +1,200 @@
+"""
+Learned resource profiles for MultiProc scheduling
+==================================================
+MultiProc only packs nodes sensibly when each node carries a realistic
+``mem_gb``/``n_procs`` estimate. This module keeps a small JSON database of
+what every node actually used in previous runs (peak memory and CPU as
+reported by Nipype's resource monitor) together with the size of the
+subject's DWI, and turns it into per-node estimates scaled to the size of
+the data about to be processed.
+
+Typical use inside a workflow script::
+
+    db = ProfileDB(out_root / "resource_profiles.json")
+    eddy = Node(fsl.Eddy(), name="eddy",
+                **node_resources(db, "eddy", input_mvox=max(sizes.values()), max_procs=16))
+    WF.run(plugin="MultiProc",
+           plugin_args={"n_procs": 16,
+                        "status_callback": make_status_callback(db, sizes)})
+"""
+
+import json
+import math
+import os
+import re
+import time
+from pathlib import Path
+
+# Estimates used for nodes that have never been profiled: (mem_gb, n_procs).
+# They are deliberately generous; the first profiled run replaces them.
+DEFAULT_RESOURCES = {
+    "eddy": (6.0, 4),
+    "topup": (2.0, 1),
+    "bedpostx": (4.0, 1),
+    "probtrackx": (4.0, 1),
+    "fugue": (1.5, 1),
+    "dtifit": (1.5, 1),
+    "prepare_fmap": (1.0, 1),
+    "fmap_resamp": (1.0, 1),
+    "flirt_t1": (1.0, 1),
+    "flirt_atlas": (1.0, 1),
+    "make_roi": (1.0, 1),
+    "dot_csv": (1.0, 1),
+}
+FALLBACK_RESOURCES = (0.5, 1)
+
+MAX_OBSERVATIONS = 50     # per node, oldest observations are dropped
+SAFETY_MARGIN = 1.2       # multiplicative head-room on learned memory
+MIN_MEM_GB = 0.2          # Nipype's own default per node
+
+
+def image_mvox(path):
+    """Number of voxels (all dimensions, in millions) of a NIfTI image."""
+    import nibabel as nib
+    return math.prod(nib.load(str(path)).shape) / 1e6
+
+
+class ProfileDB:
+    """JSON-backed store of per-node runtime observations.
+
+    Each observation records the subject's input size in megavoxels
+    (``input_mvox``), the peak resident memory in GB, the peak CPU usage in
+    percent (100 = one core) and the wall-clock duration.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.nodes = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.nodes = json.load(f).get("nodes", {})
+
+    def record(self, node_name, input_mvox, mem_gb, cpu_percent, duration_s, subject=None):
+        """Add one observation for ``node_name``."""
+        obs = self.nodes.setdefault(node_name, [])
+        obs.append({
+            "input_mvox": float(input_mvox),
+            "mem_gb": float(mem_gb),
+            "cpu_percent": float(cpu_percent),
+            "duration_s": float(duration_s),
+            "subject": subject,
+            "recorded": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+        del obs[:-MAX_OBSERVATIONS]
+
+    def save(self):
+        """Write the database atomically (safe against interrupted runs)."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "nodes": self.nodes}, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def estimate(self, node_name, input_mvox, max_procs=None):
+        """Estimate ``(mem_gb, n_procs)`` for ``node_name`` on data of ``input_mvox``.
+
+        Memory follows a least-squares line ``mem = a + b * input_mvox`` through
+        previous observations (a pure ratio when all inputs had the same size),
+        raised by the worst under-prediction seen so far and a safety margin.
+        Threads are the 90th percentile of the observed peak CPU usage.
+        Unprofiled nodes fall back to ``DEFAULT_RESOURCES``.
+        """
+        obs = self.nodes.get(node_name)
+        if not obs:
+            mem_gb, n_procs = DEFAULT_RESOURCES.get(node_name, FALLBACK_RESOURCES)
+            return mem_gb, _clamp_procs(n_procs, max_procs)
+
+        sizes = [o["input_mvox"] for o in obs]
+        mems = [o["mem_gb"] for o in obs]
+        if len(set(sizes)) > 1:
+            mean_x = sum(sizes) / len(sizes)
+            mean_y = sum(mems) / len(mems)
+            var_x = sum((x - mean_x) ** 2 for x in sizes)
+            slope = max(0.0, sum((x - mean_x) * (y - mean_y) for x, y in zip(sizes, mems)) / var_x)
+            intercept = mean_y - slope * mean_x
+        else:
+            slope = max(m / x for m, x in zip(mems, sizes)) if sizes[0] > 0 else 0.0
+            intercept = 0.0 if sizes[0] > 0 else max(mems)
+        residual = max(0.0, max(y - (intercept + slope * x) for x, y in zip(sizes, mems)))
+        mem_gb = max(MIN_MEM_GB, (intercept + slope * input_mvox + residual) * SAFETY_MARGIN)
+
+        cpus = sorted(o["cpu_percent"] for o in obs)
+        p90 = cpus[min(len(cpus) - 1, int(math.ceil(0.9 * len(cpus))) - 1)]
+        n_procs = max(1, int(math.ceil(p90 / 100.0 - 0.1)))   # tolerate monitor jitter
+        return round(mem_gb, 2), _clamp_procs(n_procs, max_procs)
+
+
+def _clamp_procs(n_procs, max_procs):
+    return max(1, min(n_procs, max_procs)) if max_procs else max(1, n_procs)
+
+
+def node_resources(db, name, input_mvox, max_procs=None, max_mem_gb=None):
+    """``Node``/``MapNode`` keyword arguments ``{"mem_gb", "n_procs"}`` for ``name``.
+
+    Pass the result to the node constructor (``Node(..., **node_resources(...))``);
+    ``mem_gb`` has no public setter on an existing node. ``input_mvox`` should
+    be the largest subject in the run: iterables expand copies of the same
+    node, so one estimate has to hold for every subject. Estimates are
+    clamped to ``max_procs``/``max_mem_gb`` so that MultiProc never refuses
+    to schedule a node.
+
+    Nipype also copies ``n_procs`` into the ``num_threads`` input of
+    interfaces that have one (e.g. ``fsl.Eddy``), so such tools run with as
+    many threads as MultiProc reserved cores for them.
+    """
+    mem_gb, n_procs = db.estimate(name, input_mvox, max_procs=max_procs)
+    if max_mem_gb:
+        mem_gb = min(mem_gb, max_mem_gb)
+    return {"mem_gb": mem_gb, "n_procs": n_procs}
+
+
+def profile_name(node):
+    """Name a node's observations are stored under.
+
+    ``MapNode`` runs its items as sub-nodes named ``_<name><index>``; they are
+    recorded under the parent name, which is the one ``node_resources`` is
+    asked for.
+    """
+    match = re.fullmatch(r"_(.+?)\d+", node.name)
+    return match.group(1) if match else node.name
+
+
+def subject_from_node(node):
+    """Subject id of an expanded node (``_subject_id_<id>`` parameterization).
+
+    ``MapNode`` sub-nodes carry no parameterization; their working directory
+    (below the parent's ``_subject_id_<id>`` directory) is used instead.
+    """
+    params = list(getattr(node, "parameterization", None) or [])
+    params += Path(getattr(node, "base_dir", None) or "").parts
+    for param in params:
+        param = param.lstrip("_")
+        if param.startswith("subject_id_"):
+            return param[len("subject_id_"):]
+    return None
+
+
+def make_status_callback(db, subject_mvox):
+    """Build a MultiProc ``status_callback`` that learns into ``db``.
+
+    ``subject_mvox`` maps subject ids to their DWI size in megavoxels. Every
+    finished node with resource-monitor data is recorded and the database is
+    saved immediately, so profiles survive crashed or cancelled runs.
+    Requires ``nipype.config.enable_resource_monitor()`` (and psutil).
+    """
+    fallback = max(subject_mvox.values()) if subject_mvox else 0.0
+
+    def status_callback(node, status):
+        if status != "end":
+            return
+        runtime = getattr(getattr(node, "result", None), "runtime", None)
+        mem_gb = getattr(runtime, "mem_peak_gb", None)
+        cpu_percent = getattr(runtime, "cpu_percent", None)
+        if mem_gb is None or cpu_percent is None:
+            return
+        subject = subject_from_node(node)
+        db.record(profile_name(node), subject_mvox.get(subject, fallback), mem_gb, cpu_percent,
+                  getattr(runtime, "duration", 0.0) or 0.0, subject=subject)
+        db.save()
+
+    return status_callback
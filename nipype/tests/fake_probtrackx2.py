@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Stand-in for FSL's ``probtrackx2`` used to test the sharded workflow.
+
+Understands the options ``probtrackx_shards.run_probtrackx_shard`` and the
+unsharded ProbTrackX2 node pass for matrix modes 2 and 4 and writes the
+same outputs (1-based ``fdt_matrix2.dot``/``fdt_matrix3.dot`` triplets and
+``waytotal``). Seed voxels are visited as probtrackx2 does – ROI-list order,
+then x fastest within each ROI – and every voxel draws its samples from a
+generator seeded with its own coordinates, so a voxel contributes the same
+paths whichever shard tracks it.
+
+Usage
+-----
+>>> python fake_probtrackx2.py --seed=rois.txt --omatrix2 --target2=mask.nii.gz --dir=out --nsamples=50
+"""
+import os
+import argparse
+
+import nibabel as nib
+import numpy as np
+
+
+def voxels(image):
+    """Non-zero voxel coordinates of ``image`` in FSL order (x fastest)."""
+    ijk = np.argwhere(np.asarray(nib.load(image).dataobj) > 0)
+    return ijk[np.lexsort(ijk.T)]
+
+
+def seed_voxels(seed):
+    if seed.endswith((".nii", ".nii.gz")):
+        return voxels(seed)
+    with open(seed) as f:
+        return np.concatenate([voxels(ln.strip()) for ln in f if ln.strip()])
+
+
+def track(seed_ijk, n_targets, nsamples):
+    """Per seed voxel: target indices hit by its valid samples (two per path)."""
+    for ijk in seed_ijk:
+        rng = np.random.default_rng([int(c) for c in ijk])
+        n_valid = rng.binomial(nsamples, 0.8)
+        yield rng.integers(0, n_targets, size=(n_valid, 2))
+
+
+def write_dot(path, counts):
+    with open(path, "w") as f:
+        for (i, j), v in sorted(counts.items()):
+            f.write(f"{i + 1} {j + 1} {v}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--seed", required=True)
+    parser.add_argument("--dir", required=True)
+    parser.add_argument("--nsamples", type=int, default=5000)
+    parser.add_argument("--omatrix2", action="store_true")
+    parser.add_argument("--target2")
+    parser.add_argument("--omatrix3", action="store_true")
+    parser.add_argument("--target3")
+    parser.add_argument("--lrtarget3")
+    args, _ = parser.parse_known_args(argv)       # --samples, --mask, --loopcheck, ...
+    if args.omatrix2 == args.omatrix3:
+        parser.error("exactly one of --omatrix2/--omatrix3 is supported")
+
+    os.makedirs(args.dir, exist_ok=True)
+    seed_ijk = seed_voxels(args.seed)
+    n_targets = len(voxels(args.target2 if args.omatrix2 else args.target3))
+
+    counts, waytotal = {}, 0
+    for row, hits in enumerate(track(seed_ijk, n_targets, args.nsamples)):
+        waytotal += len(hits)
+        # mode 2: seed voxel -> first target hit; mode 4: between the two target hits
+        keys = [(row, a) for a, _ in hits] if args.omatrix2 else [tuple(h) for h in hits]
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+
+    write_dot(os.path.join(args.dir, "fdt_matrix2.dot" if args.omatrix2 else "fdt_matrix3.dot"), counts)
+    with open(os.path.join(args.dir, "waytotal"), "w") as f:
+        f.write(f"{waytotal}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import sys
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from probtrackx_shards import SHARDABLE_MODES, merge_shards, run_probtrackx_shard, split_seeds  # noqa: E402
+
+FAKE_PROBTRACKX = f"{sys.executable} {Path(__file__).resolve().parent / 'fake_probtrackx2.py'}"
+MERGE_SCRIPT = str(Path(__file__).resolve().parents[2] / "dipy" / "tractography" / "merge_omatrix.py")
+NSAMPLES = 40
+
+
+@pytest.fixture
+def rois(tmp_path):
+    """Five seed ROIs of different sizes, their list, union and a brain mask."""
+    affine = np.eye(4)
+    labels = np.zeros((8, 8, 8), dtype=np.int16)
+    for label, (x, size) in enumerate([(1, 1), (2, 2), (3, 3), (4, 1), (5, 2)], start=1):
+        labels[x, 1:1 + size, 2:2 + size] = label
+    paths = []
+    for label in range(1, 6):
+        paths.append(tmp_path / f"roi_{label}.nii.gz")
+        nib.save(nib.Nifti1Image((labels == label).astype(np.uint8), affine), str(paths[-1]))
+    roi_list = tmp_path / "roi_list.txt"
+    roi_list.write_text("\n".join(map(str, paths)) + "\n")
+    seed_mask = tmp_path / "seed_mask.nii.gz"
+    nib.save(nib.Nifti1Image((labels > 0).astype(np.uint8), affine), str(seed_mask))
+    mask = tmp_path / "mask.nii.gz"
+    nib.save(nib.Nifti1Image(np.ones((8, 8, 8), np.uint8), affine), str(mask))
+    return {"roi_list": str(roi_list), "seed_mask": str(seed_mask), "mask": str(mask)}
+
+
+def read_dot(path):
+    with open(path) as f:
+        return {(int(i), int(j)): float(v) for i, j, v in (ln.split() for ln in f if ln.strip())}
+
+
+def sharded_run(rois, matrix_mode, n_shards, work_dir, monkeypatch):
+    work_dir.mkdir()
+    monkeypatch.chdir(work_dir)
+    specs = split_seeds(rois["roi_list"], rois["seed_mask"], matrix_mode, n_shards)
+    dirs = [run_probtrackx_shard(spec, "merged_th1samples.nii.gz", rois["mask"], rois["roi_list"],
+                                 rois["seed_mask"], NSAMPLES, probtrackx_cmd=FAKE_PROBTRACKX)
+            for spec in specs]
+    return merge_shards(dirs, specs, matrix_mode, MERGE_SCRIPT)
+
+
+def unsharded_run(rois, matrix_mode, out_dir):
+    # the options the ProbTrackX2 node of tract.py passes for this mode
+    import subprocess
+    opts = (["--omatrix2", f"--target2={rois['mask']}"] if matrix_mode == 2 else
+            ["--omatrix3", f"--target3={rois['seed_mask']}", f"--lrtarget3={rois['seed_mask']}"])
+    subprocess.check_call(FAKE_PROBTRACKX.split() + [f"--seed={rois['roi_list']}", f"--dir={out_dir}",
+                                                     f"--nsamples={NSAMPLES}"] + opts)
+    name = "fdt_matrix2" if matrix_mode == 2 else "fdt_matrix3"
+    return read_dot(out_dir / f"{name}.dot"), int((out_dir / "waytotal").read_text())
+
+
+@pytest.mark.parametrize("matrix_mode", SHARDABLE_MODES)
+def test_sharded_runs_match_the_unsharded_run(rois, matrix_mode, tmp_path, monkeypatch):
+    expected, expected_waytotal = unsharded_run(rois, matrix_mode, tmp_path / "unsharded")
+    for n_shards in (1, 3):
+        matrix_file, normalized_file, waytotal_file = sharded_run(
+            rois, matrix_mode, n_shards, tmp_path / f"shards_{n_shards}", monkeypatch)
+        assert read_dot(matrix_file) == expected
+        assert int(open(waytotal_file).read()) == expected_waytotal
+        normalized = read_dot(normalized_file)
+        assert normalized.keys() == expected.keys()
+        for key, value in expected.items():
+            assert normalized[key] == pytest.approx(value / expected_waytotal, rel=1e-6)
+
+
+def test_shards_split_the_roi_list_into_contiguous_row_blocks(rois, tmp_path, monkeypatch):
+    import json
+    monkeypatch.chdir(tmp_path)
+    specs = [json.load(open(s)) for s in split_seeds(rois["roi_list"], rois["seed_mask"], 2, 3)]
+    assert [len(s["rois"]) for s in specs] == [2, 2, 1]
+    assert [(s["row_offset"], s["n_rows"]) for s in specs] == [(0, 5), (5, 10), (15, 4)]
+
+
+@pytest.mark.parametrize("matrix_mode", [1, 3])
+def test_modes_that_depend_on_the_whole_seed_set_are_not_sharded(rois, matrix_mode, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(ValueError, match="cannot be sharded"):
+        split_seeds(rois["roi_list"], rois["seed_mask"], matrix_mode, 2)
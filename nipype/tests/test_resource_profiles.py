@@ -0,0 +1,121 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from resource_profiles import (DEFAULT_RESOURCES, FALLBACK_RESOURCES, MIN_MEM_GB, SAFETY_MARGIN,  # noqa: E402
+                               ProfileDB, make_status_callback, node_resources, profile_name)
+
+
+@pytest.fixture
+def db(tmp_path):
+    return ProfileDB(tmp_path / "profiles.json")
+
+
+def finished_node(name, mem_gb=2.0, cpu_percent=350.0, duration=10.0, parameterization=(), base_dir=None):
+    runtime = SimpleNamespace(mem_peak_gb=mem_gb, cpu_percent=cpu_percent, duration=duration)
+    return SimpleNamespace(name=name, result=SimpleNamespace(runtime=runtime),
+                           parameterization=list(parameterization), base_dir=base_dir)
+
+
+# ------------------------------  estimate()  ------------------------------- #
+
+def test_estimate_defaults_for_unprofiled_nodes(db):
+    assert db.estimate("eddy", 10.0) == DEFAULT_RESOURCES["eddy"]
+    assert db.estimate("unknown_node", 10.0) == FALLBACK_RESOURCES
+
+
+def test_estimate_scales_single_size_observations_as_a_ratio(db):
+    db.record("dtifit", 10.0, 2.0, 100.0, 5.0)
+    mem_gb, n_procs = db.estimate("dtifit", 20.0)
+    assert mem_gb == pytest.approx(4.0 * SAFETY_MARGIN)
+    assert n_procs == 1
+
+
+def test_estimate_fits_a_line_and_adds_the_worst_residual(db):
+    # least-squares line mem = 1.0 + 0.105 * mvox; the 30 Mvox run lies 0.35 GB above it
+    for mvox, mem in [(10.0, 2.0), (20.0, 3.0), (30.0, 4.5), (40.0, 5.0)]:
+        db.record("eddy", mvox, mem, 400.0, 60.0)
+    mem_gb, _ = db.estimate("eddy", 50.0)
+    slope, intercept = 0.105, 1.0
+    residual = 4.5 - (intercept + slope * 30.0)
+    assert mem_gb == pytest.approx((intercept + slope * 50.0 + residual) * SAFETY_MARGIN, abs=0.01)
+
+
+def test_estimate_never_goes_below_the_nipype_minimum(db):
+    db.record("b0", 10.0, 0.01, 50.0, 1.0)
+    assert db.estimate("b0", 1.0)[0] == MIN_MEM_GB
+
+
+def test_estimate_uses_the_90th_percentile_of_cpu(db):
+    for cpu in [100.0] * 9 + [800.0]:
+        db.record("topup", 10.0, 1.0, cpu, 30.0)
+    assert db.estimate("topup", 10.0)[1] == 1
+    db.record("topup", 10.0, 1.0, 390.0, 30.0)
+    db.record("topup", 10.0, 1.0, 395.0, 30.0)
+    assert db.estimate("topup", 10.0)[1] == 4
+
+
+def test_profiles_survive_a_save_and_reload(db):
+    db.record("eddy", 10.0, 3.0, 400.0, 60.0, subject="s01")
+    db.save()
+    assert ProfileDB(db.path).estimate("eddy", 10.0) == db.estimate("eddy", 10.0)
+
+
+# ------------------------------  clamping  --------------------------------- #
+
+def test_node_resources_clamps_procs_and_memory(db):
+    db.record("eddy", 10.0, 30.0, 1600.0, 60.0)
+    assert node_resources(db, "eddy", 10.0) == {"mem_gb": 36.0, "n_procs": 16}
+    assert node_resources(db, "eddy", 10.0, max_procs=8, max_mem_gb=24.0) == {"mem_gb": 24.0, "n_procs": 8}
+    assert node_resources(db, "unknown_node", 10.0, max_procs=8)["n_procs"] == 1
+
+
+def test_node_resources_are_accepted_by_the_node_constructor(db):
+    from nipype import Node
+    from nipype.interfaces import fsl
+
+    db.record("eddy", 10.0, 5.0, 300.0, 60.0)
+    node = Node(fsl.Eddy(), name="eddy", **node_resources(db, "eddy", 10.0, max_procs=16))
+    assert node.mem_gb == pytest.approx(6.0)
+    assert node.n_procs == 3
+    assert node.inputs.num_threads == 3          # Nipype forwards n_procs to eddy's OpenMP threads
+
+
+# ------------------------------  callback  --------------------------------- #
+
+def test_callback_records_finished_nodes_and_saves(db):
+    callback = make_status_callback(db, {"s01": 12.0, "s02": 20.0})
+    callback(finished_node("eddy", parameterization=["_subject_id_s01"]), "start")
+    assert db.nodes == {}
+    callback(finished_node("eddy", parameterization=["_subject_id_s01"]), "end")
+    (obs,) = ProfileDB(db.path).nodes["eddy"]
+    assert (obs["subject"], obs["input_mvox"], obs["mem_gb"], obs["cpu_percent"]) == ("s01", 12.0, 2.0, 350.0)
+
+
+def test_callback_records_mapnode_items_under_the_parent_name(db, tmp_path):
+    callback = make_status_callback(db, {"s01": 12.0, "s02": 20.0})
+    base_dir = tmp_path / "dwi_pipeline" / "_subject_id_s02" / "probtrackx" / "mapflow"
+    for i in range(3):
+        callback(finished_node(f"_probtrackx{i}", base_dir=str(base_dir)), "end")
+    assert list(db.nodes) == ["probtrackx"]
+    assert [o["subject"] for o in db.nodes["probtrackx"]] == ["s02"] * 3
+    assert db.estimate("probtrackx", 20.0) == (round(2.0 * SAFETY_MARGIN, 2), 4)
+
+
+def test_callback_ignores_nodes_without_monitor_data(db):
+    callback = make_status_callback(db, {})
+    node = finished_node("eddy")
+    node.result.runtime.mem_peak_gb = None
+    callback(node, "end")
+    callback(SimpleNamespace(name="eddy", result=None), "end")
+    assert db.nodes == {}
+
+
+def test_profile_name_only_strips_mapnode_items():
+    assert profile_name(SimpleNamespace(name="_probtrackx12")) == "probtrackx"
+    assert profile_name(SimpleNamespace(name="flirt_t1")) == "flirt_t1"
+    assert profile_name(SimpleNamespace(name="b0")) == "b0"
@@ -21,9 +21,21 @@ Usage
 >>> python nipype_pipeline.py /path/to/dataset  \
 ...                       --subjects subj_02 subj_03  \
 ...                       --do_tract 1  \
-...                       --matrix_mode 1  \
+...                       --matrix_mode 4  \
 ...                       --nsamples 5000  \
-...                       --n_procs 16
+...                       --shards 8  \
+...                       --n_procs 16 --memory_gb 48
+
+Each node is annotated with ``mem_gb``/``n_procs`` estimates learned from the
+runtime profiles of previous runs (``nipype_out/resource_profiles.json``, see
+``resource_profiles.py``), so MultiProc can fill every core without
+oversubscribing memory. The first run uses conservative defaults.
+
+With ``--shards N`` (matrix modes 2 and 4 only) the seed ROI list is split
+into N shards tracked by a ``MapNode`` with the options of the unsharded run
+and merged by ``dipy/tractography/merge_omatrix.py`` into the same matrix
+(see ``probtrackx_shards.py``). ``--probtrackx_cmd`` swaps the tracker
+binary, e.g. for ``tests/fake_probtrackx2.py`` when testing without FSL.
 
 If you run on a cluster, swap ``--n_procs`` for the SLURM plugin (see bottom).
 
@@ -42,10 +54,15 @@ import json
 import os
 from pathlib import Path
 
-from nipype import MapNode, Node, Workflow
+from nipype import MapNode, Node, Workflow, config
 from nipype.interfaces import fsl, io as nio, utility as niu
 from nipype.interfaces.base import CommandLine
 
+from resource_profiles import ProfileDB, image_mvox, make_status_callback, node_resources
+from probtrackx_shards import SHARDABLE_MODES, merge_shards, run_probtrackx_shard, split_seeds
+
+MERGE_SCRIPT = Path(__file__).resolve().parents[1] / "dipy" / "tractography" / "merge_omatrix.py"
+
 ################################################################################
 # ----------------------------  Helper Functions  ---------------------------- #
 ################################################################################
@@ -100,8 +117,16 @@ parser.add_argument("--skip_on_eddy_fail", type=int, default=0, help="Skip subje
 parser.add_argument("--do_tract", type=int, default=1, help="Run tractography")
 parser.add_argument("--matrix_mode", type=int, choices=[1, 2, 3, 4], default=1)
 parser.add_argument("--nsamples", type=int, default=5000)
+parser.add_argument("--shards", type=int, default=1,
+                    help="Split probtrackx seeds into this many parallel shards (matrix modes 2 and 4)")
+parser.add_argument("--probtrackx_cmd", default="probtrackx2", help="Tracker executable used by sharded runs")
 parser.add_argument("--n_procs", type=int, default=8, help="#cores for MultiProc plugin")
+parser.add_argument("--memory_gb", type=float, default=None, help="Memory budget for MultiProc (default: 90%% of RAM)")
+parser.add_argument("--profile_db", type=Path, default=None, help="Resource profile database (default: nipype_out/resource_profiles.json)")
+parser.add_argument("--resource_monitor", type=int, default=1, help="Record node runtime profiles (1) or not (0); needs psutil")
 args = parser.parse_args()
+if args.shards > 1 and args.matrix_mode not in SHARDABLE_MODES:
+    parser.error(f"--shards needs --matrix_mode 2 or 4; mode {args.matrix_mode} cannot be split over seeds")
 
 ################################################################################
 # ------------------------------  Boilerplate  ------------------------------- #
@@ -114,9 +139,6 @@ out_root.mkdir(exist_ok=True)
 
 WF = Workflow(name="dwi_pipeline", base_dir=str(out_root))
 
-infosource = Node(niu.IdentityInterface(fields=["subject_id"]), name="infosource")
-infosource.iterables = [("subject_id", subjects)]
-
 # Template paths inside each subject directory
 templates = {
     "dwi": "{subject_id}/DTI-Mono_noPAT.nii.gz",
@@ -130,8 +152,31 @@ templates = {
     "t1": "{subject_id}/t1_mprage_tra.nii.gz",
 }
 
+################################################################################
+# --------------------------  Resource estimates  ---------------------------- #
+################################################################################
+
+# Estimates scale with the subject's DWI size; iterables share one node
+# definition, so the largest subject of the run sizes every node. They are
+# passed to the node constructors below (``**resources("eddy")``).
+profile_db = ProfileDB(args.profile_db or out_root / "resource_profiles.json")
+subject_mvox = {}
+for s in subjects:
+    dwi_path = dataset / templates["dwi"].format(subject_id=s)
+    if dwi_path.exists():
+        subject_mvox[s] = image_mvox(dwi_path)
+
+
+def resources(name):
+    return node_resources(profile_db, name, max(subject_mvox.values(), default=0.0),
+                          max_procs=args.n_procs, max_mem_gb=args.memory_gb)
+
+
+infosource = Node(niu.IdentityInterface(fields=["subject_id"]), name="infosource", **resources("infosource"))
+infosource.iterables = [("subject_id", subjects)]
+
 selectfiles = Node(
-    nio.SelectFiles(templates, base_directory=str(dataset)), name="selectfiles"
+    nio.SelectFiles(templates, base_directory=str(dataset)), name="selectfiles", **resources("selectfiles")
 )
 
 ################################################################################
@@ -139,7 +184,7 @@ selectfiles = Node(
 ################################################################################
 
 prepare_fmap = Node(
-    fsl.PrepareFieldmap(scanner="SIEMENS"), name="prepare_fmap"
+    fsl.PrepareFieldmap(scanner="SIEMENS"), name="prepare_fmap", **resources("prepare_fmap")
 )
 WF.connect(infosource, "subject_id", prepare_fmap, "out_base_name")
 WF.connect(selectfiles, "gre_phase", prepare_fmap, "in_phase")
@@ -151,32 +196,32 @@ prepare_fmap.inputs.delta_TE = 2.46
 ################################################################################
 
 # Extract B0 and BET
-b0 = Node(fsl.ExtractROI(t_min=0, t_size=1), name="b0")
+b0 = Node(fsl.ExtractROI(t_min=0, t_size=1), name="b0", **resources("b0"))
 WF.connect(selectfiles, "dwi", b0, "in_file")
 
-bet_b0 = Node(fsl.BET(frac=0.3, mask=True), name="bet_b0")
+bet_b0 = Node(fsl.BET(frac=0.3, mask=True), name="bet_b0", **resources("bet_b0"))
 WF.connect(b0, "roi_file", bet_b0, "in_file")
 
 # Resample fieldmap to DWI grid using FLIRT (sform)
 fmap_resamp = Node(
-    fsl.FLIRT(apply_xfm=True, uses_qform=True), name="fmap_resamp"
+    fsl.FLIRT(apply_xfm=True, uses_qform=True), name="fmap_resamp", **resources("fmap_resamp")
 )
 WF.connect(prepare_fmap, "out_fieldmap", fmap_resamp, "in_file")
 WF.connect(b0, "roi_file", fmap_resamp, "reference")
 
 # FUGUE unwarping
-fugue = Node(fsl.FUGUE(unwarp_direction="z"), name="fugue")
+fugue = Node(fsl.FUGUE(unwarp_direction="z"), name="fugue", **resources("fugue"))
 WF.connect(selectfiles, "dwi", fugue, "in_file")
 WF.connect(fmap_resamp, "out_file", fugue, "fmap_in_file")
 WF.connect(bet_b0, "mask_file", fugue, "mask_file")
 
 # TOPUP block -------------------------------------------------------------
 
-topup_merge = Node(fsl.Merge(dimension="t"), name="topup_merge")
+topup_merge = Node(fsl.Merge(dimension="t"), name="topup_merge", **resources("topup_merge"))
 WF.connect(selectfiles, "topup_ap", topup_merge, "in_files")
 WF.connect(selectfiles, "topup_pa", topup_merge, "in_files")
 
-topup = Node(fsl.Topup(config="b02b0.cnf"), name="topup")
+topup = Node(fsl.Topup(config="b02b0.cnf"), name="topup", **resources("topup"))
 WF.connect(topup_merge, "merged_file", topup, "in_file")
 
 # ACQP params file (custom Function)
@@ -187,13 +232,14 @@ acqparams = Node(
         function=create_acqparams,
     ),
     name="acqparams",
+    **resources("acqparams"),
 )
 WF.connect(infosource, ("subject_id", lambda s: str(dataset / s)), acqparams, "datadir")
 WF.connect(selectfiles, "dwi_json", acqparams, "dwi_json")
 acqparams.inputs.out_file = "acqparams.txt"
 
 # EDDY -------------------------------------------------------------
-eddy = Node(fsl.Eddy(), name="eddy")
+eddy = Node(fsl.Eddy(), name="eddy", **resources("eddy"))
 WF.connect(fugue, "unwarped_file", eddy, "in_file")
 WF.connect(bet_b0, "mask_file", eddy, "in_mask")
 WF.connect(selectfiles, "bvec", eddy, "in_bvec")
@@ -202,7 +248,7 @@ WF.connect(topup, "out_field", eddy, "field")
 WF.connect(acqparams, "acqp_txt", eddy, "in_acqp")
 
 # DTIFIT -------------------------------------------------------------
-dtifit = Node(fsl.DTIFit(), name="dtifit")
+dtifit = Node(fsl.DTIFit(), name="dtifit", **resources("dtifit"))
 WF.connect(eddy, "out_corrected", dtifit, "dwi")
 WF.connect(bet_b0, "mask_file", dtifit, "mask")
 WF.connect(selectfiles, "bvec", dtifit, "bvecs")
@@ -212,13 +258,13 @@ WF.connect(selectfiles, "bval", dtifit, "bvals")
 # ------------------  T1 & Atlas registration to DWI ------------------------ #
 ################################################################################
 
-flirt_t1 = Node(fsl.FLIRT(dof=6), name="flirt_t1")
+flirt_t1 = Node(fsl.FLIRT(dof=6), name="flirt_t1", **resources("flirt_t1"))
 WF.connect(selectfiles, "t1", flirt_t1, "in_file")
 WF.connect(b0, "roi_file", flirt_t1, "reference")
 
 atlas_path = Path(__file__).resolve().parent / "atlases" / "BN_Atlas_246_2mm.nii.gz"
 flirt_atlas = Node(
-    fsl.FLIRT(apply_xfm=True, uses_qform=True, in_file=str(atlas_path)), name="flirt_atlas"
+    fsl.FLIRT(apply_xfm=True, uses_qform=True, in_file=str(atlas_path)), name="flirt_atlas", **resources("flirt_atlas")
 )
 WF.connect(b0, "roi_file", flirt_atlas, "reference")
 
@@ -267,7 +313,7 @@ roi_module.write_text(make_roi_fn)
 from importlib import import_module
 MakeROI = import_module(roi_module.stem).MakeROI  # type: ignore
 
-make_roi = Node(MakeROI(), name="make_roi")
+make_roi = Node(MakeROI(), name="make_roi", **resources("make_roi"))
 WF.connect(flirt_atlas, "out_file", make_roi, "in_atlas")
 
 ################################################################################
@@ -275,38 +321,101 @@ WF.connect(flirt_atlas, "out_file", make_roi, "in_atlas")
 ################################################################################
 
 if args.do_tract:
-    bedpostx = Node(fsl.Bedpostx(ndirs=1, nvols=1, model=2), name="bedpostx")
+    bedpostx = Node(fsl.Bedpostx(ndirs=1, nvols=1, model=2), name="bedpostx", **resources("bedpostx"))
     WF.connect(eddy, "out_corrected", bedpostx, "dwi")
     WF.connect(bet_b0, "mask_file", bedpostx, "mask")
 
-    probtrackx = Node(fsl.ProbTrackX2(nsamples=args.nsamples, loopcheck=True), name="probtrackx")
-    if args.matrix_mode == 1:
-        probtrackx.inputs.network = True
-    elif args.matrix_mode == 2:
-        probtrackx.inputs.omatrix2 = True
-    elif args.matrix_mode == 3:
-        probtrackx.inputs.os2t = True
-        probtrackx.inputs.omatrix1 = True
-    elif args.matrix_mode == 4:
-        probtrackx.inputs.omatrix3 = True
-    WF.connect(bet_b0, "mask_file", probtrackx, "mask")
-    WF.connect(bedpostx, "merged", probtrackx, "samples")
-    WF.connect(make_roi, "roi_list", probtrackx, "seed")
-    WF.connect(make_roi, "roi_list", probtrackx, "target_masks")
-
-    # Convert DOT to CSV (Function interface)
-    dot_csv = Node(
-        niu.Function(input_names=["in_file", "out_file"], output_names=["csv_file"], function=dot_to_csv),
-        name="dot_csv",
-    )
-    WF.connect(probtrackx, "out_matrix_file", dot_csv, "in_file")
-    dot_csv.inputs.out_file = "connectivity_matrix.csv"
+    if args.shards > 1:
+        # Split the seed ROI list into shards, track them in parallel and
+        # merge matrices and waytotals.
+        split_seeds_node = Node(
+            niu.Function(
+                input_names=["roi_list", "seed_mask", "matrix_mode", "n_shards"],
+                output_names=["shard_specs"],
+                function=split_seeds,
+            ),
+            name="split_seeds",
+            **resources("split_seeds"),
+        )
+        split_seeds_node.inputs.matrix_mode = args.matrix_mode
+        split_seeds_node.inputs.n_shards = args.shards
+        WF.connect(make_roi, "roi_list", split_seeds_node, "roi_list")
+        WF.connect(make_roi, "seed_mask", split_seeds_node, "seed_mask")
+
+        probtrackx = MapNode(
+            niu.Function(
+                input_names=["shard_spec", "thsamples", "mask", "roi_list", "seed_mask",
+                             "nsamples", "probtrackx_cmd"],
+                output_names=["out_dir"],
+                function=run_probtrackx_shard,
+            ),
+            iterfield=["shard_spec"],
+            name="probtrackx",
+            **resources("probtrackx"),
+        )
+        probtrackx.inputs.nsamples = args.nsamples
+        probtrackx.inputs.probtrackx_cmd = args.probtrackx_cmd
+        WF.connect(split_seeds_node, "shard_specs", probtrackx, "shard_spec")
+        WF.connect(bedpostx, "merged_thsamples", probtrackx, "thsamples")
+        WF.connect(bet_b0, "mask_file", probtrackx, "mask")
+        WF.connect(make_roi, "roi_list", probtrackx, "roi_list")
+        WF.connect(make_roi, "seed_mask", probtrackx, "seed_mask")
+
+        merge_shards_node = Node(
+            niu.Function(
+                input_names=["shard_dirs", "shard_specs", "matrix_mode", "merge_script"],
+                output_names=["matrix_file", "normalized_file", "waytotal_file"],
+                function=merge_shards,
+            ),
+            name="merge_shards",
+            **resources("merge_shards"),
+        )
+        merge_shards_node.inputs.matrix_mode = args.matrix_mode
+        merge_shards_node.inputs.merge_script = str(MERGE_SCRIPT)
+        WF.connect(probtrackx, "out_dir", merge_shards_node, "shard_dirs")
+        WF.connect(split_seeds_node, "shard_specs", merge_shards_node, "shard_specs")
+
+        dot_csv = Node(
+            niu.Function(input_names=["in_file", "out_file"], output_names=["csv_file"], function=dot_to_csv),
+            name="dot_csv",
+            **resources("dot_csv"),
+        )
+        WF.connect(merge_shards_node, "matrix_file", dot_csv, "in_file")
+        dot_csv.inputs.out_file = "connectivity_matrix.csv"
+    else:
+        probtrackx = Node(fsl.ProbTrackX2(nsamples=args.nsamples, loopcheck=True), name="probtrackx", **resources("probtrackx"))
+        if args.matrix_mode == 1:
+            probtrackx.inputs.network = True
+        elif args.matrix_mode == 2:
+            probtrackx.inputs.omatrix2 = True
+            WF.connect(bet_b0, "mask_file", probtrackx, "target2")
+        elif args.matrix_mode == 3:
+            probtrackx.inputs.os2t = True
+            probtrackx.inputs.omatrix1 = True
+        elif args.matrix_mode == 4:
+            # target3 = lrtarget3 gives the NxN matrix over the seed mask
+            probtrackx.inputs.omatrix3 = True
+            WF.connect(make_roi, "seed_mask", probtrackx, "target3")
+            WF.connect(make_roi, "seed_mask", probtrackx, "lrtarget3")
+        WF.connect(bet_b0, "mask_file", probtrackx, "mask")
+        WF.connect(bedpostx, "merged", probtrackx, "samples")
+        WF.connect(make_roi, "roi_list", probtrackx, "seed")
+        WF.connect(make_roi, "roi_list", probtrackx, "target_masks")
+
+        # Convert DOT to CSV (Function interface)
+        dot_csv = Node(
+            niu.Function(input_names=["in_file", "out_file"], output_names=["csv_file"], function=dot_to_csv),
+            name="dot_csv",
+            **resources("dot_csv"),
+        )
+        WF.connect(probtrackx, "out_matrix_file", dot_csv, "in_file")
+        dot_csv.inputs.out_file = "connectivity_matrix.csv"
 
 ################################################################################
 # ------------------------------  DataSink  ---------------------------------- #
 ################################################################################
 
-datasink = Node(nio.DataSink(base_directory=str(out_root / "derivatives")), name="datasink")
+datasink = Node(nio.DataSink(base_directory=str(out_root / "derivatives")), name="datasink", **resources("datasink"))
 
 WF.connect([
     (eddy, datasink, [("out_corrected", "preproc.@dwi")]),
@@ -315,7 +424,13 @@ WF.connect([
     (flirt_atlas, datasink, [("out_file", "reg.@atlas_dwi")]),
     (make_roi, datasink, [("roi_list", "rois.@list"), ("seed_mask", "rois.@seed")]),
 ])
-if args.do_tract:
+if args.do_tract and args.shards > 1:
+    WF.connect(merge_shards_node, datasink, [
+        ("normalized_file", "tract.@connectome_norm"),
+        ("waytotal_file", "tract.@waytotal"),
+    ])
+    WF.connect(dot_csv, datasink, [("csv_file", "tract.@connectome")])
+elif args.do_tract:
     WF.connect(dot_csv, datasink, [("csv_file", "tract.@connectome")])
 
 ################################################################################
@@ -323,5 +438,11 @@ if args.do_tract:
 ################################################################################
 
 if __name__ == "__main__":
-    WF.run(plugin="MultiProc", plugin_args={"n_procs": args.n_procs})
+    plugin_args = {"n_procs": args.n_procs}
+    if args.memory_gb:
+        plugin_args["memory_gb"] = args.memory_gb
+    if args.resource_monitor:
+        config.enable_resource_monitor()
+        plugin_args["status_callback"] = make_status_callback(profile_db, subject_mvox)
+    WF.run(plugin="MultiProc", plugin_args=plugin_args)
     # Alternative: WF.run(plugin="SLURM", plugin_args={"sbatch_args": "--time=2:00:00"})